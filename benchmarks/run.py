@@ -0,0 +1,441 @@
+"""
+Microbenchmarks for the hot paths of the client.
+
+    python -m benchmarks.run -o results.json
+    python -m benchmarks.run -k wire --compare results.json
+
+Each benchmark is timed like `timeit`: the call count is scaled until one sample takes at least
+`--min-time` seconds, then `--repeat` samples are taken. Results are written as JSON together
+with the commit they were measured on, so runs can be compared across commits.
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+from typing import Callable, Dict, List, Optional, Tuple
+
+from pytorrent.bcode import bdecode, bencode
+from pytorrent.create import hash_pieces
+from pytorrent.peer_connection import (
+    Handshake,
+    Have,
+    PeerProtocol,
+    PeerStreamIterator,
+    Piece,
+    Request,
+)
+from pytorrent.storage import Storage
+from pytorrent.verify import PieceVerifier
+
+# a benchmark is set up once and returns (call, bytes processed per call, teardown)
+Setup = Callable[[], Tuple[Callable[[], object], int, Optional[Callable[[], None]]]]
+
+BENCHMARKS: Dict[str, Setup] = {}
+
+BLOCK_SIZE = 16 * 1024
+PIECE_LENGTH = 256 * 1024
+
+
+def benchmark(name: str):
+    def register(setup: Setup) -> Setup:
+        BENCHMARKS[name] = setup
+        return setup
+
+    return register
+
+
+# sample data
+
+
+def make_torrent(files: int = 5000, piece_length: int = PIECE_LENGTH) -> bytes:
+    """
+    A multi-file torrent of about 20 GiB, roughly the size of large real world metainfo
+    """
+    rng = random.Random(0)
+    lengths = [rng.randrange(1, 8 * 1024 * 1024) for _ in range(files)]
+    pieces = (sum(lengths) + piece_length - 1) // piece_length
+
+    return bencode(
+        {
+            "announce": "http://tracker.example.com:6969/announce",
+            "announce-list": [[f"udp://tracker{i}.example.com:1337/announce"] for i in range(8)],
+            "comment": "benchmark",
+            "created by": "pytorrent",
+            "creation date": 1700000000,
+            "info": {
+                "name": "benchmark",
+                "piece length": piece_length,
+                "pieces": rng.randbytes(20 * pieces),
+                "files": [
+                    {"length": length, "path": [f"dir{i % 50}", f"file{i}.bin"]}
+                    for i, length in enumerate(lengths)
+                ],
+            },
+        }
+    )
+
+
+def make_tracker_response(peers: int = 200, compact: bool = True) -> bytes:
+    rng = random.Random(0)
+    if compact:
+        peer_list = rng.randbytes(6 * peers)
+    else:
+        peer_list = [
+            {
+                "ip": ".".join(str(rng.randrange(1, 255)) for _ in range(4)),
+                "peer id": rng.randbytes(20),
+                "port": rng.randrange(1024, 65535),
+            }
+            for _ in range(peers)
+        ]
+
+    return bencode(
+        {
+            "complete": 120,
+            "incomplete": 80,
+            "interval": 1800,
+            "min interval": 900,
+            "peers": peer_list,
+        }
+    )
+
+
+def make_stream(blocks: int = 256) -> bytes:
+    """
+    What a leecher receives from a good peer: mostly blocks with Have bursts in between
+    """
+    block = bytes(range(256)) * (BLOCK_SIZE // 256)
+    frames = []
+    for i in range(blocks):
+        frames.append(Piece(i // 16, (i % 16) * BLOCK_SIZE, block).encode())
+        frames.append(b"".join(Have(i * 4 + j).encode() for j in range(4)))
+        if i % 8 == 0:
+            frames.append(Request(i, 0, BLOCK_SIZE).encode())
+    return b"".join(frames)
+
+
+class _NullTransport:
+    def get_extra_info(self, name, default=None):
+        return default
+
+    def pause_reading(self):
+        pass
+
+    def resume_reading(self):
+        pass
+
+    def writelines(self, data):
+        pass
+
+
+_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+def _run(coroutine):
+    # one loop for every call, so the timings do not include creating and closing loops
+    global _loop
+    if _loop is None:
+        _loop = asyncio.new_event_loop()
+    return _loop.run_until_complete(coroutine)
+
+
+# bencoding
+
+
+@benchmark("bcode/bdecode-torrent")
+def _bdecode_torrent():
+    data = make_torrent()
+    return lambda: bdecode(data), len(data), None
+
+
+@benchmark("bcode/bdecode-torrent-views")
+def _bdecode_torrent_views():
+    data = make_torrent()
+    return lambda: bdecode(data, views=True), len(data), None
+
+
+@benchmark("bcode/bencode-torrent")
+def _bencode_torrent():
+    data = make_torrent()
+    value = bdecode(data)
+    return lambda: bencode(value), len(data), None
+
+
+@benchmark("bcode/bdecode-tracker-compact")
+def _bdecode_compact():
+    data = make_tracker_response()
+    return lambda: bdecode(data), len(data), None
+
+
+@benchmark("bcode/bdecode-tracker-dict")
+def _bdecode_dict():
+    data = make_tracker_response(compact=False)
+    return lambda: bdecode(data), len(data), None
+
+
+# wire protocol
+
+
+def _frame_stream(stream: bytes, chunk_size: int) -> int:
+    async def _parse():
+        protocol = PeerProtocol()
+        protocol.connection_made(_NullTransport())
+
+        for i in range(0, len(stream), chunk_size):
+            chunk = stream[i : i + chunk_size]
+            buffer = protocol.get_buffer(len(chunk))
+            buffer[: len(chunk)] = chunk
+            protocol.buffer_updated(len(chunk))
+        protocol.eof_received()
+
+        count = 0
+        async for _ in PeerStreamIterator(protocol):
+            count += 1
+        return count
+
+    return _run(_parse())
+
+
+@benchmark("wire/framing-64k-reads")
+def _framing():
+    stream = make_stream()
+    return lambda: _frame_stream(stream, 64 * 1024), len(stream), None
+
+
+@benchmark("wire/framing-1500-reads")
+def _framing_small_reads():
+    stream = make_stream(64)
+    return lambda: _frame_stream(stream, 1500), len(stream), None
+
+
+@benchmark("wire/handshake-encode")
+def _handshake_encode():
+    handshake = Handshake(bytes(20), b"-PT0001-000000000000")
+    return handshake.encode, Handshake.length, None
+
+
+@benchmark("wire/handshake-decode")
+def _handshake_decode():
+    data = Handshake(bytes(20), b"-PT0001-000000000000").encode()
+    return lambda: Handshake.decode(data), len(data), None
+
+
+@benchmark("wire/request-encode")
+def _request_encode():
+    return lambda: Request(12, BLOCK_SIZE, BLOCK_SIZE).encode(), Request.size, None
+
+
+@benchmark("wire/request-decode")
+def _request_decode():
+    data = Request(12, BLOCK_SIZE, BLOCK_SIZE).encode()
+    return lambda: Request.decode(data), len(data), None
+
+
+@benchmark("wire/piece-encode-header")
+def _piece_encode():
+    piece = Piece(12, BLOCK_SIZE, bytes(BLOCK_SIZE))
+    return piece.encode_header, BLOCK_SIZE, None
+
+
+@benchmark("wire/piece-decode")
+def _piece_decode():
+    data = memoryview(Piece(12, BLOCK_SIZE, bytes(BLOCK_SIZE)).encode())
+    return lambda: Piece.decode(data), len(data), None
+
+
+# verification and disk
+
+
+@benchmark("verify/sha1-pieces")
+def _verify():
+    pieces = [os.urandom(PIECE_LENGTH) for _ in range(32)]
+    hashes = [hashlib.sha1(piece).digest() for piece in pieces]
+    results = []
+    verifier = PieceVerifier(hashes, lambda index, valid: results.append(valid))
+
+    async def _verify_all():
+        for index, piece in enumerate(pieces):
+            await verifier.submit(index, piece)
+        await verifier.join()
+        assert all(results)
+        results.clear()
+
+    return lambda: _run(_verify_all()), len(pieces) * PIECE_LENGTH, verifier.close
+
+
+@benchmark("storage/write-blocks")
+def _storage_write():
+    directory = tempfile.TemporaryDirectory(prefix="pytorrent-bench-")
+    pieces = 64
+    # three files so some pieces span file boundaries
+    size = pieces * PIECE_LENGTH
+    files = [
+        (os.path.join(directory.name, name), length)
+        for name, length in (("a", size // 3), ("b", size // 3), ("c", size - 2 * (size // 3)))
+    ]
+    storage = Storage(files, PIECE_LENGTH)
+    block = os.urandom(BLOCK_SIZE)
+
+    async def _write_all():
+        for index in range(pieces):
+            for begin in range(0, PIECE_LENGTH, BLOCK_SIZE):
+                storage.write_nowait(index, begin, block)
+        await storage.flush()
+
+    def _teardown():
+        storage.close()
+        directory.cleanup()
+
+    return lambda: _run(_write_all()), size, _teardown
+
+
+@benchmark("create/hash-pieces")
+def _create_hash():
+    directory = tempfile.TemporaryDirectory(prefix="pytorrent-bench-")
+    pieces = 64
+    size = pieces * PIECE_LENGTH
+    files = []
+    for name, length in (("a", size // 3), ("b", size // 3), ("c", size - 2 * (size // 3))):
+        path = os.path.join(directory.name, name)
+        with open(path, "wb") as f:
+            f.write(os.urandom(length))
+        files.append((path, length))
+    storage = Storage(files, PIECE_LENGTH, readonly=True)
+
+    def _teardown():
+        storage.close()
+        directory.cleanup()
+
+    return lambda: hash_pieces(storage), size, _teardown
+
+
+# runner
+
+
+def measure(setup: Setup, min_time: float, repeat: int) -> dict:
+    call, nbytes, teardown = setup()
+    try:
+        number = 1
+        while True:
+            elapsed = _time(call, number)
+            if elapsed >= min_time:
+                break
+            number = max(number * 2, int(number * min_time / max(elapsed, 1e-9) * 1.1))
+
+        samples = [elapsed / number] + [_time(call, number) / number for _ in range(repeat - 1)]
+    finally:
+        if teardown is not None:
+            teardown()
+
+    median = statistics.median(samples)
+    result = {
+        "number": number,
+        "samples": samples,
+        "min": min(samples),
+        "median": median,
+        "stdev": statistics.stdev(samples) if len(samples) > 1 else 0.0,
+        "ops_per_sec": 1 / median,
+    }
+    if nbytes:
+        result["bytes"] = nbytes
+        result["mb_per_sec"] = nbytes / median / 1e6
+    return result
+
+
+def _time(call: Callable[[], object], number: int) -> float:
+    start = time.perf_counter()
+    for _ in range(number):
+        call()
+    return time.perf_counter() - start
+
+
+def _commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            check=True,
+            text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _format_time(seconds: float) -> str:
+    for unit, scale in (("s", 1), ("ms", 1e-3), ("us", 1e-6)):
+        if seconds >= scale:
+            return f"{seconds / scale:.2f} {unit}"
+    return f"{seconds / 1e-9:.0f} ns"
+
+
+def run(names: List[str], min_time: float, repeat: int, baseline: Optional[dict] = None) -> dict:
+    report = {
+        "commit": _commit(),
+        "python": sys.version.split()[0],
+        "implementation": platform.python_implementation(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "timestamp": time.time(),
+        "results": {},
+    }
+    previous = (baseline or {}).get("results", {})
+
+    for name in names:
+        result = measure(BENCHMARKS[name], min_time, repeat)
+        report["results"][name] = result
+
+        line = f"{name:<32} {_format_time(result['median']):>10}"
+        if "mb_per_sec" in result:
+            line += f" {result['mb_per_sec']:>10.1f} MB/s"
+        if name in previous:
+            line += f"  {previous[name]['median'] / result['median']:.2f}x vs baseline"
+        print(line, flush=True)
+
+    return report
+
+
+def create_parser() -> ArgumentParser:
+    parser = ArgumentParser(description="Run the pytorrent microbenchmarks")
+    parser.add_argument("-k", "--filter", action="append", help="only names containing this")
+    parser.add_argument("-o", "--output", help="write the results as JSON to this file")
+    parser.add_argument("--compare", help="JSON results of an earlier run to compare against")
+    parser.add_argument("--min-time", type=float, default=0.2, help="seconds per sample")
+    parser.add_argument("--repeat", type=int, default=5, help="samples per benchmark")
+    parser.add_argument("--list", action="store_true", default=False)
+    return parser
+
+
+def main(argv: Optional[List[str]] = None):
+    args = create_parser().parse_args(argv)
+
+    names = [
+        name for name in BENCHMARKS if not args.filter or any(f in name for f in args.filter)
+    ]
+    if args.list:
+        print("\n".join(names))
+        return
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    report = run(names, args.min_time, args.repeat, baseline)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
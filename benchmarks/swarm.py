@@ -0,0 +1,597 @@
+"""
+Loopback swarm for end-to-end load tests of the whole client.
+
+    python -m benchmarks.swarm --size 256 --seeders 8 --leechers 4 --latency 20 --loss 0.001
+
+A stand-in HTTP tracker and simulated seeders and leechers serve a generated torrent on
+127.0.0.1, and a real `Manager` downloads it to a temporary directory. Every simulated peer
+shapes the traffic it sends with a `Link` (latency, bandwidth and packet loss) and, with churn,
+leaves after a random uptime and rejoins the swarm on a new port.
+
+The swarm runs in a child process so the reported CPU time is the client's alone, `--in-process`
+runs it on the client's event loop instead.
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import multiprocessing
+import random
+import resource
+import socket
+import struct
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+from collections import deque
+from typing import Deque, Dict, List, Optional, Set, Tuple
+
+from aiohttp import web
+
+from pytorrent.bcode import bencode
+from pytorrent.peer_connection import (
+    BitField,
+    Handshake,
+    Have,
+    HaveAll,
+    Interested,
+    PeerMessage,
+    Piece,
+    Request,
+    UnChoke,
+)
+from pytorrent.piece_manager import BLOCK_SIZE, Bitfield
+from pytorrent.torrent import Torrent
+
+_LENGTH = struct.Struct(">I")
+_BLOCK = struct.Struct(">III")
+
+
+class SwarmConfig:
+    def __init__(
+        self,
+        size: int = 64 * 1024 * 1024,
+        piece_length: int = 256 * 1024,
+        files: int = 3,
+        seeders: int = 4,
+        leechers: int = 2,
+        leecher_share: float = 0.5,
+        latency: float = 0.02,
+        bandwidth: Optional[float] = None,
+        loss: float = 0.0,
+        churn: float = 0.0,
+        downtime: float = 5.0,
+        announce_interval: int = 10,
+        seed: int = 0,
+    ):
+        self.size = size
+        self.piece_length = piece_length
+        self.files = files
+        self.seeders = seeders
+        self.leechers = leechers
+        # fraction of the pieces a simulated leecher starts with
+        self.leecher_share = leecher_share
+        # one-way delay in seconds and bytes per second of every link
+        self.latency = latency
+        self.bandwidth = bandwidth
+        # probability that a packet is lost, delaying everything behind it on its link
+        self.loss = loss
+        # mean seconds a peer stays online, 0 keeps every peer up
+        self.churn = churn
+        self.downtime = downtime
+        self.announce_interval = announce_interval
+        self.seed = seed
+
+    @property
+    def piece_count(self) -> int:
+        return (self.size + self.piece_length - 1) // self.piece_length
+
+
+class Link:
+    """
+    One direction of a simulated connection.
+
+    Messages leave in order at `bandwidth` and arrive `latency` later. A message that would
+    lose one of its packets holds up the link for a retransmission timeout, like TCP.
+    """
+
+    MSS = 1448
+    MIN_RTO = 0.2
+
+    def __init__(self, writer: asyncio.StreamWriter, config: SwarmConfig, rng: random.Random):
+        self.writer = writer
+        self.latency = config.latency
+        self.bandwidth = config.bandwidth
+        self.loss = config.loss
+        self.rng = rng
+        self.sent = 0
+        self.retransmits = 0
+
+        self._queue: Deque[Tuple[float, List[bytes]]] = deque()
+        self._in_flight: Deque[Tuple[float, List[bytes]]] = deque()
+        self._queued = asyncio.Event()
+        self._arrived = asyncio.Event()
+        self._tasks = [
+            asyncio.get_running_loop().create_task(self._transmit()),
+            asyncio.get_running_loop().create_task(self._deliver()),
+        ]
+
+    def send(self, *data: bytes, ready: Optional[float] = None):
+        """
+        Queue `data`, not sent before the loop time `ready`
+        """
+        self._queue.append((ready or 0.0, list(data)))
+        self._queued.set()
+
+    def close(self):
+        for task in self._tasks:
+            task.cancel()
+        self.writer.close()
+
+    async def _transmit(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            while not self._queue:
+                self._queued.clear()
+                await self._queued.wait()
+
+            ready, data = self._queue.popleft()
+            if ready > loop.time():
+                await asyncio.sleep(ready - loop.time())
+
+            size = sum(len(part) for part in data)
+            duration = size / self.bandwidth if self.bandwidth else 0.0
+            packets = -(-size // Link.MSS)
+            if self.loss and self.rng.random() < 1 - (1 - self.loss) ** packets:
+                self.retransmits += 1
+                duration += max(Link.MIN_RTO, 2 * self.latency)
+            if duration:
+                await asyncio.sleep(duration)
+
+            self._in_flight.append((loop.time() + self.latency, data))
+            self._arrived.set()
+
+    async def _deliver(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            while not self._in_flight:
+                self._arrived.clear()
+                await self._arrived.wait()
+
+            due, data = self._in_flight.popleft()
+            if due > loop.time():
+                await asyncio.sleep(due - loop.time())
+
+            self.writer.writelines(data)
+            self.sent += sum(len(part) for part in data)
+            await self.writer.drain()
+
+
+class SimulatedPeer:
+    """
+    Seeder or leecher on its own port. It unchokes everybody, serves the pieces it has and,
+    as a leecher, downloads the pieces it is missing from the client without checking them.
+    """
+
+    MAX_REQUESTS = 32
+
+    def __init__(self, swarm: "Swarm", have: Bitfield, rng: random.Random):
+        self.swarm = swarm
+        self.config = swarm.config
+        self.have = have
+        self.rng = rng
+        self.peer_id = b"-SIM000-" + rng.randbytes(12)
+        self.port = 0
+
+        self.uploaded = 0
+        self.downloaded = 0
+        self.retransmits = 0
+
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._links: Set[Link] = set()
+
+    @property
+    def seeder(self) -> bool:
+        return self.have.all()
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._serve, "127.0.0.1", 0)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self._server is None:
+            return
+
+        self._server.close()
+        self._server = None
+        for link in list(self._links):
+            link.close()
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        link = Link(writer, self.config, self.rng)
+        self._links.add(link)
+        try:
+            await self._exchange(reader, link)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self._links.discard(link)
+            self.retransmits += link.retransmits
+            link.close()
+
+    async def _exchange(self, reader: asyncio.StreamReader, link: Link):
+        loop = asyncio.get_running_loop()
+        handshake = Handshake.decode(await reader.readexactly(Handshake.length))
+        if handshake is None or handshake.info_hash != self.swarm.info_hash:
+            return
+
+        fast = handshake.supports(Handshake.FAST_EXTENSION)
+        if fast and self.have.all():
+            pieces = HaveAll().encode()
+        else:
+            pieces = BitField(self.have.to_bytes()).encode()
+        link.send(
+            Handshake(self.swarm.info_hash, self.peer_id).encode(), pieces, UnChoke().encode()
+        )
+        if not self.seeder:
+            link.send(Interested().encode())
+
+        remote = Bitfield(self.config.piece_count)
+        choked = True
+        # piece index -> blocks still to come
+        pending: Dict[int, int] = {}
+
+        while True:
+            length = _LENGTH.unpack(await reader.readexactly(_LENGTH.size))[0]
+            if not length:
+                continue
+            message = await reader.readexactly(length)
+            message_id = message[0]
+
+            if message_id == PeerMessage.Request:
+                index, begin, size = _BLOCK.unpack_from(message, 1)
+                if index not in self.have:
+                    continue
+                offset = index * self.config.piece_length + begin
+                data = self.swarm.data[offset : offset + size]
+                # the request itself took `latency` to get here
+                link.send(
+                    Piece(index, begin, data).encode_header(),
+                    data,
+                    ready=loop.time() + self.config.latency,
+                )
+                self.uploaded += size
+            elif message_id == PeerMessage.Piece:
+                index, begin = struct.unpack_from(">II", message, 1)
+                self.downloaded += length - 9
+                if index in pending:
+                    pending[index] -= 1
+                    if not pending[index]:
+                        del pending[index]
+                        self.have.add(index)
+                        link.send(Have(index).encode())
+            elif message_id == PeerMessage.Have:
+                remote.add(struct.unpack_from(">I", message, 1)[0])
+            elif message_id == PeerMessage.BitField:
+                remote = Bitfield(self.config.piece_count, message[1:])
+            elif message_id == PeerMessage.HaveAll:
+                remote = Bitfield(self.config.piece_count, b"\xff" * len(remote.to_bytes()))
+            elif message_id == PeerMessage.RejectRequest:
+                # asked again once the client unchokes us
+                pending.pop(_BLOCK.unpack_from(message, 1)[0], None)
+            elif message_id == PeerMessage.UnChoke:
+                choked = False
+            elif message_id == PeerMessage.Choke:
+                choked = True
+                pending.clear()
+
+            if not choked and not self.seeder:
+                self._request(link, remote, pending)
+
+    def _request(self, link: Link, remote: Bitfield, pending: Dict[int, int]):
+        outstanding = sum(pending.values())
+        for index in remote:
+            if outstanding >= SimulatedPeer.MAX_REQUESTS:
+                return
+            if index in self.have or index in pending:
+                continue
+
+            size = self.swarm.piece_size(index)
+            blocks = [
+                Request(index, begin, min(BLOCK_SIZE, size - begin)).encode()
+                for begin in range(0, size, BLOCK_SIZE)
+            ]
+            pending[index] = len(blocks)
+            outstanding += len(blocks)
+            link.send(*blocks)
+
+
+class Swarm:
+    """
+    The stand-in tracker and the simulated peers of one generated torrent
+    """
+
+    def __init__(self, config: SwarmConfig):
+        self.config = config
+        self.rng = random.Random(config.seed)
+        self.data = memoryview(self.rng.randbytes(config.size))
+        self.metainfo = b""
+        self.info_hash = b""
+
+        self.peers: List[SimulatedPeer] = []
+        self.left: List[SimulatedPeer] = []
+        self.announces = 0
+        # the event of every announce and the upload total last reported by the client
+        self.events: List[str] = []
+        self.reported_uploaded = 0
+
+        self._runner: Optional[web.AppRunner] = None
+        self._tasks: List[asyncio.Task] = []
+
+    def piece_size(self, index: int) -> int:
+        return min(self.config.piece_length, self.config.size - index * self.config.piece_length)
+
+    async def start(self) -> bytes:
+        """
+        Start the tracker and the peers, returns the metainfo of the torrent
+        """
+        app = web.Application()
+        app.router.add_get("/announce", self._announce)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        port = self._runner.addresses[0][1]
+
+        self.metainfo = self._make_metainfo(f"http://127.0.0.1:{port}/announce")
+        self.info_hash = Torrent(self.metainfo).info_hash
+
+        config = self.config
+        for i in range(config.seeders + config.leechers):
+            have = Bitfield(config.piece_count)
+            for index in range(config.piece_count):
+                if i < config.seeders or self.rng.random() < config.leecher_share:
+                    have.add(index)
+
+            peer = SimulatedPeer(self, have, random.Random(self.rng.random()))
+            await peer.start()
+            self.peers.append(peer)
+            if config.churn:
+                self._tasks.append(asyncio.get_running_loop().create_task(self._churn(peer)))
+
+        return self.metainfo
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        for peer in self.peers:
+            await peer.stop()
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    def stats(self) -> dict:
+        peers = self.peers + self.left
+        return {
+            "announces": self.announces,
+            "events": self.events,
+            "reported_uploaded": self.reported_uploaded,
+            "uploaded": sum(peer.uploaded for peer in peers),
+            "downloaded": sum(peer.downloaded for peer in peers),
+            "retransmits": sum(peer.retransmits for peer in peers),
+            "departures": len(self.left),
+        }
+
+    def _make_metainfo(self, announce: str) -> bytes:
+        config = self.config
+        pieces = b"".join(
+            hashlib.sha1(
+                self.data[index * config.piece_length :][: self.piece_size(index)]
+            ).digest()
+            for index in range(config.piece_count)
+        )
+
+        lengths = [config.size // config.files] * config.files
+        lengths[-1] += config.size - sum(lengths)
+        return bencode(
+            {
+                "announce": announce,
+                "info": {
+                    "name": "swarm",
+                    "piece length": config.piece_length,
+                    "pieces": pieces,
+                    "files": [
+                        {"length": length, "path": [f"file{i}.bin"]}
+                        for i, length in enumerate(lengths)
+                    ],
+                },
+            }
+        )
+
+    async def _announce(self, request: web.Request) -> web.Response:
+        self.announces += 1
+        self.events.append(request.query.get("event", ""))
+        self.reported_uploaded = int(request.query.get("uploaded", 0))
+        peers = b"".join(
+            socket.inet_aton("127.0.0.1") + struct.pack(">H", peer.port) for peer in self.peers
+        )
+        seeders = sum(1 for peer in self.peers if peer.seeder)
+        return web.Response(
+            body=bencode(
+                {
+                    "interval": self.config.announce_interval,
+                    "complete": seeders,
+                    "incomplete": len(self.peers) - seeders,
+                    "peers": peers,
+                }
+            )
+        )
+
+    async def _churn(self, peer: SimulatedPeer):
+        # a departing peer is replaced by one with the same pieces on a new port
+        while True:
+            await asyncio.sleep(self.rng.expovariate(1 / self.config.churn))
+            await peer.stop()
+            self.peers.remove(peer)
+            self.left.append(peer)
+
+            await asyncio.sleep(self.config.downtime)
+            peer, departed = SimulatedPeer(self, peer.have, peer.rng), peer
+            await peer.start()
+            self.peers.append(peer)
+            logging.debug("Peer on port %d was replaced by %d", departed.port, peer.port)
+
+
+def _cpu_time() -> float:
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+async def download(metainfo: bytes, timeout: float = 600.0) -> dict:
+    """
+    Download `metainfo` with a fresh `Manager` and measure it
+    """
+    # the client lives in the top level script
+    from main import Manager
+
+    torrent = Torrent(metainfo)
+    with tempfile.TemporaryDirectory(prefix="pytorrent-swarm-") as directory:
+        manager = Manager(directory)
+
+        cpu = _cpu_time()
+        started = time.monotonic()
+        session = await manager.add_torrent(torrent)
+        first_piece = None
+
+        try:
+            deadline = started + timeout
+            while session.written.count < session.piece_manager.piece_count:
+                if first_piece is None and session.written.count:
+                    first_piece = time.monotonic() - started
+                if time.monotonic() > deadline:
+                    raise TimeoutError(
+                        f"{session.written.count} of {session.piece_manager.piece_count} "
+                        f"pieces after {timeout} seconds"
+                    )
+                await asyncio.sleep(0.005)
+
+            elapsed = time.monotonic() - started
+            cpu = _cpu_time() - cpu
+            uploaded = session.uploader.uploaded
+            peers = len(session.pool.store)
+            metrics = manager.metrics.snapshot()
+        finally:
+            await manager.remove_torrent(torrent.info_hash)
+            await manager.http_session.close()
+
+    megabytes = torrent.total_size / 1e6
+    return {
+        "bytes": torrent.total_size,
+        "seconds": elapsed,
+        "mb_per_sec": megabytes / elapsed,
+        "time_to_first_piece": first_piece if first_piece is not None else elapsed,
+        "cpu_seconds": cpu,
+        "cpu_per_mb": cpu / megabytes,
+        "uploaded": uploaded,
+        "peers_seen": peers,
+        "metrics": metrics,
+    }
+
+
+async def _simulate_in_process(config: SwarmConfig, timeout: float) -> dict:
+    swarm = Swarm(config)
+    try:
+        report = await download(await swarm.start(), timeout)
+    finally:
+        await swarm.stop()
+    report["swarm"] = swarm.stats()
+    return report
+
+
+def _run_swarm(config: SwarmConfig, connection):
+    async def _run():
+        swarm = Swarm(config)
+        connection.send(await swarm.start())
+        # the parent sends anything once it is done
+        await asyncio.get_running_loop().run_in_executor(None, connection.recv)
+        stats = swarm.stats()
+        await swarm.stop()
+        connection.send(stats)
+
+    asyncio.run(_run())
+
+
+def simulate(config: SwarmConfig, in_process: bool = False, timeout: float = 600.0) -> dict:
+    if in_process:
+        return asyncio.run(_simulate_in_process(config, timeout))
+
+    context = multiprocessing.get_context("spawn")
+    connection, child_connection = context.Pipe()
+    process = context.Process(target=_run_swarm, args=(config, child_connection), daemon=True)
+    process.start()
+    try:
+        report = asyncio.run(download(connection.recv(), timeout))
+        connection.send(None)
+        report["swarm"] = connection.recv()
+    finally:
+        process.join(timeout=5)
+        if process.is_alive():
+            process.terminate()
+    return report
+
+
+def create_parser() -> ArgumentParser:
+    parser = ArgumentParser(description="Download a generated torrent from a loopback swarm")
+    parser.add_argument("--size", type=int, default=64, help="MiB")
+    parser.add_argument("--piece-length", type=int, default=256, help="KiB")
+    parser.add_argument("--files", type=int, default=3)
+    parser.add_argument("--seeders", type=int, default=4)
+    parser.add_argument("--leechers", type=int, default=2)
+    parser.add_argument("--latency", type=float, default=20, help="one-way, milliseconds")
+    parser.add_argument("--bandwidth", type=int, default=0, help="KiB/s per link, 0 is unlimited")
+    parser.add_argument("--loss", type=float, default=0.0, help="packet loss probability")
+    parser.add_argument("--churn", type=float, default=0, help="mean peer uptime in seconds")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--timeout", type=float, default=600)
+    parser.add_argument("--in-process", action="store_true", default=False)
+    parser.add_argument("-o", "--output", help="write the report as JSON to this file")
+    parser.add_argument("-v", "--verbose", action="store_true", default=False)
+    return parser
+
+
+def main(argv: Optional[List[str]] = None):
+    args = create_parser().parse_args(argv)
+    if args.verbose:
+        logging.basicConfig(level=logging.INFO)
+
+    config = SwarmConfig(
+        size=args.size * 1024 * 1024,
+        piece_length=args.piece_length * 1024,
+        files=args.files,
+        seeders=args.seeders,
+        leechers=args.leechers,
+        latency=args.latency / 1000,
+        bandwidth=args.bandwidth * 1024 or None,
+        loss=args.loss,
+        churn=args.churn,
+        seed=args.seed,
+    )
+    report = simulate(config, args.in_process, args.timeout)
+    report["config"] = vars(config)
+
+    print(
+        f"{report['mb_per_sec']:.1f} MB/s, first piece after "
+        f"{report['time_to_first_piece'] * 1000:.0f} ms, "
+        f"{report['cpu_per_mb'] * 1000:.1f} ms CPU per MB"
+    )
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
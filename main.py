@@ -1,44 +1,187 @@
 import asyncio
+import base64
+import os
 from asyncio.exceptions import CancelledError
 import hashlib
+import multiprocessing
 import platform
 from pytorrent.torrent import TrackerResponse
 import signal
+import socket
 from argparse import ArgumentParser
-from typing import Optional, List
+from typing import Dict, Optional, List
 import logging
 import time
 import struct
-import bitstring
+import sys
 
 import aiohttp
 
-from pytorrent import Torrent, bdecode, bencode, Tracker, PeerConnection, PieceManager
+from pytorrent import Torrent, bdecode, bencode, make_torrent
+from pytorrent.budget import ResourceBudget, SessionLimits
+from pytorrent.ipc import Channel
+from pytorrent.listener import Listener
+from pytorrent.metrics import (
+    LoopMonitor,
+    Registry,
+    merge_exports,
+    render_prometheus,
+    serve_metrics,
+)
+from pytorrent.peer_connection import Handshake
+from pytorrent.peer_pool import PeerPool
+from pytorrent.ratelimit import TokenBucket
+from pytorrent.udp_tracker import ConnectionCache
+from pytorrent.session import TorrentSession
+
+EVENT_LOOPS = ("auto", "asyncio", "uvloop")
 
 
 def create_parser() -> ArgumentParser:
     parser = ArgumentParser()
-    parser.add_argument("file")
+    parser.add_argument("files", nargs="+")
+    parser.add_argument("-o", "--output-dir", default=".")
+    parser.add_argument("--preallocate", action="store_true", default=False)
+    parser.add_argument("--resume-dir", default=None)
+    parser.add_argument("--recheck", action="store_true", default=False)
+    parser.add_argument("--download-limit", type=int, default=0, help="KiB/s, 0 is unlimited")
+    parser.add_argument("--upload-limit", type=int, default=0, help="KiB/s, 0 is unlimited")
+    parser.add_argument(
+        "--metrics-port", type=int, default=0, help="serve Prometheus metrics on localhost"
+    )
+    parser.add_argument(
+        "--listen-port", type=int, default=None, help="accept incoming peers, 0 picks a port"
+    )
+    parser.add_argument(
+        "--workers", type=int, default=1, help="processes to spread the torrents over"
+    )
+    parser.add_argument(
+        "--event-loop",
+        choices=EVENT_LOOPS,
+        default="auto",
+        help="auto uses uvloop where it is installed",
+    )
     parser.add_argument("-v", "--verbose", action="store_true", default=False)
     parser.add_argument("--debug", action="store_true", default=False)
 
     return parser
 
 
-MAX_PEER_CONNECTIONS = 2  # 30
+def create_torrent_parser() -> ArgumentParser:
+    parser = ArgumentParser(prog="main.py create", description="Create a torrent file")
+    parser.add_argument("path", help="file or directory to share")
+    parser.add_argument("-o", "--output", default=None, help="defaults to <name>.torrent")
+    parser.add_argument("-t", "--tracker", action="append", default=[], help="announce URL")
+    parser.add_argument("--web-seed", action="append", default=[], help="web seed URL (BEP 19)")
+    parser.add_argument("--piece-length", type=int, default=None, help="KiB, picked by size")
+    parser.add_argument("--name", default=None)
+    parser.add_argument("--comment", default=None)
+    parser.add_argument("--private", action="store_true", default=False)
+    parser.add_argument("--workers", type=int, default=None, help="hashing threads")
+
+    return parser
+
+
+def create_torrent(argv: List[str]):
+    args = create_torrent_parser().parse_args(argv)
+    output = args.output or os.path.basename(os.path.abspath(args.path)) + ".torrent"
+
+    start = time.monotonic()
+    metainfo = make_torrent(
+        args.path,
+        trackers=args.tracker,
+        piece_length=args.piece_length * 1024 if args.piece_length else None,
+        name=args.name,
+        private=args.private,
+        comment=args.comment,
+        web_seeds=args.web_seed,
+        workers=args.workers,
+    )
+    elapsed = time.monotonic() - start
+
+    with open(output, "wb") as f:
+        f.write(metainfo)
+
+    info = Torrent(metainfo).info
+    print(
+        f"{output}: {info.total_length} bytes in {len(info.pieces)} pieces of "
+        f"{info.piece_length // 1024} KiB, hashed in {elapsed:.2f}s "
+        f"({info.total_length / max(elapsed, 1e-9) / 2**20:.1f} MiB/s)"
+    )
+
+
+def new_event_loop(kind: str = "auto") -> asyncio.AbstractEventLoop:
+    """
+    A new event loop of `kind`, "auto" prefers uvloop and falls back to asyncio's own
+    """
+    if kind not in EVENT_LOOPS:
+        raise ValueError(f"Unknown event loop {kind}")
+
+    if kind != "asyncio":
+        try:
+            import uvloop
+        except ImportError:
+            if kind == "uvloop":
+                raise
+        else:
+            return uvloop.new_event_loop()
+
+    return asyncio.new_event_loop()
 
 
 class Manager:
-    def __init__(self):
+    """
+    Runs any number of torrent sessions on one event loop. The HTTP client and the limits on
+    open connections, half-open connects and file descriptors are shared by all torrents.
+    """
+
+    MAX_CONNECTIONS = 500
+    MAX_HALF_OPEN = 50
+    MAX_OPEN_FILES = 512
+    MIN_OPEN_FILES_PER_TORRENT = 2
+
+    def __init__(
+        self,
+        download_dir: str = ".",
+        preallocate: bool = False,
+        resume_dir: Optional[str] = None,
+        force_recheck: bool = False,
+        max_connections: int = MAX_CONNECTIONS,
+        max_half_open: int = MAX_HALF_OPEN,
+        max_open_files: int = MAX_OPEN_FILES,
+        max_peers: int = PeerPool.MAX_PEERS,
+        metrics_port: Optional[int] = None,
+        listen_port: Optional[int] = None,
+    ):
+        self.download_dir = download_dir
+        self.preallocate = preallocate
+        self.resume_dir = resume_dir or os.path.join(download_dir, ".pytorrent")
+        self.force_recheck = force_recheck
         self.torrent_files: List[Torrent] = []
         self.should_continue = True
         self.abort = False
 
-        self.available_peers = asyncio.Queue()
-        self.peers = []
-        self.piece_manager = PieceManager()
+        self.sessions: Dict[bytes, TorrentSession] = {}
+        self.connections = ResourceBudget(max_connections)
+        self.half_open = ResourceBudget(max_half_open)
+        self.max_open_files = max_open_files
+        self.max_peers = max_peers
+        self.udp_connections: ConnectionCache = {}
+        self.download_limit = TokenBucket()
+        self.upload_limit = TokenBucket()
+
+        self.metrics = Registry()
+        self.metrics_port = metrics_port
+        self.loop_monitor = LoopMonitor(self.metrics)
+        self._metrics_runner = None
+        self._tasks: List[asyncio.Task] = []
+
+        self.listen_port = listen_port
+        self.listener: Optional[Listener] = None
+        # the port announced to trackers, where peers reach the listener
+        self.port: Optional[int] = None
 
-        self.http_session: Optional[aiohttp.ClientSession]
+        self.http_session: Optional[aiohttp.ClientSession] = None
 
         self.loop = asyncio.get_event_loop()
 
@@ -48,74 +191,474 @@ class Manager:
         else:
             self.torrent_files.append(Torrent(file))
 
+    async def add_torrent(self, torrent: Torrent) -> TorrentSession:
+        """
+        Start downloading a torrent, can be called at any time while the loop is running
+        """
+        if torrent.info_hash in self.sessions:
+            return self.sessions[torrent.info_hash]
+
+        if self.http_session is None:
+            self.http_session = aiohttp.ClientSession()
+
+        session = TorrentSession(
+            torrent,
+            self.http_session,
+            SessionLimits(
+                torrent.info_hash,
+                self.connections,
+                self.half_open,
+                self.download_limit,
+                self.upload_limit,
+            ),
+            self.download_dir,
+            self.resume_dir,
+            self.max_peers,
+            self.preallocate,
+            self.force_recheck,
+            udp_connections=self.udp_connections,
+            registry=self.metrics,
+        )
+        if self.port:
+            session.tracker.port = self.port
+        self.sessions[torrent.info_hash] = session
+        self._rebalance_files()
+
+        try:
+            await session.start()
+        except Exception:
+            del self.sessions[torrent.info_hash]
+            session.close()
+            raise
+
+        logging.info("Added torrent %s", torrent.info_hash.hex())
+        return session
+
+    async def remove_torrent(self, info_hash: bytes):
+        session = self.sessions.pop(info_hash, None)
+        if session is None:
+            return
+
+        await session.stop()
+        self._rebalance_files()
+        logging.info("Removed torrent %s", info_hash.hex())
+
+    def set_rate_limits(self, download: Optional[float] = None, upload: Optional[float] = None):
+        """
+        Global limits in bytes per second for all torrents, None removes a limit. Torrent and
+        peer limits are set through `TorrentSession.limits.set_rates`.
+        """
+        self.download_limit.set_rate(download)
+        self.upload_limit.set_rate(upload)
+
+    def stats(self) -> dict:
+        """
+        Snapshot of every torrent and its peers, plus the raw metrics
+        """
+        return {
+            "event_loop_lag": self.loop_monitor.lag.get(),
+            "connections": self.connections.used,
+            "half_open": self.half_open.used,
+            "torrents": {
+                info_hash.hex(): session.stats() for info_hash, session in self.sessions.items()
+            },
+            "metrics": self.metrics.snapshot(),
+        }
+
+    async def serve_metrics(self, port: int, host: str = "127.0.0.1"):
+        """
+        Serve the metrics in the Prometheus text format on http://host:port/metrics
+        """
+        self._metrics_runner = await serve_metrics(self.metrics, host, port)
+        logging.info("Serving metrics on http://%s:%d/metrics", host, port)
+
+    async def listen(self, port: int = 0, host: str = "0.0.0.0"):
+        """
+        Accept incoming connections for all torrents on `port`, 0 picks a free one
+        """
+        self.listener = Listener(self.accept, host, port)
+        await self.listener.start()
+        self.port = self.listener.port
+        for session in self.sessions.values():
+            session.tracker.port = self.port
+
+    def accept(self, sock: socket.socket, handshake: Handshake) -> bool:
+        """
+        Hand an incoming connection to the torrent it is for, False when it is refused
+        """
+        session = self.sessions.get(handshake.info_hash)
+        if session is None or session.pool is None:
+            return False
+        return session.pool.accept(sock, handshake)
+
+    def _rebalance_files(self):
+        share = self.max_open_files // max(1, len(self.sessions))
+        for session in self.sessions.values():
+            session.storage.max_open_files = max(Manager.MIN_OPEN_FILES_PER_TORRENT, share)
+
     def stop(self):
-        if not self.http_session.closed:
+        for session in self.sessions.values():
+            session.stop_blocking()
+        self.sessions.clear()
+
+        for task in self._tasks:
+            task.cancel()
+        if self.listener:
+            self.listener.close()
+        if self._metrics_runner:
+            self.loop.create_task(self._metrics_runner.cleanup())
+
+        if self.http_session and not self.http_session.closed:
             self.loop.create_task(self.http_session.close())
 
+    async def shutdown(self):
+        """
+        Stop every torrent and wait until everything is saved and closed
+        """
+        if self.listener:
+            self.listener.close()
+        for info_hash in list(self.sessions):
+            await self.remove_torrent(info_hash)
+
+        for task in self._tasks:
+            task.cancel()
+        if self._metrics_runner:
+            await self._metrics_runner.cleanup()
+            self._metrics_runner = None
+        if self.http_session and not self.http_session.closed:
+            await self.http_session.close()
+
     async def run(self):
-        self.http_session = aiohttp.ClientSession()
-        torrent = self.torrent_files[0]
-        tracker = Tracker(torrent, self.http_session)
+        self._tasks.append(self.loop.create_task(self.loop_monitor.run()))
+        if self.metrics_port:
+            await self.serve_metrics(self.metrics_port)
+        if self.listen_port is not None:
+            await self.listen(self.listen_port)
 
-        self.peers = [
-            PeerConnection(
-                self.available_peers,
-                torrent.info_hash,
-                tracker.peer_id,
-                self.piece_manager,
-                self.loop,
-                self.http_session,
-            )
-            for _ in range(MAX_PEER_CONNECTIONS)
-        ]
+        for torrent in self.torrent_files:
+            await self.add_torrent(torrent)
 
-        previous = None
-        interval = 30 * 60
-        while True:
+    def start(self):
+        self.loop.create_task(self.run())
+        self.loop.run_forever()
 
-            current = time.time()
 
-            if (not previous) or (previous + interval < current):
-                async with Tracker(torrent, self.http_session).connect() as tracker_response:
+class Worker:
+    """
+    One process of a `ShardedManager`: a `Manager` on its own event loop, driven by the front
+    process over `channel`
+    """
+
+    def __init__(self, sock: socket.socket, options: dict, port: Optional[int] = None):
+        self.manager = Manager(**options)
+        self.manager.port = port
+        self.channel = Channel(sock, self._handle)
+        self._stopped = asyncio.Event()
+        self._methods = {
+            "add_torrent": self._add_torrent,
+            "remove_torrent": self._remove_torrent,
+            "accept": self._accept,
+            "set_rate_limits": self._set_rate_limits,
+            "stats": self._stats,
+            "metrics": self._metrics,
+            "stop": self._stop,
+        }
 
-                    if failed_reason := tracker_response.failure_reason:
-                        logging.error(failed_reason)
-                        continue
+    async def run(self):
+        await self.manager.run()
+        self.channel.start()
 
-                    if warning_message := tracker_response.warning_message:
-                        logging.warning(warning_message)
+        # until the front asks to stop or goes away
+        waiters = [
+            asyncio.ensure_future(self._stopped.wait()),
+            asyncio.ensure_future(self.channel.wait_closed()),
+        ]
+        await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+        for waiter in waiters:
+            waiter.cancel()
+
+        await self.manager.shutdown()
+        self.channel.close()
+
+    async def _handle(self, method: str, args: dict, fds: List[int]):
+        handler = self._methods.get(method)
+        if handler is None:
+            for fd in fds:
+                os.close(fd)
+            raise ValueError(f"Unknown method {method}")
+        return await handler(args, fds)
+
+    async def _add_torrent(self, args: dict, fds: List[int]) -> str:
+        torrent = Torrent(base64.b64decode(args["metainfo"]))
+        await self.manager.add_torrent(torrent)
+        return torrent.info_hash.hex()
+
+    async def _remove_torrent(self, args: dict, fds: List[int]):
+        await self.manager.remove_torrent(bytes.fromhex(args["info_hash"]))
+
+    async def _accept(self, args: dict, fds: List[int]):
+        sock = socket.socket(fileno=fds[0])
+        handshake = Handshake.decode(base64.b64decode(args["handshake"]))
+        if handshake is None or not self.manager.accept(sock, handshake):
+            sock.close()
+
+    async def _set_rate_limits(self, args: dict, fds: List[int]):
+        self.manager.set_rate_limits(args["download"], args["upload"])
+
+    async def _stats(self, args: dict, fds: List[int]) -> dict:
+        return self.manager.stats()
+
+    async def _metrics(self, args: dict, fds: List[int]) -> list:
+        return self.manager.metrics.export()
+
+    async def _stop(self, args: dict, fds: List[int]):
+        self._stopped.set()
+
+
+def _run_worker(
+    sock: socket.socket, options: dict, port: Optional[int], event_loop: str, log_level: int
+):
+    # the front process decides when workers stop, e.g. on ctrl-c of the whole process group
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logging.basicConfig(level=log_level)
+
+    loop = new_event_loop(event_loop)
+    asyncio.set_event_loop(loop)
+    try:
+        loop.run_until_complete(Worker(sock, options, port).run())
+    finally:
+        loop.close()
+
+
+class ShardedManager:
+    """
+    Spreads torrents over worker processes that each run a `Manager` on their own event loop,
+    so framing and message handling of many torrents are not limited to one core.
+
+    The front process assigns every torrent to the worker with the fewest. It owns the listen
+    port: incoming connections are accepted here and, once the handshake tells the torrent,
+    the socket is passed to the worker that runs it. Workers are controlled and report stats
+    and metrics over a `Channel` on a Unix socket pair. Connection and file limits and the
+    global rate limits are split evenly between the workers.
+    """
+
+    STOP_TIMEOUT = 30.0
+
+    def __init__(
+        self,
+        workers: int = os.cpu_count() or 1,
+        download_dir: str = ".",
+        preallocate: bool = False,
+        resume_dir: Optional[str] = None,
+        force_recheck: bool = False,
+        max_connections: int = Manager.MAX_CONNECTIONS,
+        max_half_open: int = Manager.MAX_HALF_OPEN,
+        max_open_files: int = Manager.MAX_OPEN_FILES,
+        max_peers: int = PeerPool.MAX_PEERS,
+        metrics_port: Optional[int] = None,
+        listen_port: Optional[int] = None,
+        event_loop: str = "auto",
+    ):
+        self.workers = max(1, workers)
+        self.options = {
+            "download_dir": download_dir,
+            "preallocate": preallocate,
+            "resume_dir": resume_dir,
+            "force_recheck": force_recheck,
+            "max_connections": max(1, max_connections // self.workers),
+            "max_half_open": max(1, max_half_open // self.workers),
+            "max_open_files": max(1, max_open_files // self.workers),
+            "max_peers": max_peers,
+        }
+        self.metrics_port = metrics_port
+        self.listen_port = listen_port
+        self.event_loop = event_loop
+        self.torrent_files: List[Torrent] = []
 
-                    if tracker_response.peers:
-                        logging.info("Got %d peers", len(tracker_response.peers))
-                        previous = current
-                        interval = tracker_response.interval
-                        self._empty_queue()
-                        for peer in tracker_response.peers:
-                            self.available_peers.put_nowait(peer)
+        # info hash -> index of the worker running the torrent
+        self.owners: Dict[bytes, int] = {}
+        self.processes: List[multiprocessing.Process] = []
+        self.channels: List[Channel] = []
+        self.listener: Optional[Listener] = None
+        self.port: Optional[int] = None
+        self.rates = (None, None)
+        self._metrics_runner = None
 
-            else:
-                logging.debug("sleeping...")
-                await asyncio.sleep(5)
+        self.loop = asyncio.get_event_loop()
 
-    def _empty_queue(self):
-        while not self.available_peers.empty():
-            self.available_peers.get_nowait()
+    def load_file(self, file):
+        if isinstance(file, Torrent):
+            self.torrent_files.append(file)
+        else:
+            self.torrent_files.append(Torrent(file))
 
-    def start(self):
-        assert len(self.torrent_files) == 1
+    async def start_workers(self):
+        context = multiprocessing.get_context("spawn")
+        for index in range(self.workers):
+            front, child = socket.socketpair()
+            process = context.Process(
+                target=_run_worker,
+                args=(child, self.options, self.port, self.event_loop, logging.getLogger().level),
+                name=f"pytorrent-worker-{index}",
+                daemon=True,
+            )
+            process.start()
+            child.close()
+
+            channel = Channel(front)
+            channel.start()
+            self.processes.append(process)
+            self.channels.append(channel)
+
+        self.set_rate_limits(*self.rates)
+
+    async def add_torrent(self, torrent: Torrent) -> int:
+        """
+        Start a torrent in the worker with the fewest, returns the index of the worker
+        """
+        if torrent.info_hash in self.owners:
+            return self.owners[torrent.info_hash]
+
+        counts = [0] * len(self.channels)
+        for index in self.owners.values():
+            counts[index] += 1
+        index = counts.index(min(counts))
+
+        self.owners[torrent.info_hash] = index
+        try:
+            await self.channels[index].call(
+                "add_torrent", metainfo=base64.b64encode(torrent.to_bytes()).decode()
+            )
+        except Exception:
+            del self.owners[torrent.info_hash]
+            raise
+
+        logging.info("Added torrent %s to worker %d", torrent.info_hash.hex(), index)
+        return index
+
+    async def remove_torrent(self, info_hash: bytes):
+        index = self.owners.pop(info_hash, None)
+        if index is not None:
+            await self.channels[index].call("remove_torrent", info_hash=info_hash.hex())
+
+    def set_rate_limits(self, download: Optional[float] = None, upload: Optional[float] = None):
+        """
+        Global limits in bytes per second, every worker gets an equal share
+        """
+        self.rates = (download, upload)
+        for channel in self.channels:
+            if not channel.closed:
+                channel.notify(
+                    "set_rate_limits",
+                    download=download / len(self.channels) if download else None,
+                    upload=upload / len(self.channels) if upload else None,
+                )
+
+    def accept(self, sock: socket.socket, handshake: Handshake) -> bool:
+        """
+        Pass an incoming connection on to the worker running its torrent
+        """
+        index = self.owners.get(handshake.info_hash)
+        if index is None or self.channels[index].closed:
+            return False
+
+        # the channel sends a duplicate of the descriptor, this process is done with it
+        self.channels[index].notify(
+            "accept", fds=[sock.fileno()], handshake=base64.b64encode(handshake.encode()).decode()
+        )
+        sock.close()
+        return True
+
+    async def stats(self) -> dict:
+        """
+        Snapshot of every worker and of the torrents of all of them
+        """
+        results = await asyncio.gather(*(channel.call("stats") for channel in self.channels))
+
+        workers = []
+        torrents = {}
+        for process, stats in zip(self.processes, results):
+            torrents.update(stats.pop("torrents"))
+            workers.append(dict(stats, pid=process.pid))
+
+        return {
+            "connections": sum(stats["connections"] for stats in workers),
+            "half_open": sum(stats["half_open"] for stats in workers),
+            "workers": workers,
+            "torrents": torrents,
+        }
+
+    async def prometheus(self) -> str:
+        """
+        The metrics of all workers in the Prometheus text format, labelled by worker
+        """
+        exports = await asyncio.gather(*(channel.call("metrics") for channel in self.channels))
+        return render_prometheus(merge_exports(exports, "worker"))
+
+    async def serve_metrics(self, port: int, host: str = "127.0.0.1"):
+        self._metrics_runner = await serve_metrics(self, host, port)
+        logging.info("Serving metrics on http://%s:%d/metrics", host, port)
+
+    async def listen(self, port: int = 0, host: str = "0.0.0.0"):
+        """
+        Accept incoming connections for all workers, must be called before `start_workers` so
+        they announce the port
+        """
+        self.listener = Listener(self.accept, host, port)
+        await self.listener.start()
+        self.port = self.listener.port
+
+    async def stop(self):
+        """
+        Stop accepting, let every worker save its torrents and wait for the processes to exit
+        """
+        if self.listener:
+            self.listener.close()
+        if self._metrics_runner:
+            await self._metrics_runner.cleanup()
+            self._metrics_runner = None
+
+        await asyncio.gather(
+            *(channel.call("stop") for channel in self.channels if not channel.closed),
+            return_exceptions=True,
+        )
+        for channel in self.channels:
+            channel.close()
+
+        for process in self.processes:
+            await self.loop.run_in_executor(None, process.join, ShardedManager.STOP_TIMEOUT)
+            if process.is_alive():
+                logging.warning("Worker %d did not stop, terminating it", process.pid)
+                process.terminate()
+
+        self.channels.clear()
+        self.processes.clear()
+        self.owners.clear()
+
+    async def run(self):
+        if self.listen_port is not None:
+            await self.listen(self.listen_port)
+        await self.start_workers()
+        if self.metrics_port:
+            await self.serve_metrics(self.metrics_port)
 
+        for torrent in self.torrent_files:
+            await self.add_torrent(torrent)
+
+    def start(self):
         self.loop.create_task(self.run())
         self.loop.run_forever()
 
 
-def main():
-    print("Start")
+def main(argv: Optional[List[str]] = None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv and argv[0] == "create":
+        create_torrent(argv[1:])
+        return
 
-    args = create_parser().parse_args()
+    print("Start")
 
-    manager = Manager()
-    with open(args.file, "rb") as f:
-        manager.load_file(Torrent(f))
+    args = create_parser().parse_args(argv)
 
     if args.verbose:
         logging.basicConfig(level=logging.INFO)
@@ -123,8 +666,42 @@ def main():
     if args.debug:
         logging.basicConfig(level=logging.DEBUG)
 
+    loop = new_event_loop(args.event_loop)
+    asyncio.set_event_loop(loop)
+
+    if args.workers > 1:
+        manager = ShardedManager(
+            args.workers,
+            args.output_dir,
+            args.preallocate,
+            args.resume_dir,
+            args.recheck,
+            metrics_port=args.metrics_port,
+            listen_port=args.listen_port,
+            event_loop=args.event_loop,
+        )
+    else:
+        manager = Manager(
+            args.output_dir,
+            args.preallocate,
+            args.resume_dir,
+            args.recheck,
+            metrics_port=args.metrics_port,
+            listen_port=args.listen_port,
+        )
+    manager.set_rate_limits(args.download_limit * 1024, args.upload_limit * 1024)
+    for file in args.files:
+        with open(file, "rb") as f:
+            manager.load_file(Torrent(f))
+
     def on_sigint(_sig_nb, _frame):
         print("Stopping the loop")
+        if isinstance(manager, ShardedManager):
+            # the workers are stopped over their channels, which needs the loop
+            stopping = loop.create_task(manager.stop())
+            stopping.add_done_callback(lambda _: loop.stop())
+            return
+
         manager.loop.stop()
         manager.stop()
 
@@ -1,3 +1,5 @@
-from .bcode import bencode, bdecode
+from .bcode import BDecodeError, bencode, bencode_into, bdecode
 from .torrent import Torrent, Tracker
-from .peer_connection import PeerConnection, PieceManager
+from .peer_connection import PeerConnection
+from .piece_manager import PieceManager
+from .create import make_torrent
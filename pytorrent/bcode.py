@@ -1,108 +1,214 @@
-from typing import Dict, Iterable, Union
-import string
+from typing import Dict, Iterable, Tuple, Union
 
 
-_digits_as_bytes = tuple(ord(x) for x in string.digits)
-
 BCodeType = Union[int, bytes, str, Dict[Union[str, bytes], "BCodeType"], Iterable["BCodeType"]]
 
+_INT = ord(b"i")
+_LIST = ord(b"l")
+_DICT = ord(b"d")
+_END = ord(b"e")
+_DIGITS = frozenset(range(ord(b"0"), ord(b"9") + 1))
 
-def _decode_int(data: bytes) -> BCodeType:
-    data_end = data.index(b"e")
-    return int(data[1:data_end].decode()), data[1 + data_end :]
 
+class BDecodeError(ValueError):
+    pass
 
-def _decode_string(data: bytes) -> BCodeType:
-    length_data = []
-    i = 0
 
-    while True:
-        c = data[i]
-        i += 1
+class BDict(dict):
+    """
+    dict returned by bdecode, `span` is the (start, end) slice of the input it was decoded from
+    """
 
-        if c == ord(b":"):
-            break
+    __slots__ = ("span",)
 
-        length_data.append(chr(c))
 
-    length = int("".join(length_data))
+class _Decoder:
+    def __init__(self, data, strict: bool, views: bool):
+        if not hasattr(data, "find"):
+            data = bytes(data)
 
-    return data[i : i + length], data[i + length :]
+        self.data = data
+        self.view = memoryview(data)
+        self.size = len(data)
+        self.strict = strict
+        self.views = views
 
+    def decode(self, pos: int) -> Tuple[BCodeType, int]:
+        if pos >= self.size:
+            raise BDecodeError(f"unexpected end of data at {pos}")
 
-def _decode_list(data: bytes) -> BCodeType:
-    results = []
+        c = self.view[pos]
+        if c == _INT:
+            return self._decode_int(pos)
+        elif c in _DIGITS:
+            return self._decode_string(pos)
+        elif c == _LIST:
+            return self._decode_list(pos)
+        elif c == _DICT:
+            return self._decode_dict(pos)
+        else:
+            raise BDecodeError(f"invalid token {chr(c)!r} at {pos}")
 
-    data = data[1:]
+    def _read_number(self, start: int, end: int) -> int:
+        raw = self.data[start:end]
+        digits = raw[1:] if raw.startswith(b"-") else raw
 
-    while True:
+        if not digits.isdigit():
+            raise BDecodeError(f"invalid number {bytes(raw)!r} at {start}")
 
-        value, data = _bdecode_impl(data)
+        if self.strict and digits.startswith(b"0") and raw != b"0":
+            raise BDecodeError(f"leading zero in number at {start}")
 
-        results.append(value)
+        return int(raw)
 
-        if data[0] == ord(b"e"):
-            break
+    def _decode_int(self, pos: int) -> Tuple[int, int]:
+        end = self.data.find(b"e", pos + 1)
+        if end == -1:
+            raise BDecodeError(f"unterminated integer at {pos}")
 
-    data = data[1:]
+        return self._read_number(pos + 1, end), end + 1
 
-    return (results, data)
+    def _decode_string(self, pos: int) -> Tuple[bytes, int]:
+        colon = self.data.find(b":", pos)
+        if colon == -1:
+            raise BDecodeError(f"unterminated string length at {pos}")
 
+        length = self._read_number(pos, colon)
+        if length < 0:
+            raise BDecodeError(f"negative string length at {pos}")
 
-def _decode_dict(data: bytes) -> BCodeType:
-    results_data = []
-    data = data[1:]
+        start = colon + 1
+        end = start + length
+        if end > self.size:
+            raise BDecodeError(f"string at {pos} runs past end of data")
 
-    while True:
+        if self.views:
+            return self.view[start:end], end
+        return self.view[start:end].tobytes(), end
 
-        key, data = _bdecode_impl(data)
-        value, data = _bdecode_impl(data)
+    def _decode_list(self, pos: int) -> Tuple[list, int]:
+        results = []
+        pos += 1
 
-        results_data.append((key, value))
+        while pos < self.size and self.view[pos] != _END:
+            value, pos = self.decode(pos)
+            results.append(value)
 
-        if data[0] == ord(b"e"):
-            break
+        if pos >= self.size:
+            raise BDecodeError("unterminated list")
 
-    data = data[1:]
+        return results, pos + 1
 
-    return dict(results_data), data
+    def _decode_dict(self, pos: int) -> Tuple[BDict, int]:
+        results = BDict()
+        start = pos
+        previous = None
+        pos += 1
 
+        while pos < self.size and self.view[pos] != _END:
+            if self.view[pos] not in _DIGITS:
+                raise BDecodeError(f"dict key at {pos} is not a string")
 
-def _bdecode_impl(data: bytes) -> BCodeType:
-    if data.startswith(b"i"):
-        return _decode_int(data)
-    elif data[0] in _digits_as_bytes:
-        return _decode_string(data)
-    elif data.startswith(b"l"):
-        return _decode_list(data)
-    elif data.startswith(b"d"):
-        return _decode_dict(data)
-    else:
-        raise NotImplementedError
+            key, pos = self._decode_string(pos)
+            if self.views:
+                key = key.tobytes()
 
+            if self.strict:
+                if previous is not None and key <= previous:
+                    raise BDecodeError(f"dict keys are not sorted at {pos}")
+                previous = key
 
-def bdecode(data: bytes) -> BCodeType:
-    return _bdecode_impl(data)[0]
+            results[key], pos = self.decode(pos)
 
+        if pos >= self.size:
+            raise BDecodeError("unterminated dict")
 
-def bencode(data: BCodeType) -> bytes:
+        results.span = (start, pos + 1)
+        return results, pos + 1
+
+
+def bdecode(data: bytes, strict: bool = False, views: bool = False) -> BCodeType:
+    """
+    Decode bencoded `data` (bytes, bytearray, memoryview or mmap) in a single pass.
+
+    With `views` string values are returned as memoryviews into `data` instead of copies.
+    With `strict` non-canonical input (leading zeros, unsorted keys, trailing data) is rejected.
+    Every decoded dict is a `BDict` carrying the byte span it occupied in `data`.
+    """
+    decoder = _Decoder(data, strict, views)
+    value, end = decoder.decode(0)
+
+    if strict and end != decoder.size:
+        raise BDecodeError(f"trailing data after position {end}")
+
+    return value
+
+
+def _encode(data: BCodeType, write) -> None:
     if isinstance(data, int):
-        return f"i{data}e".encode()
-    elif isinstance(data, (bytes, str)):
-        if isinstance(data, bytes):
-            return str(len(data)).encode() + b":" + data
-        return f"{len(data)}:{data}".encode()
+        write(b"i%de" % data)
+    elif isinstance(data, (bytes, bytearray, memoryview)):
+        write(b"%d:" % len(data))
+        write(data)
+    elif isinstance(data, str):
+        data = data.encode()
+        write(b"%d:" % len(data))
+        write(data)
     elif isinstance(data, (list, tuple)):
-        encoded = b""
+        write(b"l")
         for value in data:
-            encoded += bencode(value)
-
-        return b"l" + encoded + b"e"
+            _encode(value, write)
+        write(b"e")
     elif isinstance(data, dict):
-        encoded = b""
-        for key, value in data.items():
-            encoded += bencode(key) + bencode(value)
+        items = sorted(((_encode_key(key), value) for key, value in data.items()), key=_first)
+
+        write(b"d")
+        previous = None
+        for key, value in items:
+            if key == previous:
+                raise ValueError(f"duplicate dict key {key!r}")
+            previous = key
+
+            write(b"%d:" % len(key))
+            write(key)
+            _encode(value, write)
+        write(b"e")
+    else:
+        raise ValueError(f"cannot bencode {type(data).__name__}")
+
+
+def _first(item):
+    return item[0]
+
+
+def _encode_key(key: Union[str, bytes]) -> bytes:
+    if isinstance(key, str):
+        return key.encode()
+    if isinstance(key, (bytes, bytearray, memoryview)):
+        return bytes(key)
+    raise ValueError(f"dict keys must be strings, got {type(key).__name__}")
+
 
-        return b"d" + encoded + b"e"
+def bencode_into(data: BCodeType, out) -> None:
+    """
+    Encode `data` in canonical form (sorted dict keys) straight into `out`.
+
+    `out` can be a bytearray, any object with `write` (files, sockets, io.BytesIO) or a
+    hashlib object, so large values are passed through without intermediate copies.
+    """
+    if isinstance(out, bytearray):
+        write = out.extend
+    elif hasattr(out, "write"):
+        write = out.write
+    elif hasattr(out, "update"):
+        write = out.update
     else:
-        raise ValueError
+        raise ValueError(f"cannot write bencoded data into {type(out).__name__}")
+
+    _encode(data, write)
+
+
+def bencode(data: BCodeType) -> bytes:
+    out = bytearray()
+    _encode(data, out.extend)
+    return bytes(out)
@@ -0,0 +1,187 @@
+import asyncio
+import contextlib
+import weakref
+from collections import deque
+from typing import Deque, Dict, Hashable, Optional, Tuple
+
+from .ratelimit import TokenBucket
+
+
+class ResourceBudget:
+    """
+    Global pool of slots (connections, half-open connects, ...) shared between torrents.
+
+    Slots are handed out right away while nobody is waiting. Once the pool is exhausted a freed
+    slot goes to the waiting owner that currently holds the fewest, so every torrent converges
+    to its fair share no matter how many slots it asks for. Slots are not taken back, owners
+    holding more than their share while others wait give up the `excess` themselves.
+    """
+
+    def __init__(self, limit: Optional[int] = None):
+        self.limit = limit
+        self.used = 0
+
+        self._owners: Dict[Hashable, int] = {}
+        # only owners with waiters have an entry
+        self._waiters: Dict[Hashable, Deque[asyncio.Future]] = {}
+
+    @property
+    def fair_share(self) -> Optional[int]:
+        if self.limit is None:
+            return None
+        return max(1, self.limit // max(1, len(self._owners)))
+
+    @property
+    def full(self) -> bool:
+        """
+        Whether `acquire` would have to wait
+        """
+        return self.limit is not None and (self.used >= self.limit or bool(self._waiters))
+
+    def in_use(self, owner: Hashable) -> int:
+        return self._owners.get(owner, 0)
+
+    def excess(self, owner: Hashable) -> int:
+        """
+        How many slots `owner` holds beyond its fair share while other owners wait for one
+        """
+        if self.limit is None or not any(other != owner for other in self._waiters):
+            return 0
+        return max(0, self.in_use(owner) - self.fair_share)
+
+    def register(self, owner: Hashable):
+        self._owners.setdefault(owner, 0)
+
+    def unregister(self, owner: Hashable):
+        for waiter in self._waiters.pop(owner, ()):
+            waiter.cancel()
+
+        self.used -= self._owners.pop(owner, 0)
+        self._wake()
+
+    async def acquire(self, owner: Hashable):
+        if self.limit is None or (self.used < self.limit and not self._waiters):
+            self._take(owner)
+            return
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(owner, deque()).append(waiter)
+
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # the slot was handed over just before the cancellation
+                self.release(owner)
+            else:
+                # `_wake` may have dropped the cancelled waiter already, `unregister` the owner
+                waiters = self._waiters.get(owner, ())
+                if waiter in waiters:
+                    waiters.remove(waiter)
+                    if not waiters:
+                        del self._waiters[owner]
+            raise
+
+    def release(self, owner: Hashable):
+        if owner in self._owners and self._owners[owner] > 0:
+            self._owners[owner] -= 1
+            self.used -= 1
+        self._wake()
+
+    @contextlib.asynccontextmanager
+    async def slot(self, owner: Hashable):
+        await self.acquire(owner)
+        try:
+            yield
+        finally:
+            self.release(owner)
+
+    def _take(self, owner: Hashable):
+        self._owners[owner] = self._owners.get(owner, 0) + 1
+        self.used += 1
+
+    def _wake(self):
+        while self._waiters and (self.limit is None or self.used < self.limit):
+            owner = min(self._waiters, key=self.in_use)
+            waiters = self._waiters[owner]
+            waiter = waiters.popleft()
+            if not waiters:
+                del self._waiters[owner]
+            if not waiter.done():
+                self._take(owner)
+                waiter.set_result(None)
+
+
+class SessionLimits:
+    """
+    The global budgets as seen by one torrent session, plus the bandwidth limits of the torrent
+    and of each of its peers, nested in the global ones
+    """
+
+    def __init__(
+        self,
+        owner: Hashable,
+        connections: Optional[ResourceBudget] = None,
+        half_open: Optional[ResourceBudget] = None,
+        download: Optional[TokenBucket] = None,
+        upload: Optional[TokenBucket] = None,
+    ):
+        self.owner = owner
+        self.connections = connections or ResourceBudget()
+        self.half_open = half_open or ResourceBudget()
+
+        self.connections.register(owner)
+        self.half_open.register(owner)
+
+        self.download = TokenBucket(parent=download)
+        self.upload = TokenBucket(parent=upload)
+        self.peer_download_rate: Optional[float] = None
+        self.peer_upload_rate: Optional[float] = None
+        self._peer_buckets: "weakref.WeakSet[TokenBucket]" = weakref.WeakSet()
+        self._peer_upload_buckets: "weakref.WeakSet[TokenBucket]" = weakref.WeakSet()
+
+    def connection(self):
+        return self.connections.slot(self.owner)
+
+    def excess_connections(self) -> int:
+        """
+        Connections to give up so the other torrents get their share
+        """
+        return self.connections.excess(self.owner)
+
+    def connecting(self):
+        return self.half_open.slot(self.owner)
+
+    def peer_buckets(self) -> Tuple[TokenBucket, TokenBucket]:
+        """
+        Download and upload limits for a new connection
+        """
+        download = TokenBucket(self.peer_download_rate, self.download)
+        upload = TokenBucket(self.peer_upload_rate, self.upload)
+        self._peer_buckets.add(download)
+        self._peer_upload_buckets.add(upload)
+        return download, upload
+
+    def set_rates(
+        self,
+        download: Optional[float] = None,
+        upload: Optional[float] = None,
+        peer_download: Optional[float] = None,
+        peer_upload: Optional[float] = None,
+    ):
+        """
+        Change the torrent and per peer limits in bytes per second, also of live connections
+        """
+        self.download.set_rate(download)
+        self.upload.set_rate(upload)
+
+        self.peer_download_rate = peer_download
+        self.peer_upload_rate = peer_upload
+        for bucket in self._peer_buckets:
+            bucket.set_rate(peer_download)
+        for bucket in self._peer_upload_buckets:
+            bucket.set_rate(peer_upload)
+
+    def close(self):
+        self.connections.unregister(self.owner)
+        self.half_open.unregister(self.owner)
@@ -0,0 +1,144 @@
+import asyncio
+import logging
+import math
+import random
+import time
+from typing import List, Optional
+
+
+class RateMeter:
+    """
+    Rolling transfer rate in bytes per second, an exponential average over about `WINDOW`
+    seconds that is folded at most once per `TICK`
+    """
+
+    __slots__ = ("total", "_rate", "_bytes", "_last")
+
+    TICK = 1.0
+    WINDOW = 20.0
+
+    def __init__(self):
+        self.total = 0
+        self._rate = 0.0
+        self._bytes = 0
+        self._last: Optional[float] = None
+
+    def add(self, nbytes: int, now: Optional[float] = None):
+        now = time.monotonic() if now is None else now
+        self._update(now)
+        self._bytes += nbytes
+        self.total += nbytes
+
+    def rate(self, now: Optional[float] = None) -> float:
+        self._update(time.monotonic() if now is None else now)
+        return self._rate
+
+    def _update(self, now: float):
+        if self._last is None:
+            self._last = now
+            return
+
+        elapsed = now - self._last
+        if elapsed < RateMeter.TICK:
+            return
+
+        weight = math.exp(-elapsed / RateMeter.WINDOW)
+        self._rate = self._rate * weight + self._bytes / elapsed * (1 - weight)
+        self._bytes = 0
+        self._last = now
+
+
+class Choker:
+    """
+    Decides which interested peers of a torrent may download from us.
+
+    Every `INTERVAL` the `slots` peers that gave us the most data recently are unchoked
+    (tit-for-tat), once the torrent is complete it is the peers we upload to fastest instead.
+    One more optimistic slot goes to a random other interested peer and rotates every
+    `OPTIMISTIC_INTERVAL`, newly connected peers being three times as likely to get it so they
+    can get started. Free slots are given out right away when a peer becomes interested.
+    """
+
+    INTERVAL = 10.0
+    OPTIMISTIC_INTERVAL = 30.0
+    SLOTS = 4
+    NEW_PEER_AGE = 60.0
+
+    def __init__(self, pool, piece_manager, slots: int = SLOTS):
+        self.pool = pool
+        self.piece_manager = piece_manager
+        self.slots = slots
+
+        self.optimistic = None
+        self._optimistic_since = 0.0
+
+    @property
+    def seeding(self) -> bool:
+        return self.piece_manager.complete
+
+    def peers(self) -> List:
+        return list(self.pool.connections.values())
+
+    def interested(self, peer):
+        """
+        Called when `peer` starts being interested, fill a free slot without waiting
+        """
+        unchoked = sum(1 for other in self.peers() if not other.am_choking)
+        if peer.am_choking and unchoked < self.slots + 1:
+            peer.unchoke()
+
+    def rechoke(self, now: Optional[float] = None):
+        now = time.monotonic() if now is None else now
+        peers = self.peers()
+        interested = [peer for peer in peers if peer.peer_interested]
+
+        seeding = self.seeding
+        interested.sort(key=lambda peer: self._rate(peer, seeding, now), reverse=True)
+        unchoke = set(interested[: self.slots])
+
+        candidates = [peer for peer in interested if peer not in unchoke]
+        if (
+            self.optimistic not in candidates
+            or now - self._optimistic_since >= Choker.OPTIMISTIC_INTERVAL
+        ):
+            self.optimistic = self._pick_optimistic(candidates, now)
+            self._optimistic_since = now
+        if self.optimistic is not None:
+            unchoke.add(self.optimistic)
+
+        for peer in peers:
+            if peer in unchoke:
+                peer.unchoke()
+            else:
+                peer.choke()
+
+        logging.debug(
+            "Unchoked %d of %d interested peers, optimistic %s",
+            len(unchoke),
+            len(interested),
+            self.optimistic,
+        )
+
+    @staticmethod
+    def _rate(peer, seeding: bool, now: float) -> float:
+        # a seed has nothing to reciprocate, it serves the peers that take data fastest
+        if seeding:
+            return peer.upload_rate.rate(now)
+        return peer.download_rate.rate(now)
+
+    def _pick_optimistic(self, candidates: List, now: float):
+        if not candidates:
+            return None
+
+        weights = [
+            3
+            if peer.connected_at is not None and now - peer.connected_at < Choker.NEW_PEER_AGE
+            else 1
+            for peer in candidates
+        ]
+        return random.choices(candidates, weights)[0]
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(Choker.INTERVAL)
+            self.rechoke()
@@ -0,0 +1,143 @@
+import os
+import pathlib
+import time
+from typing import Callable, List, Optional, Sequence, Tuple, Union
+
+from .bcode import bencode
+from .storage import Storage
+from .verify import hash_storage
+
+Trackers = Sequence[Union[str, Sequence[str]]]
+
+MIN_PIECE_LENGTH = 16 * 1024
+MAX_PIECE_LENGTH = 16 * 1024 * 1024
+# enough pieces to spread a download over many peers, few enough to keep the metainfo small
+TARGET_PIECES = 1500
+
+
+def piece_length_for(total_length: int) -> int:
+    """
+    The smallest power of two piece length that keeps the piece count near `TARGET_PIECES`
+    """
+    piece_length = MIN_PIECE_LENGTH
+    while piece_length < MAX_PIECE_LENGTH and total_length > piece_length * TARGET_PIECES:
+        piece_length *= 2
+    return piece_length
+
+
+def find_files(path: Union[str, pathlib.Path]) -> List[Tuple[pathlib.Path, List[bytes]]]:
+    """
+    Every regular file under `path` with its path components relative to it, in a stable order.
+    A single file is returned with no components.
+    """
+    path = pathlib.Path(path)
+    if path.is_file():
+        return [(path, [])]
+    if not path.is_dir():
+        raise FileNotFoundError(f"{path} is neither a file nor a directory")
+
+    files = []
+    for directory, directories, names in os.walk(path):
+        directories.sort()
+        for name in sorted(names):
+            file = pathlib.Path(directory, name)
+            if file.is_file():
+                relative = file.relative_to(path)
+                files.append((file, [os.fsencode(part) for part in relative.parts]))
+
+    # sorted by components so the order does not depend on the walk
+    files.sort(key=lambda entry: entry[1])
+    return files
+
+
+def hash_pieces(
+    storage: Storage,
+    workers: Optional[int] = None,
+    progress: Optional[Callable[[int, int], None]] = None,
+) -> bytes:
+    """
+    The concatenated SHA-1 digests of every piece of `storage`, hashed in parallel
+    """
+    digests = hash_storage(
+        storage, workers=workers, progress=progress, thread_name_prefix="pytorrent-create"
+    )
+    if None in digests:
+        raise OSError(f"Unable to read piece {digests.index(None)}")
+    return b"".join(digests)
+
+
+def make_torrent(
+    path: Union[str, pathlib.Path],
+    trackers: Trackers = (),
+    piece_length: Optional[int] = None,
+    name: Optional[str] = None,
+    private: bool = False,
+    comment: Optional[str] = None,
+    created_by: Optional[str] = "pytorrent",
+    creation_date: Optional[int] = None,
+    web_seeds: Sequence[str] = (),
+    workers: Optional[int] = None,
+    progress: Optional[Callable[[int, int], None]] = None,
+) -> bytes:
+    """
+    Create the metainfo of a file or a directory, bencoded in canonical form.
+
+    `trackers` are announce URLs, or lists of them to form tiers (BEP 12). The piece length is
+    chosen from the total size unless given, it must be a power of two of at least 16 KiB.
+    `creation_date` defaults to now, 0 leaves it out.
+    """
+    path = pathlib.Path(path)
+    files = find_files(path)
+    lengths = [file.stat().st_size for file, _ in files]
+    total_length = sum(lengths)
+    if not total_length:
+        raise ValueError(f"{path} has no data to share")
+
+    piece_length = piece_length or piece_length_for(total_length)
+    if piece_length < MIN_PIECE_LENGTH or piece_length & (piece_length - 1):
+        raise ValueError(f"Invalid piece length {piece_length}")
+
+    storage = Storage(
+        [(file, length) for (file, _), length in zip(files, lengths)],
+        piece_length,
+        readonly=True,
+    )
+    try:
+        pieces = hash_pieces(storage, workers, progress)
+    finally:
+        storage.close()
+
+    info = {
+        "name": name.encode() if name else os.fsencode(path.resolve().name),
+        "piece length": piece_length,
+        "pieces": pieces,
+    }
+    if path.is_file():
+        info["length"] = total_length
+    else:
+        info["files"] = [
+            {"length": length, "path": components}
+            for (_, components), length in zip(files, lengths)
+        ]
+    if private:
+        info["private"] = 1
+
+    metainfo = {"info": info}
+    tiers = [[tracker] if isinstance(tracker, str) else list(tracker) for tracker in trackers]
+    tiers = [tier for tier in tiers if tier]
+    if tiers:
+        metainfo["announce"] = tiers[0][0]
+    if sum(map(len, tiers)) > 1:
+        metainfo["announce-list"] = tiers
+    if comment:
+        metainfo["comment"] = comment
+    if created_by:
+        metainfo["created by"] = created_by
+    if creation_date is None:
+        creation_date = int(time.time())
+    if creation_date:
+        metainfo["creation date"] = creation_date
+    if web_seeds:
+        metainfo["url-list"] = list(web_seeds)
+
+    return bencode(metainfo)
@@ -0,0 +1,198 @@
+import asyncio
+import itertools
+import json
+import logging
+import os
+import socket
+import struct
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Sequence, Tuple
+
+# <length of the JSON body><number of file descriptors attached>
+_FRAME = struct.Struct(">IB")
+
+# called with the method, its arguments and the file descriptors that came with the message
+Handler = Callable[[str, dict, List[int]], Awaitable[Any]]
+
+
+class RemoteError(Exception):
+    """
+    The handler on the other side of a `Channel` failed
+    """
+
+
+class Channel:
+    """
+    JSON messages in both directions over a connected Unix stream socket, e.g. one end of a
+    `socketpair` shared with a worker process.
+
+    `call` waits for the result of the handler on the other side, `notify` does not expect one.
+    File descriptors such as accepted peer sockets can be attached to a message (SCM_RIGHTS),
+    they are duplicated when queued so the sender may close its copy right away, and arrive as
+    the `fds` of the handler, which owns them.
+    """
+
+    MAX_FDS = 16
+    READ_SIZE = 64 * 1024
+
+    def __init__(self, sock: socket.socket, handler: Optional[Handler] = None):
+        self.socket = sock
+        self.handler = handler
+        self.closed = False
+
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._ids = itertools.count(1)
+        self._pending: Dict[int, asyncio.Future] = {}
+        self._buffer = bytearray()
+        self._fds: Deque[int] = deque()
+        self._outgoing: Deque[Tuple[bytes, List[int]]] = deque()
+        self._writing = False
+        self._lost = asyncio.Event()
+
+        sock.setblocking(False)
+
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._loop.add_reader(self.socket.fileno(), self._read)
+
+    async def call(self, method: str, fds: Sequence[int] = (), **args) -> Any:
+        if self.closed:
+            raise ConnectionResetError("Channel is closed")
+
+        message_id = next(self._ids)
+        future = self._loop.create_future()
+        self._pending[message_id] = future
+        self._send({"id": message_id, "method": method, "args": args}, fds)
+        return await future
+
+    def notify(self, method: str, fds: Sequence[int] = (), **args):
+        if self.closed:
+            raise ConnectionResetError("Channel is closed")
+        self._send({"id": None, "method": method, "args": args}, fds)
+
+    async def wait_closed(self):
+        await self._lost.wait()
+
+    def close(self):
+        if self.closed:
+            return
+
+        self.closed = True
+        if self._loop is not None:
+            self._loop.remove_reader(self.socket.fileno())
+            if self._writing:
+                self._loop.remove_writer(self.socket.fileno())
+        self.socket.close()
+
+        for future in self._pending.values():
+            if not future.done():
+                future.set_exception(ConnectionResetError("Channel closed"))
+        self._pending.clear()
+        for _, fds in self._outgoing:
+            _close_all(fds)
+        self._outgoing.clear()
+        _close_all(self._fds)
+        self._fds.clear()
+        self._lost.set()
+
+    # reading
+
+    def _read(self):
+        try:
+            data, fds, _, _ = socket.recv_fds(self.socket, Channel.READ_SIZE, Channel.MAX_FDS)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            logging.debug("Channel lost: %s", e)
+            self.close()
+            return
+
+        self._fds.extend(fds)
+        if not data:
+            self.close()
+            return
+
+        self._buffer += data
+        while len(self._buffer) >= _FRAME.size:
+            length, count = _FRAME.unpack_from(self._buffer)
+            end = _FRAME.size + length
+            if len(self._buffer) < end:
+                break
+
+            message = json.loads(self._buffer[_FRAME.size : end])
+            del self._buffer[:end]
+            fds = [self._fds.popleft() for _ in range(min(count, len(self._fds)))]
+            self._dispatch(message, fds)
+
+    def _dispatch(self, message: dict, fds: List[int]):
+        if "method" in message:
+            self._loop.create_task(self._handle(message, fds))
+            return
+
+        future = self._pending.pop(message["id"], None)
+        if future is None or future.done():
+            return
+        if "error" in message:
+            future.set_exception(RemoteError(message["error"]))
+        else:
+            future.set_result(message.get("result"))
+
+    async def _handle(self, message: dict, fds: List[int]):
+        if self.handler is None:
+            _close_all(fds)
+            reply = {"error": "No handler"}
+        else:
+            try:
+                reply = {"result": await self.handler(message["method"], message["args"], fds)}
+            except Exception as e:
+                logging.exception("Handling %s failed", message["method"])
+                reply = {"error": f"{type(e).__name__}: {e}"}
+
+        if message["id"] is not None and not self.closed:
+            reply["id"] = message["id"]
+            self._send(reply)
+
+    # writing
+
+    def _send(self, message: dict, fds: Sequence[int] = ()):
+        body = json.dumps(message).encode()
+        self._outgoing.append((_FRAME.pack(len(body), len(fds)) + body, [os.dup(fd) for fd in fds]))
+        self._write()
+
+    def _write(self):
+        while self._outgoing:
+            data, fds = self._outgoing[0]
+            try:
+                if fds:
+                    sent = socket.send_fds(self.socket, [data], fds)
+                else:
+                    sent = self.socket.send(data)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError as e:
+                logging.debug("Channel lost: %s", e)
+                self.close()
+                return
+
+            # the descriptors travel with the first byte, the kernel holds them from here on
+            _close_all(fds)
+            if sent < len(data):
+                self._outgoing[0] = (data[sent:], [])
+            else:
+                self._outgoing.popleft()
+
+        writing = bool(self._outgoing)
+        if writing != self._writing and self._loop is not None:
+            if writing:
+                self._loop.add_writer(self.socket.fileno(), self._write)
+            else:
+                self._loop.remove_writer(self.socket.fileno())
+            self._writing = writing
+
+
+def _close_all(fds):
+    for fd in fds:
+        try:
+            os.close(fd)
+        except OSError:
+            pass
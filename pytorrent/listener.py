@@ -0,0 +1,105 @@
+import asyncio
+import logging
+import socket
+from typing import Callable, Optional, Set
+
+from .peer_connection import Handshake
+
+# called with an accepted socket and its handshake, False has the connection closed
+HandshakeHandler = Callable[[socket.socket, Handshake], bool]
+
+
+class Listener:
+    """
+    Accepts incoming peer connections for every torrent on one port.
+
+    Only the handshake is read here, exactly `Handshake.length` bytes so nothing the peer sends
+    after it is lost, then the socket is handed to `on_handshake`, which finds the torrent by its
+    info hash. The handler owns the socket from then on unless it returns False.
+    """
+
+    HANDSHAKE_TIMEOUT = 10.0
+    BACKLOG = 128
+
+    def __init__(self, on_handshake: HandshakeHandler, host: str = "0.0.0.0", port: int = 0):
+        self.on_handshake = on_handshake
+        self.host = host
+        self.port = port
+
+        self.socket: Optional[socket.socket] = None
+        self.accepted = 0
+        self._accepting: Optional[asyncio.Task] = None
+        self._handshakes: Set[asyncio.Task] = set()
+
+    async def start(self):
+        family = socket.AF_INET6 if ":" in self.host else socket.AF_INET
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind((self.host, self.port))
+            sock.listen(Listener.BACKLOG)
+            sock.setblocking(False)
+        except OSError:
+            sock.close()
+            raise
+
+        self.socket = sock
+        self.port = sock.getsockname()[1]
+        self._accepting = asyncio.get_running_loop().create_task(self._accept())
+        logging.info("Listening for peers on %s:%d", self.host, self.port)
+
+    def close(self):
+        for task in (self._accepting, *self._handshakes):
+            if task:
+                task.cancel()
+        if self.socket:
+            self.socket.close()
+            self.socket = None
+
+    async def _accept(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                sock, _ = await loop.sock_accept(self.socket)
+            except OSError as e:
+                # e.g. out of file descriptors, the backlog keeps the peer until there is room
+                logging.warning("Unable to accept a connection: %s", e)
+                await asyncio.sleep(1)
+                continue
+
+            sock.setblocking(False)
+            task = loop.create_task(self._handshake(sock))
+            self._handshakes.add(task)
+            task.add_done_callback(self._handshakes.discard)
+
+    async def _handshake(self, sock: socket.socket):
+        try:
+            data = await asyncio.wait_for(
+                _receive(sock, Handshake.length), Listener.HANDSHAKE_TIMEOUT
+            )
+        except (OSError, asyncio.TimeoutError):
+            sock.close()
+            return
+        except asyncio.CancelledError:
+            sock.close()
+            raise
+
+        handshake = Handshake.decode(data)
+        if handshake is None or not self.on_handshake(sock, handshake):
+            sock.close()
+            return
+
+        self.accepted += 1
+
+
+async def _receive(sock: socket.socket, nbytes: int) -> bytes:
+    loop = asyncio.get_running_loop()
+    data = bytearray(nbytes)
+    view = memoryview(data)
+    received = 0
+    while received < nbytes:
+        count = await loop.sock_recv_into(sock, view[received:])
+        if not count:
+            raise ConnectionResetError("Connection closed during the handshake")
+        received += count
+    return bytes(data)
@@ -0,0 +1,355 @@
+import bisect
+import hashlib
+from typing import Dict, List, Optional, Sequence, Tuple
+
+# leaves of the v2 hash trees are the SHA-256 digests of 16 KiB blocks (BEP 52)
+BLOCK_SIZE = 16 * 1024
+HASH_SIZE = 32
+# hashes served per request, also the widest piece (8 MiB) whose leaves we ask peers for
+MAX_HASHES = 512
+
+# roots of all-zero subtrees by height, leaves past the end of a file are zero
+_PADS = [bytes(HASH_SIZE)]
+for _ in range(64):
+    _PADS.append(hashlib.sha256(_PADS[-1] * 2).digest())
+
+HashRange = Tuple[bytes, int, int, int, int]
+
+
+def _width(count: int) -> int:
+    """
+    The smallest power of two that is at least `count`
+    """
+    return 1 << max(count - 1, 0).bit_length()
+
+
+def _height(width: int) -> int:
+    return width.bit_length() - 1
+
+
+def block_hashes(data) -> List[bytes]:
+    """
+    The leaf hashes of a range of file data, the last block may be short
+    """
+    view = memoryview(data)
+    return [
+        hashlib.sha256(view[begin : begin + BLOCK_SIZE]).digest()
+        for begin in range(0, len(view), BLOCK_SIZE)
+    ]
+
+
+def merkle_layers(hashes: Sequence[bytes], width: int, height: int = 0) -> List[List[bytes]]:
+    """
+    Every layer of the tree over `hashes` padded to `width` nodes, from `hashes` up to the root.
+    Padding nodes are not stored, a layer is only as long as its last real node. `height` is the
+    layer `hashes` are at, for the right padding.
+    """
+    layers = [list(hashes)]
+    while width > 1:
+        layer = layers[-1]
+        if len(layer) % 2:
+            layer = layer + [_PADS[height]]
+        layers.append(
+            [hashlib.sha256(layer[i] + layer[i + 1]).digest() for i in range(0, len(layer), 2)]
+        )
+        width //= 2
+        height += 1
+    return layers
+
+
+def merkle_root(hashes: Sequence[bytes], width: int, height: int = 0) -> bytes:
+    if not hashes:
+        return _PADS[height + _height(width)]
+    return merkle_layers(hashes, width, height)[-1][0]
+
+
+class FileHashes:
+    """
+    The hash tree of one file of a v2 torrent.
+
+    The piece layer comes from the metainfo and is checked against `pieces_root`. Leaf hashes of
+    single pieces are learned from peers (`hashes` messages) and checked against the piece
+    layer, they let blocks be verified as they arrive.
+    """
+
+    def __init__(
+        self,
+        pieces_root: bytes,
+        length: int,
+        piece_length: int,
+        first_piece: int,
+        piece_layer: Optional[bytes] = None,
+    ):
+        self.pieces_root = pieces_root
+        self.length = length
+        self.piece_length = piece_length
+        self.first_piece = first_piece
+        self.piece_count = -(-length // piece_length)
+
+        blocks = -(-length // BLOCK_SIZE)
+        if self.piece_count == 1:
+            # the tree of a file of one piece is only as wide as its blocks
+            self.piece_width = _width(blocks)
+            self.piece_layer = [pieces_root]
+        else:
+            self.piece_width = piece_length // BLOCK_SIZE
+            if piece_layer is None or len(piece_layer) != self.piece_count * HASH_SIZE:
+                raise ValueError("Missing or invalid piece layer")
+            self.piece_layer = [
+                bytes(piece_layer[i : i + HASH_SIZE])
+                for i in range(0, len(piece_layer), HASH_SIZE)
+            ]
+            if merkle_root(self.piece_layer, _width(self.piece_count), self.piece_height) != (
+                pieces_root
+            ):
+                raise ValueError("Piece layer does not match its pieces root")
+
+        self.height = self.piece_height + _height(_width(self.piece_count))
+        # piece in the file -> its verified leaf hashes
+        self.leaves: Dict[int, List[bytes]] = {}
+        self._upper: Optional[List[List[bytes]]] = None
+
+    @property
+    def piece_height(self) -> int:
+        return _height(self.piece_width)
+
+    def piece_size(self, piece: int) -> int:
+        """
+        Bytes of the file in one of its pieces, the rest of the last piece is padding
+        """
+        return min(self.piece_length, self.length - piece * self.piece_length)
+
+    def hash_piece(self, piece: int, data) -> bytes:
+        return merkle_root(
+            block_hashes(memoryview(data)[: self.piece_size(piece)]), self.piece_width
+        )
+
+    def known_leaves(self, piece: int) -> Optional[List[bytes]]:
+        if self.piece_width == 1:
+            return self.piece_layer[piece : piece + 1]
+        return self.leaves.get(piece)
+
+    def verify_block(self, piece: int, begin: int, data) -> Optional[bool]:
+        """
+        Check a block against its leaf hash, None while the leaf hashes of the piece are unknown
+        or for blocks that are not 16 KiB aligned
+        """
+        leaves = self.known_leaves(piece)
+        if leaves is None or begin % BLOCK_SIZE or not 0 <= begin < self.piece_length:
+            return None
+        if len(data) > BLOCK_SIZE:
+            return None
+
+        # the padding after the end of a file is all zeros
+        data = memoryview(data)
+        size = max(self.piece_size(piece) - begin, 0)
+        padding = data[size:]
+        if padding != bytes(len(padding)):
+            return False
+        return not size or hashlib.sha256(data[:size]).digest() == leaves[begin // BLOCK_SIZE]
+
+    def add_hashes(self, base_layer: int, index: int, length: int, hashes: List[bytes]) -> bool:
+        """
+        Check hashes from a peer, the leaves are kept when they cover whole pieces of the file.
+        Ranges narrower than a piece are checked through their uncle hashes.
+        """
+        if not _valid_range(base_layer, index, length, self.height) or len(hashes) < length:
+            return False
+
+        nodes, proof = hashes[:length], hashes[length:]
+        height = base_layer + _height(length)
+        if base_layer >= self.piece_height:
+            # the layers above the pieces are all known
+            return all(
+                node == self._node(base_layer, index + offset) for offset, node in enumerate(nodes)
+            )
+
+        if height < self.piece_height:
+            node = merkle_root(nodes, length, base_layer)
+            position = index >> _height(length)
+            for uncle in proof[: self.piece_height - height]:
+                pair = uncle + node if position % 2 else node + uncle
+                node = hashlib.sha256(pair).digest()
+                position //= 2
+                height += 1
+            return height == self.piece_height and self._node(height, position) == node
+
+        width = self.piece_width >> base_layer
+        for offset in range(0, length, width):
+            node = merkle_root(nodes[offset : offset + width], width, base_layer)
+            if self._node(self.piece_height, (index + offset) // width) != node:
+                return False
+
+        if base_layer == 0:
+            for offset in range(0, length, width):
+                piece = (index + offset) // width
+                if piece < self.piece_count:
+                    self.leaves[piece] = list(nodes[offset : offset + width])
+        return True
+
+    def serve(
+        self,
+        base_layer: int,
+        index: int,
+        length: int,
+        proof_layers: int,
+        leaves: Optional[Dict[int, List[bytes]]] = None,
+    ) -> Optional[List[bytes]]:
+        """
+        The hashes and uncle hashes to answer a hash request with, None if we do not know them.
+        `leaves` adds the leaf hashes of pieces, e.g. hashed from the data on disk. Layers below
+        the pieces are hashed from the leaves, so this belongs off the event loop.
+        """
+        if not _valid_range(base_layer, index, length, self.height) or length > MAX_HASHES:
+            return None
+
+        # the trees of the pieces below the piece layer, each built once for the whole request
+        trees: Dict[int, List[List[bytes]]] = {}
+        hashes = []
+        for position in range(index, index + length):
+            node = self._node(base_layer, position, leaves, trees)
+            if node is None:
+                return None
+            hashes.append(node)
+
+        height = base_layer + _height(length)
+        position = index >> _height(length)
+        for _ in range(proof_layers):
+            if height >= self.height:
+                break
+            node = self._node(height, position ^ 1, leaves, trees)
+            if node is None:
+                return None
+            hashes.append(node)
+            height += 1
+            position //= 2
+
+        return hashes
+
+    def piece_leaves(self, piece: int, data) -> Optional[List[bytes]]:
+        """
+        The leaf hashes of a piece from its data, None if they do not match the piece layer
+        """
+        leaves = block_hashes(memoryview(data)[: self.piece_size(piece)])
+        if merkle_root(leaves, self.piece_width) != self.piece_layer[piece]:
+            return None
+        return leaves + [_PADS[0]] * (self.piece_width - len(leaves))
+
+    def _node(
+        self,
+        height: int,
+        position: int,
+        leaves: Optional[Dict[int, List[bytes]]] = None,
+        trees: Optional[Dict[int, List[List[bytes]]]] = None,
+    ) -> Optional[bytes]:
+        if height >= self.piece_height:
+            if self._upper is None:
+                self._upper = merkle_layers(
+                    self.piece_layer, _width(self.piece_count), self.piece_height
+                )
+            layer = self._upper[height - self.piece_height]
+            return layer[position] if position < len(layer) else _PADS[height]
+
+        shift = self.piece_height - height
+        piece = position >> shift
+        if piece >= self.piece_count:
+            return _PADS[height]
+        tree = trees.get(piece) if trees is not None else None
+        if tree is None:
+            piece_leaves = self.known_leaves(piece)
+            if piece_leaves is None and leaves is not None:
+                piece_leaves = leaves.get(piece)
+            if piece_leaves is None:
+                return None
+            tree = merkle_layers(piece_leaves, self.piece_width)
+            if trees is not None:
+                trees[piece] = tree
+        layer = tree[height]
+        offset = position - (piece << shift)
+        return layer[offset] if offset < len(layer) else _PADS[height]
+
+
+def _valid_range(base_layer: int, index: int, length: int, height: int) -> bool:
+    return (
+        0 <= base_layer <= height
+        and 0 < length <= 1 << (height - base_layer)
+        and not length & (length - 1)
+        and not index % length
+        and index + length <= 1 << (height - base_layer)
+    )
+
+
+class HashTree:
+    """
+    The hash trees of every file of a v2 or hybrid torrent, addressed by the piece indexes
+    of the whole torrent. Files start on piece boundaries, so every piece belongs to one file.
+    """
+
+    def __init__(self, files: List[FileHashes], piece_length: int):
+        self.files = files
+        self.piece_length = piece_length
+        self.piece_count = sum(file.piece_count for file in files)
+
+        self._roots = {file.pieces_root: file for file in files}
+        self._first_pieces = [file.first_piece for file in files]
+        # expected piece hashes of the whole torrent, e.g. for the `PieceVerifier`
+        self.piece_hashes = [digest for file in files for digest in file.piece_layer]
+
+    @classmethod
+    def from_torrent(cls, torrent) -> "HashTree":
+        info = torrent.info
+        files = []
+        first_piece = 0
+        for file in info.file_tree_files:
+            if not file.length:
+                continue
+            files.append(
+                FileHashes(
+                    file.pieces_root,
+                    file.length,
+                    info.piece_length,
+                    first_piece,
+                    torrent.piece_layers.get(file.pieces_root),
+                )
+            )
+            first_piece += files[-1].piece_count
+
+        tree = cls(files, info.piece_length)
+        if tree.piece_count != info.piece_count:
+            raise ValueError("The v1 and v2 pieces of the torrent do not line up")
+        return tree
+
+    def file_of(self, pieces_root: bytes) -> Optional[FileHashes]:
+        return self._roots.get(pieces_root)
+
+    def locate(self, index: int) -> Tuple[FileHashes, int]:
+        """
+        The file of a piece and the index of the piece within the file
+        """
+        file = self.files[bisect.bisect_right(self._first_pieces, index) - 1]
+        return file, index - file.first_piece
+
+    def hash_piece(self, index: int, data) -> bytes:
+        file, piece = self.locate(index)
+        return file.hash_piece(piece, data)
+
+    def verify_block(self, index: int, begin: int, data) -> Optional[bool]:
+        file, piece = self.locate(index)
+        return file.verify_block(piece, begin, data)
+
+    def hash_request(self, index: int) -> Optional[HashRange]:
+        """
+        The request for the leaf hashes of a piece, None if they are known or not needed
+        """
+        file, piece = self.locate(index)
+        if file.known_leaves(piece) is not None or file.piece_width > MAX_HASHES:
+            return None
+        width = file.piece_width
+        return file.pieces_root, 0, piece * width, width, 0
+
+    def discard_leaves(self, index: int):
+        """
+        Forget the leaf hashes of a verified piece, they are hashed from disk when asked for
+        """
+        file, piece = self.locate(index)
+        file.leaves.pop(piece, None)
@@ -0,0 +1,333 @@
+import asyncio
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple, Union
+
+from aiohttp import web
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Counter:
+    """
+    Monotonic total, either counted with `inc` or read from `function` when collected
+    """
+
+    __slots__ = ("value", "function")
+
+    kind = "counter"
+
+    def __init__(self, function: Optional[Callable[[], float]] = None):
+        self.value = 0
+        self.function = function
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def get(self) -> float:
+        return self.function() if self.function is not None else self.value
+
+
+class Gauge(Counter):
+    __slots__ = ()
+
+    kind = "gauge"
+
+    def set(self, value: float):
+        self.value = value
+
+
+class Histogram:
+    """
+    Counts of observed values per bucket, `bounds` are the inclusive upper limits
+    """
+
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    kind = "histogram"
+
+    # seconds
+    LATENCY = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, bounds: Tuple[float, ...] = LATENCY):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def get(self) -> dict:
+        buckets = {}
+        total = 0
+        for bound, count in zip(self.bounds, self.counts):
+            total += count
+            buckets[bound] = total
+        return {"count": self.count, "sum": self.sum, "buckets": buckets}
+
+
+Metric = Union[Counter, Gauge, Histogram]
+
+
+class _Family:
+    __slots__ = ("kind", "help", "series")
+
+    def __init__(self, kind: str, help: str):
+        self.kind = kind
+        self.help = help
+        self.series: Dict[Labels, Metric] = {}
+
+
+class Registry:
+    """
+    Named metrics with labels. Looking a series up is the slow part, callers keep the returned
+    object and only call `inc`/`set`/`observe` on it in hot paths.
+    """
+
+    def __init__(self):
+        self._families: Dict[str, _Family] = {}
+
+    def counter(self, name: str, help: str, function=None, **labels) -> Counter:
+        return self._series(Counter, name, help, labels, function)
+
+    def gauge(self, name: str, help: str, function=None, **labels) -> Gauge:
+        return self._series(Gauge, name, help, labels, function)
+
+    def histogram(
+        self, name: str, help: str, bounds: Tuple[float, ...] = Histogram.LATENCY, **labels
+    ) -> Histogram:
+        return self._series(Histogram, name, help, labels, bounds)
+
+    def _series(self, cls, name: str, help: str, labels: Dict[str, str], *args) -> Metric:
+        family = self._families.get(name)
+        if family is None:
+            family = self._families[name] = _Family(cls.kind, help)
+        elif family.kind != cls.kind:
+            raise ValueError(f"{name} is a {family.kind}, not a {cls.kind}")
+
+        key = tuple(sorted((label, str(value)) for label, value in labels.items()))
+        metric = family.series.get(key)
+        if metric is None:
+            metric = family.series[key] = cls(*args)
+        return metric
+
+    def remove(self, **labels):
+        """
+        Drop every series that has all of `labels`, e.g. those of a removed torrent
+        """
+        wanted = {(label, str(value)) for label, value in labels.items()}
+        for family in self._families.values():
+            for key in [key for key in family.series if wanted.issubset(key)]:
+                del family.series[key]
+
+    def snapshot(self) -> Dict[str, List[dict]]:
+        return {
+            name: [
+                {"labels": dict(labels), "value": metric.get()}
+                for labels, metric in family.series.items()
+            ]
+            for name, family in self._families.items()
+            if family.series
+        }
+
+    def export(self) -> List[dict]:
+        """
+        Every family with its current values as plain lists and dicts, e.g. to be sent to the
+        process that serves them
+        """
+        return [
+            {
+                "name": name,
+                "kind": family.kind,
+                "help": family.help,
+                "series": [
+                    [[list(label) for label in labels], metric.get()]
+                    for labels, metric in family.series.items()
+                ],
+            }
+            for name, family in self._families.items()
+            if family.series
+        ]
+
+    def prometheus(self) -> str:
+        """
+        Everything in the Prometheus text exposition format
+        """
+        return render_prometheus(self.export())
+
+
+def merge_exports(exports: Sequence[List[dict]], label: str) -> List[dict]:
+    """
+    The exports of several registries as one, each series labelled with the index of its
+    registry so equal series of different processes stay apart
+    """
+    merged: Dict[str, dict] = {}
+    for i, families in enumerate(exports):
+        for family in families:
+            target = merged.setdefault(family["name"], dict(family, series=[]))
+            target["series"].extend(
+                [labels + [[label, str(i)]], value] for labels, value in family["series"]
+            )
+    return list(merged.values())
+
+
+def render_prometheus(families: Iterable[dict]) -> str:
+    lines = []
+    for family in families:
+        name = family["name"]
+        lines.append(f"# HELP {name} {family['help']}")
+        lines.append(f"# TYPE {name} {family['kind']}")
+        for labels, value in family["series"]:
+            labels = tuple(tuple(label) for label in labels)
+            if family["kind"] != "histogram":
+                lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+                continue
+
+            for bound, count in value["buckets"].items():
+                bucket_labels = labels + (("le", _format_value(bound)),)
+                lines.append(f"{name}_bucket{_format_labels(bucket_labels)} {count}")
+            inf_labels = labels + (("le", "+Inf"),)
+            lines.append(f"{name}_bucket{_format_labels(inf_labels)} {value['count']}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(value['sum'])}")
+            lines.append(f"{name}_count{_format_labels(labels)} {value['count']}")
+
+    return "\n".join(lines) + "\n"
+
+
+def _format_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+
+    def _escape(value: str) -> str:
+        return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    return "{" + ",".join(f'{label}="{_escape(value)}"' for label, value in labels) + "}"
+
+
+def _format_value(value: float) -> str:
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
+
+
+class TorrentMetrics:
+    """
+    The series of one torrent, resolved once so connections only add to them
+    """
+
+    def __init__(self, registry: Registry, info_hash: bytes):
+        self.registry = registry
+        self.torrent = info_hash.hex()
+
+        self.received = registry.counter(
+            "pytorrent_received_bytes_total",
+            "Bytes received from peers including protocol overhead",
+            torrent=self.torrent,
+        )
+        self.sent = registry.counter(
+            "pytorrent_sent_bytes_total",
+            "Bytes sent to peers including protocol overhead",
+            torrent=self.torrent,
+        )
+        self.request_latency = registry.histogram(
+            "pytorrent_request_latency_seconds",
+            "Time from requesting a block until it arrived",
+            torrent=self.torrent,
+        )
+        self.write_latency = registry.histogram(
+            "pytorrent_disk_write_latency_seconds",
+            "Time to write one coalesced batch of blocks",
+            torrent=self.torrent,
+        )
+
+        self._messages: Dict[Tuple[str, str], Counter] = {}
+        self._connects: Dict[str, Counter] = {}
+
+    def message_received(self, message_type: str):
+        self._message("in", message_type).inc()
+
+    def message_sent(self, message_type: str, count: int = 1):
+        self._message("out", message_type).inc(count)
+
+    def _message(self, direction: str, message_type: str) -> Counter:
+        counter = self._messages.get((direction, message_type))
+        if counter is None:
+            counter = self._messages[(direction, message_type)] = self.registry.counter(
+                "pytorrent_messages_total",
+                "Peer wire messages by direction and type",
+                torrent=self.torrent,
+                direction=direction,
+                type=message_type,
+            )
+        return counter
+
+    def connect_attempt(self, outcome: str):
+        counter = self._connects.get(outcome)
+        if counter is None:
+            counter = self._connects[outcome] = self.registry.counter(
+                "pytorrent_connect_attempts_total",
+                "Outgoing peer connections by outcome",
+                torrent=self.torrent,
+                outcome=outcome,
+            )
+        counter.inc()
+
+    def gauge(self, name: str, help: str, function: Callable[[], float]):
+        self.registry.gauge(name, help, function, torrent=self.torrent)
+
+    def counter(self, name: str, help: str, function: Callable[[], float]):
+        self.registry.counter(name, help, function, torrent=self.torrent)
+
+    def close(self):
+        self.registry.remove(torrent=self.torrent)
+
+
+class LoopMonitor:
+    """
+    Measures event loop lag as how late a timer fires, a blocked loop delays every peer
+    """
+
+    INTERVAL = 0.5
+
+    def __init__(self, registry: Registry, interval: float = INTERVAL):
+        self.interval = interval
+        self.lag = registry.gauge(
+            "pytorrent_event_loop_lag_seconds", "Most recent lag of the event loop"
+        )
+        self.lags = registry.histogram(
+            "pytorrent_event_loop_lag_distribution_seconds", "Lag of the event loop"
+        )
+
+    async def run(self):
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, time.monotonic() - started - self.interval)
+            self.lag.set(lag)
+            self.lags.observe(lag)
+
+
+async def serve_metrics(registry: Registry, host: str, port: int) -> web.AppRunner:
+    """
+    Serve `registry` to Prometheus on http://host:port/metrics until the runner is cleaned up.
+    Anything with a `prometheus` method works as the registry, the method may be a coroutine.
+    """
+
+    async def _metrics(request: web.Request) -> web.Response:
+        text = registry.prometheus()
+        if asyncio.iscoroutine(text):
+            text = await text
+        return web.Response(
+            body=text.encode(),
+            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+        )
+
+    app = web.Application()
+    app.router.add_get("/metrics", _metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
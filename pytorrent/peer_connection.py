@@ -1,30 +1,53 @@
 import asyncio
-from asyncio.exceptions import CancelledError
 import hashlib
-import platform
-from re import A
-from pytorrent.torrent import TrackerResponse
-import signal
-from argparse import ArgumentParser
-from typing import Optional, List
+import ipaddress
 import logging
-import time
+import socket
 import struct
-import bitstring
-
-import aiohttp
-
-
-class PieceManager:
-    def __init__(self):
-        pass
+import time
+from collections import deque
+from typing import TYPE_CHECKING, Callable, Container, Deque, Dict, List, Optional, Set, Tuple
+
+from .piece_manager import BLOCK_SIZE, PieceManager
+from .choker import Choker, RateMeter
+from .merkle import HASH_SIZE, MAX_HASHES, FileHashes, HashTree
+from .metrics import TorrentMetrics
+from .peer_store import Endpoint, encode_address
+from .pex import (
+    EXTENDED_HANDSHAKE,
+    LOCAL_EXTENSIONS,
+    UT_PEX,
+    PeerExchange,
+    decode_handshake,
+    decode_listen_port,
+    decode_pex,
+    encode_handshake,
+)
+from .ratelimit import TokenBucket
+from .verify import PieceVerifier
+
+if TYPE_CHECKING:
+    # the uploader encodes Piece headers with the codec below
+    from .upload import Uploader
 
 
 class ProtocolError(BaseException):
     pass
 
 
-REQUEST_SIZE = 2 ** 14
+REQUEST_SIZE = BLOCK_SIZE
+
+# <length prefix><message id>[payload], compiled once for the whole module
+_HEADER = struct.Struct(">IB")
+_HANDSHAKE = struct.Struct(">B19s8s20s20s")
+_HAVE = struct.Struct(">IBI")
+_REQUEST = struct.Struct(">IBIII")
+_PIECE_HEADER = struct.Struct(">IBII")
+_PORT = struct.Struct(">IBH")
+_EXTENDED_HEADER = struct.Struct(">IBB")
+_HASH_REQUEST = struct.Struct(">IB32sIIII")
+
+_PROTOCOL = b"BitTorrent protocol"
 
 
 class PeerMessage:
@@ -39,9 +62,24 @@ class PeerMessage:
     Piece = 7
     Cancel = 8
     Port = 9
+    # fast extension (BEP 6)
+    Suggest = 13
+    HaveAll = 14
+    HaveNone = 15
+    RejectRequest = 16
+    AllowedFast = 17
+    Extended = 20
+    # v2 (BEP 52)
+    HashRequest = 21
+    Hashes = 22
+    HashReject = 23
     KeepAlive = None
     Handshake = None
 
+    __slots__ = ()
+
+    # length of the whole frame for fixed size messages, checked before decoding
+    size: Optional[int] = None
     length: int
 
     def encode(self) -> bytes:
@@ -49,16 +87,26 @@ class PeerMessage:
 
     @classmethod
     def decode(cls, data: bytes):
-        pass
+        return cls()
 
     def __str__(self):
         return self.__class__.__name__
 
 
 class Handshake(PeerMessage):
-    length = 49 + 19
+    __slots__ = ("info_hash", "peer_id", "reserved")
+
+    length = _HANDSHAKE.size
+
+    # reserved bits as (byte, mask)
+    EXTENSION_PROTOCOL = (5, 0x10)
+    FAST_EXTENSION = (7, 0x04)
+    V2 = (7, 0x10)
+
+    # what we advertise
+    RESERVED = bytes([0, 0, 0, 0, 0, EXTENSION_PROTOCOL[1], 0, FAST_EXTENSION[1] | V2[1]])
 
-    def __init__(self, info_hash, peer_id):
+    def __init__(self, info_hash, peer_id, reserved: bytes = RESERVED):
 
         if isinstance(info_hash, str):
             info_hash = info_hash.encode()
@@ -68,14 +116,17 @@ class Handshake(PeerMessage):
 
         self.info_hash = info_hash
         self.peer_id = peer_id
+        self.reserved = reserved
 
     def encode(self):
         """
         <pstrlen><pstr><reserved><info_hash><peer_id>
         """
-        return struct.pack(
-            ">B19s8x20s20s", 19, b"BitTorrent protocol", self.info_hash, self.peer_id
-        )
+        return _HANDSHAKE.pack(19, _PROTOCOL, self.reserved, self.info_hash, self.peer_id)
+
+    def supports(self, bit: Tuple[int, int]) -> bool:
+        byte, mask = bit
+        return bool(self.reserved[byte] & mask)
 
     @classmethod
     def decode(cls, data: bytes):
@@ -84,83 +135,154 @@ class Handshake(PeerMessage):
         if len(data) < Handshake.length:
             return None
 
-        parts = struct.unpack(">B19s8x20s20s", data)
-        hash_info = parts[2]
-        peer_id = parts[3]
+        pstrlen, pstr, reserved, info_hash, peer_id = _HANDSHAKE.unpack_from(data)
+        if pstrlen != 19 or pstr != _PROTOCOL:
+            return None
 
-        return cls(hash_info, peer_id)
+        return cls(info_hash, peer_id, reserved)
 
 
 class KeepAlive(PeerMessage):
-    pass
+    __slots__ = ()
 
+    def encode(self):
+        return bytes(4)
 
-class Choke(PeerMessage):
-    pass
 
+class _Flag(PeerMessage):
+    """
+    Messages without payload, their frames are built once
+    """
 
-class UnChoke(PeerMessage):
-    pass
+    __slots__ = ()
 
-
-class Interested(PeerMessage):
-    length = 1
+    size = _HEADER.size
+    frame: bytes
 
     def encode(self):
-        return struct.pack(">Ib", Interested.length, PeerMessage.Interested)
+        return self.frame
 
 
-class NotInterested(PeerMessage):
-    pass
+class Choke(_Flag):
+    __slots__ = ()
+    frame = _HEADER.pack(1, PeerMessage.Choke)
+
+
+class UnChoke(_Flag):
+    __slots__ = ()
+    frame = _HEADER.pack(1, PeerMessage.UnChoke)
+
+
+class Interested(_Flag):
+    __slots__ = ()
+    frame = _HEADER.pack(1, PeerMessage.Interested)
 
 
-class Have(PeerMessage):
+class NotInterested(_Flag):
+    __slots__ = ()
+    frame = _HEADER.pack(1, PeerMessage.NotInterested)
+
+
+class HaveAll(_Flag):
+    __slots__ = ()
+    frame = _HEADER.pack(1, PeerMessage.HaveAll)
+
+
+class HaveNone(_Flag):
+    __slots__ = ()
+    frame = _HEADER.pack(1, PeerMessage.HaveNone)
+
+
+class _Index(PeerMessage):
+    """
+    Have, Suggest and AllowedFast only carry a piece index
+    """
+
+    __slots__ = ("index",)
+
+    size = _HAVE.size
+    message_id: int
+
     def __init__(self, index: int):
         self.index = index
 
     def encode(self):
-        return struct.pack(">IbI", 5, PeerMessage.Have, self.index)
+        return _HAVE.pack(5, self.message_id, self.index)
 
     @classmethod
     def decode(cls, data: bytes):
-        index = struct.unpack(">IbI", data)[2]
-        return cls(index)
+        return cls(_HAVE.unpack_from(data)[2])
+
+
+class Have(_Index):
+    __slots__ = ()
+
+    message_id = PeerMessage.Have
+
+
+class Suggest(_Index):
+    __slots__ = ()
+
+    message_id = PeerMessage.Suggest
+
+
+class AllowedFast(_Index):
+    __slots__ = ()
+
+    message_id = PeerMessage.AllowedFast
 
 
 class BitField(PeerMessage):
-    def __init__(self, data):
-        self.bitfield = bitstring.BitArray(bytes=data)
+    __slots__ = ("bitfield",)
+
+    def __init__(self, data: bytes):
+        self.bitfield = data
 
     def encode(self):
-        length = len(self.bitfield)
-        return struct.pack(
-            ">Ib" + str(length) + "s", 1 + length, PeerMessage.BitField, self.bitfield
-        )
+        return _HEADER.pack(1 + len(self.bitfield), PeerMessage.BitField) + self.bitfield
 
     @classmethod
     def decode(cls, data: bytes):
-        message_length = struct.unpack(">I", data[0:4])[0]
-        parts = struct.unpack(">Ib" + str(message_length - 1) + "s", data)
-        return cls(parts[2])
+        return cls(bytes(data[_HEADER.size :]))
+
+
+class _Block(PeerMessage):
+    """
+    Request, Cancel and RejectRequest share the layout <index><begin><length>
+    """
 
+    __slots__ = ("index", "begin", "length")
+
+    size = _REQUEST.size
+    message_id: int
 
-class Request(PeerMessage):
     def __init__(self, index: int, begin: int, length: int = REQUEST_SIZE):
         self.index = index
         self.begin = begin
         self.length = length
 
     def encode(self):
-        return struct.pack(">IbIII", 13, PeerMessage.Request, self.index, self.begin, self.length)
+        return _REQUEST.pack(13, self.message_id, self.index, self.begin, self.length)
 
     @classmethod
     def decode(cls, data: bytes):
+        _, _, index, begin, length = _REQUEST.unpack_from(data)
+        return cls(index, begin, length)
+
+
+class Request(_Block):
+    __slots__ = ()
 
-        parts = struct.unpack(">IbIII", data)
-        return cls(parts[2], parts[3], parts[4])
+    message_id = PeerMessage.Request
 
 
 class Piece(PeerMessage):
+    """
+    `data` is sent and received as is, only the 13 byte header goes through `struct`
+    """
+
+    __slots__ = ("index", "begin", "data")
+
     length: int = 9
 
     def __init__(self, index: int, begin: int, data: bytes):
@@ -168,174 +290,1255 @@ class Piece(PeerMessage):
         self.begin = begin
         self.data = data
 
+    @staticmethod
+    def header(index: int, begin: int, length: int) -> bytes:
+        """
+        The header of a message with `length` bytes of data, e.g. to send the data from a file
+        """
+        return _PIECE_HEADER.pack(Piece.length + length, PeerMessage.Piece, index, begin)
+
+    def encode_header(self) -> bytes:
+        return Piece.header(self.index, self.begin, len(self.data))
+
+    def encode(self):
+        return self.encode_header() + self.data
+
+    @classmethod
+    def decode(cls, data: bytes):
+        _, _, index, begin = _PIECE_HEADER.unpack_from(data)
+        return cls(index, begin, memoryview(data)[_PIECE_HEADER.size :])
+
+
+class Cancel(_Block):
+    __slots__ = ()
+
+    message_id = PeerMessage.Cancel
+
+
+class RejectRequest(_Block):
+    __slots__ = ()
+
+    message_id = PeerMessage.RejectRequest
+
+
+class Port(PeerMessage):
+    __slots__ = ("port",)
+
+    size = _PORT.size
+
+    def __init__(self, port: int):
+        self.port = port
+
+    def encode(self):
+        return _PORT.pack(3, PeerMessage.Port, self.port)
+
+    @classmethod
+    def decode(cls, data: bytes):
+        return cls(_PORT.unpack_from(data)[2])
+
+
+class Extended(PeerMessage):
+    """
+    Extension protocol message (BEP 10), `extended_id` 0 is the extension handshake
+    """
+
+    __slots__ = ("extended_id", "payload")
+
+    def __init__(self, extended_id: int, payload: bytes):
+        self.extended_id = extended_id
+        self.payload = payload
+
     def encode(self):
-        message_length = Piece.length + len(self.data)
-        return struct.pack(
-            ">IbII" + str(len(self.data)) + "s",
-            message_length,
-            PeerMessage.Piece,
-            self.indx,
-            self.begin,
-            self.data,
+        return (
+            _EXTENDED_HEADER.pack(2 + len(self.payload), PeerMessage.Extended, self.extended_id)
+            + self.payload
         )
 
     @classmethod
     def decode(cls, data: bytes):
-        message_length = struct.unpack(">I", data[0:4])[0]
-        parts = struct.unpack(">IbII" + str(message_length - Piece.length) + "s", data)
-        return cls(parts[2], parts[3], parts[4])
+        if len(data) < _EXTENDED_HEADER.size:
+            raise ProtocolError("Extended message without extension id")
+        return cls(data[_EXTENDED_HEADER.size - 1], bytes(data[_EXTENDED_HEADER.size :]))
 
 
-class Cancel(PeerMessage):
-    def __init__(self, index: int, begin: int, length: int = REQUEST_SIZE):
+class _HashRange(PeerMessage):
+    """
+    HashRequest and HashReject share the layout
+    <pieces root><base layer><index><length><proof layers>
+    """
+
+    __slots__ = ("pieces_root", "base_layer", "index", "length", "proof_layers")
+
+    size = _HASH_REQUEST.size
+    message_id: int
+
+    def __init__(
+        self, pieces_root: bytes, base_layer: int, index: int, length: int, proof_layers: int = 0
+    ):
+        self.pieces_root = pieces_root
+        self.base_layer = base_layer
         self.index = index
-        self.begin = begin
         self.length = length
+        self.proof_layers = proof_layers
 
     def encode(self):
-        return struct.pack(">IbIII", 13, PeerMessage.Cancel, self.index, self.begin, self.length)
+        return _HASH_REQUEST.pack(
+            _HASH_REQUEST.size - 4,
+            self.message_id,
+            self.pieces_root,
+            self.base_layer,
+            self.index,
+            self.length,
+            self.proof_layers,
+        )
 
     @classmethod
     def decode(cls, data: bytes):
+        return cls(*_HASH_REQUEST.unpack_from(data)[2:])
 
-        parts = struct.unpack(">IbIII", data)
-        return cls(parts[2], parts[3], parts[4])
 
+class HashRequest(_HashRange):
+    __slots__ = ()
 
-class Port(PeerMessage):
-    def __init__(self):
-        pass
+    message_id = PeerMessage.HashRequest
 
-    def encode():
-        pass
+
+class HashReject(_HashRange):
+    __slots__ = ()
+
+    message_id = PeerMessage.HashReject
+
+
+class Hashes(PeerMessage):
+    """
+    The range of a `HashRequest` followed by the requested hashes and then the uncle hashes
+    """
+
+    __slots__ = ("pieces_root", "base_layer", "index", "length", "proof_layers", "hashes")
+
+    def __init__(
+        self,
+        pieces_root: bytes,
+        base_layer: int,
+        index: int,
+        length: int,
+        proof_layers: int,
+        hashes: List[bytes],
+    ):
+        self.pieces_root = pieces_root
+        self.base_layer = base_layer
+        self.index = index
+        self.length = length
+        self.proof_layers = proof_layers
+        self.hashes = hashes
+
+    def encode(self):
+        header = _HASH_REQUEST.pack(
+            _HASH_REQUEST.size - 4 + HASH_SIZE * len(self.hashes),
+            PeerMessage.Hashes,
+            self.pieces_root,
+            self.base_layer,
+            self.index,
+            self.length,
+            self.proof_layers,
+        )
+        return header + b"".join(self.hashes)
 
     @classmethod
     def decode(cls, data: bytes):
-        pass
+        if len(data) < _HASH_REQUEST.size or (len(data) - _HASH_REQUEST.size) % HASH_SIZE:
+            raise ProtocolError(f"Hashes of invalid length {len(data)}")
+        hashes = [
+            bytes(data[i : i + HASH_SIZE]) for i in range(_HASH_REQUEST.size, len(data), HASH_SIZE)
+        ]
+        return cls(*_HASH_REQUEST.unpack_from(data)[2:], hashes)
+
+
+# decoders by message id, None for ids we do not handle
+MESSAGE_TYPES: List[Optional[type]] = [None] * (PeerMessage.HashReject + 1)
+for _message_type in (
+    Choke,
+    UnChoke,
+    Interested,
+    NotInterested,
+    Have,
+    BitField,
+    Request,
+    Piece,
+    Cancel,
+    Port,
+    Suggest,
+    HaveAll,
+    HaveNone,
+    RejectRequest,
+    AllowedFast,
+    Extended,
+    HashRequest,
+    Hashes,
+    HashReject,
+):
+    MESSAGE_TYPES[getattr(PeerMessage, _message_type.__name__)] = _message_type
+
+
+def allowed_fast_set(info_hash: bytes, ip: str, piece_count: int, k: int = 10) -> Set[int]:
+    """
+    The pieces a peer at `ip` may request while choked (BEP 6). Derived from the /24 of the
+    address so peers cannot get more by opening connections from neighbouring addresses.
+    Only defined for IPv4, other addresses get an empty set.
+    """
+    try:
+        address = ipaddress.ip_address(ip)
+    except ValueError:
+        return set()
+    if address.version != 4 or not piece_count:
+        return set()
+
+    k = min(k, piece_count)
+    allowed: Set[int] = set()
+    x = (int(address) & 0xFFFFFF00).to_bytes(4, "big") + info_hash
+    while len(allowed) < k:
+        x = hashlib.sha1(x).digest()
+        for i in range(0, 20, 4):
+            if len(allowed) >= k:
+                break
+            allowed.add(int.from_bytes(x[i : i + 4], "big") % piece_count)
+    return allowed
+
+
+def _hashes_from_pieces(
+    file: FileHashes, request: HashRequest, pieces: Dict[int, bytes]
+) -> Optional[List[bytes]]:
+    # hashes the leaves of `pieces` and the layers above them, runs on the verifier's pool
+    leaves = {}
+    for piece, data in pieces.items():
+        piece_leaves = file.piece_leaves(piece, data)
+        if piece_leaves is not None:
+            leaves[piece] = piece_leaves
+    return file.serve(
+        request.base_layer, request.index, request.length, request.proof_layers, leaves
+    )
+
+
+class RequestPipeline:
+    """
+    Requests outstanding on one connection.
+
+    The target depth follows the bandwidth-delay product: the measured download rate times the
+    lowest request latency seen recently, plus headroom so the depth keeps growing until the
+    link, not the pipeline, is the bottleneck. Requests older than the adaptive timeout are
+    returned by `expired` so they can be given back to the piece manager.
+    """
+
+    MIN_DEPTH = 2
+    MAX_DEPTH = 500
+    INITIAL_DEPTH = 4
+    HEADROOM = 1.5
+
+    MIN_TIMEOUT = 5.0
+    MAX_TIMEOUT = 60.0
+
+    RATE_INTERVAL = 1.0
+    RTT_WINDOW = 10.0
+
+    def __init__(self, block_size: int = REQUEST_SIZE):
+        self.block_size = block_size
+        self.outstanding: Dict[Tuple[int, int], Tuple[int, float]] = {}
+        self.depth = RequestPipeline.INITIAL_DEPTH
+
+        self.rate = 0.0
+        self.min_rtt: Optional[float] = None
+        self.srtt: Optional[float] = None
+        self.rttvar = 0.0
+
+        self._rate_started: Optional[float] = None
+        self._rate_bytes = 0
+        self._window_min_rtt: Optional[float] = None
+        self._window_started: Optional[float] = None
+
+    def __len__(self):
+        return len(self.outstanding)
+
+    def __contains__(self, request: Tuple[int, int]) -> bool:
+        return request in self.outstanding
+
+    @property
+    def wanted(self) -> int:
+        return self.depth - len(self.outstanding)
+
+    @property
+    def timeout(self) -> float:
+        if self.srtt is None:
+            return RequestPipeline.MAX_TIMEOUT
+
+        timeout = self.srtt + 4 * self.rttvar
+        return min(max(timeout, RequestPipeline.MIN_TIMEOUT), RequestPipeline.MAX_TIMEOUT)
+
+    def sent(self, index: int, begin: int, length: int, now: Optional[float] = None):
+        self.outstanding[(index, begin)] = (length, time.monotonic() if now is None else now)
+
+    def discard(self, index: int, begin: int) -> bool:
+        return self.outstanding.pop((index, begin), None) is not None
+
+    def rejected(self, index: int, begin: int) -> bool:
+        """
+        A request the peer refused, the depth drops to what it accepted so far
+        """
+        if self.outstanding.pop((index, begin), None) is None:
+            return False
+
+        self.depth = max(RequestPipeline.MIN_DEPTH, min(self.depth, len(self.outstanding)))
+        return True
+
+    def clear(self) -> List[Tuple[int, int]]:
+        requests = list(self.outstanding)
+        self.outstanding.clear()
+        return requests
+
+    def received(self, index: int, begin: int, length: int, now: Optional[float] = None) -> bool:
+        now = time.monotonic() if now is None else now
+        self._rate_bytes += length
+
+        if self._rate_started is None:
+            self._rate_started = self._window_started = now
+        elif now - self._rate_started >= RequestPipeline.RATE_INTERVAL:
+            sample = self._rate_bytes / (now - self._rate_started)
+            self.rate = sample if not self.rate else 0.7 * self.rate + 0.3 * sample
+            self._rate_started = now
+            self._rate_bytes = 0
+
+        request = self.outstanding.pop((index, begin), None)
+        if request is None:
+            return False
+
+        self._update_rtt(now - request[1], now)
+        self._update_depth()
+        return True
+
+    def expired(self, now: Optional[float] = None) -> List[Tuple[int, int]]:
+        now = time.monotonic() if now is None else now
+        deadline = now - self.timeout
+
+        expired = [key for key, (_, sent_at) in self.outstanding.items() if sent_at < deadline]
+        for key in expired:
+            del self.outstanding[key]
+
+        if expired:
+            self.depth = max(RequestPipeline.MIN_DEPTH, self.depth // 2)
+
+        return expired
+
+    def _update_rtt(self, sample: float, now: float):
+        if self.srtt is None:
+            self.srtt = sample
+            self.rttvar = sample / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - sample)
+            self.srtt = 0.875 * self.srtt + 0.125 * sample
+
+        if self._window_min_rtt is None or sample < self._window_min_rtt:
+            self._window_min_rtt = sample
+        if self.min_rtt is None or sample < self.min_rtt:
+            self.min_rtt = sample
+
+        if now - self._window_started >= RequestPipeline.RTT_WINDOW:
+            self.min_rtt = self._window_min_rtt
+            self._window_min_rtt = None
+            self._window_started = now
+
+    def _update_depth(self):
+        if not self.rate or self.min_rtt is None:
+            # no rate measured yet, grow by one for every block like a slow start
+            depth = self.depth + 1
+        else:
+            bdp = self.rate * self.min_rtt / self.block_size
+            depth = int(bdp * RequestPipeline.HEADROOM) + RequestPipeline.MIN_DEPTH
+
+        self.depth = min(max(depth, RequestPipeline.MIN_DEPTH), RequestPipeline.MAX_DEPTH)
 
 
 class PeerConnection:
+    """
+    One connection to one peer. `connect` dials and handshakes, `run` exchanges messages until
+    either side closes. Connections are created and scheduled by the `PeerPool`.
+    """
+
+    TIMEOUT_CHECK_INTERVAL = 1.0
+    MAX_HASH_FAILURES = 3
+    CONNECT_TIMEOUT = 5.0
+    HANDSHAKE_TIMEOUT = 10.0
+    MAX_UPLOAD_QUEUE = 256
+    # pieces a new peer may download from us before it is unchoked
+    ALLOWED_FAST_COUNT = 10
+    # allowed fast pieces accepted from a peer, more are ignored
+    MAX_ALLOWED_FAST = 64
+
     def __init__(
         self,
-        queue: asyncio.Queue,
+        address: Tuple[str, int],
         info_hash: bytes,
         peer_id: str,
         piece_manager: PieceManager,
         loop: asyncio.BaseEventLoop,
-        session: aiohttp.ClientSession,
+        verifier: Optional[PieceVerifier] = None,
+        uploader: Optional["Uploader"] = None,
+        choker: Optional[Choker] = None,
+        download_limit: Optional[TokenBucket] = None,
+        upload_limit: Optional[TokenBucket] = None,
+        metrics: Optional[TorrentMetrics] = None,
+        pex: bool = False,
+        on_peers: Optional[Callable[[List[Endpoint]], None]] = None,
+        hash_tree: Optional[HashTree] = None,
     ):
         self.loop = loop
-        self.session = session
-        self.states = []
-        self.peer_states = []
-
-        self.reader: asyncio.StreamReader = None
-        self.writer: asyncio.StreamWriter = None
+        self.address = address
+        # incoming connections come from an ephemeral port, the peer may tell its listen port
+        self.incoming = False
+        self.listen_port: Optional[int] = None
+        # our side and the peer's side of the choke and interest states
+        self.am_choking = True
+        self.am_interested = False
+        self.peer_choking = True
+        self.peer_interested = False
+        self.stopped = False
+
+        self.transport: asyncio.Transport = None
+        self.protocol: PeerProtocol = None
+        self.remote_id: Optional[bytes] = None
+        self.remote_reserved = bytes(8)
+
+        # extension names -> the ids the peer wants them sent with
+        self.extensions: Dict[bytes, int] = {}
+        self.peer_exchange = PeerExchange() if pex else None
+        self.on_peers = on_peers
+
+        # fast extension: pieces the peer lets us request while it chokes us, and the other way
+        self.allowed_fast: Set[int] = set()
+        self.allowed_for_peer: Set[int] = set()
+
+        # v2: leaf hashes asked for as (pieces root, base layer, index, length)
+        self.hash_tree = hash_tree
+        self.hash_requests: Set[Tuple[bytes, int, int, int]] = set()
 
         self.piece_manager = piece_manager
+        self.verifier = verifier
         self.peer_id = peer_id
         self.info_hash = info_hash
-        self.queue = queue
+        self.pipeline = RequestPipeline()
+
+        self.uploader = uploader
+        self.choker = choker
+        self.download_limit = download_limit
+        self.upload_limit = upload_limit
+        self.metrics = metrics
+        self.uploads: Deque[Tuple[int, int, int]] = deque()
+        self._upload_task: Optional[asyncio.Task] = None
+
+        self.downloaded = 0
+        self.uploaded = 0
+        self.download_rate = RateMeter()
+        self.upload_rate = RateMeter()
+        self.connected_at: Optional[float] = None
 
-        self.future = asyncio.ensure_future(self._start(), loop=self.loop)
+    def __str__(self):
+        return "%s:%d" % self.address
 
-    async def _start(self):
+    async def connect(
+        self,
+        connect_timeout: float = CONNECT_TIMEOUT,
+        handshake_timeout: float = HANDSHAKE_TIMEOUT,
+    ):
+        ip, port = self.address
+        self.transport, self.protocol = await asyncio.wait_for(
+            self.loop.create_connection(
+                lambda: PeerProtocol(self.download_limit, self.metrics), ip, port
+            ),
+            connect_timeout,
+        )
+        logging.info("connection opened to %s", self)
 
-        while "stopped" not in self.states:
-            ip, port = await self.queue.get()
-            logging.info("Got assigned peer with: %s:%d", ip, port)
+        await asyncio.wait_for(self._handshake(), handshake_timeout)
+        self.connected_at = time.monotonic()
 
+    async def accept(self, sock: socket.socket, handshake: Handshake):
+        """
+        Take over an incoming connection whose handshake was already read, e.g. by a `Listener`
+        """
+        self.transport, self.protocol = await self.loop.connect_accepted_socket(
+            lambda: PeerProtocol(self.download_limit, self.metrics), sock
+        )
+        self.incoming = True
+        self.remote_id = handshake.peer_id
+        self.remote_reserved = handshake.reserved
+
+        self._send(Handshake(self.info_hash, self.peer_id))
+        await self.protocol.drain()
+        logging.info("Accepted connection from %s (%s)", self, self.remote_id)
+        self.connected_at = time.monotonic()
+
+    async def run(self):
+        self.piece_manager.add_peer(self)
+        timeouts = asyncio.ensure_future(self._check_timeouts())
+
+        try:
+            self._send_pieces()
+
+            if self.supports_extensions:
+                local = {name: i for name, i in LOCAL_EXTENSIONS.items() if self._enabled(name)}
+                self._send(
+                    Extended(
+                        EXTENDED_HANDSHAKE,
+                        encode_handshake(local, PeerConnection.MAX_UPLOAD_QUEUE),
+                    )
+                )
+
+            self.update_interest()
+            await self.protocol.drain()
+
+            async for message in PeerStreamIterator(self.protocol):
+                if self.stopped:
+                    break
+
+                logging.debug("Got message %s", message)
+                if self.metrics is not None:
+                    self.metrics.message_received(type(message).__name__)
+                await self._handle_message(message)
+                await self.protocol.drain()
+
+        finally:
+            timeouts.cancel()
+            if self._upload_task:
+                self._upload_task.cancel()
+            self.uploads.clear()
+            self.piece_manager.remove_peer(self)
+            self.pipeline = RequestPipeline()
+            self.disconnect()
+
+    def _send_pieces(self):
+        have = self.uploader.have if self.uploader else None
+        if not self.supports_fast:
+            if have is not None and len(have):
+                self._send(BitField(have.to_bytes()))
+            return
+
+        # a seed of a huge torrent would otherwise send a bitfield of many kilobytes
+        if have is not None and have.all():
+            self._send(HaveAll())
+        elif have is None or not len(have):
+            self._send(HaveNone())
+        else:
+            self._send(BitField(have.to_bytes()))
+
+        if have is not None and not have.all():
+            self.allowed_for_peer = allowed_fast_set(
+                self.info_hash,
+                self.address[0],
+                self.piece_manager.piece_count,
+                PeerConnection.ALLOWED_FAST_COUNT,
+            )
+            for index in sorted(self.allowed_for_peer):
+                if index in have:
+                    self._send(AllowedFast(index))
+
+    async def _handle_message(self, message: PeerMessage):
+        if isinstance(message, BitField):
+            self.piece_manager.peer_bitfield(self, message.bitfield)
+            self.update_interest()
+        elif isinstance(message, Have):
+            if not 0 <= message.index < self.piece_manager.piece_count:
+                raise ProtocolError(f"Have of invalid piece {message.index}")
+            self.piece_manager.peer_have(self, message.index)
+            # one more piece can only make the peer interesting
+            if not self.am_interested:
+                self.update_interest()
+        elif isinstance(message, HaveAll):
+            self.piece_manager.peer_have_all(self)
+            self.update_interest()
+        elif isinstance(message, HaveNone):
+            self.piece_manager.peer_have_none(self)
+            self.update_interest()
+        elif isinstance(message, Choke):
+            self.peer_choking = True
+            # with the fast extension the peer rejects every request it drops
+            if not self.supports_fast:
+                for index, begin in self.pipeline.clear():
+                    self.piece_manager.release(self, index, begin)
+        elif isinstance(message, UnChoke):
+            self.peer_choking = False
+        elif isinstance(message, Piece):
+            await self._handle_piece(message)
+        elif isinstance(message, Interested):
+            self._peer_interested()
+        elif isinstance(message, NotInterested):
+            self.peer_interested = False
+        elif isinstance(message, Request):
+            self._queue_upload(message.index, message.begin, message.length)
+        elif isinstance(message, Cancel):
+            request = (message.index, message.begin, message.length)
             try:
+                self.uploads.remove(request)
+            except ValueError:
+                pass
+            else:
+                self._reject(*request)
+        elif isinstance(message, RejectRequest):
+            if self.pipeline.rejected(message.index, message.begin):
+                self.piece_manager.release(self, message.index, message.begin)
+                if self.peer_choking:
+                    self.allowed_fast.discard(message.index)
+        elif isinstance(message, AllowedFast):
+            if (
+                0 <= message.index < self.piece_manager.piece_count
+                and len(self.allowed_fast) < PeerConnection.MAX_ALLOWED_FAST
+            ):
+                self.allowed_fast.add(message.index)
+        elif isinstance(message, Extended):
+            self._handle_extended(message)
+        elif isinstance(message, HashRequest):
+            await self._serve_hashes(message)
+        elif isinstance(message, Hashes):
+            self._add_hashes(message)
+        elif isinstance(message, HashReject):
+            self.hash_requests.discard(
+                (message.pieces_root, message.base_layer, message.index, message.length)
+            )
+
+        self._request_pieces()
+
+    @property
+    def supports_extensions(self) -> bool:
+        byte, mask = Handshake.EXTENSION_PROTOCOL
+        return bool(self.remote_reserved[byte] & mask)
+
+    @property
+    def supports_fast(self) -> bool:
+        byte, mask = Handshake.FAST_EXTENSION
+        return bool(self.remote_reserved[byte] & mask)
+
+    @property
+    def supports_v2(self) -> bool:
+        byte, mask = Handshake.V2
+        return bool(self.remote_reserved[byte] & mask)
+
+    def _enabled(self, extension: bytes) -> bool:
+        return extension != UT_PEX or self.peer_exchange is not None
+
+    def _handle_extended(self, message: Extended):
+        if message.extended_id == EXTENDED_HANDSHAKE:
+            # later handshakes may enable or disable (id 0) single extensions
+            self.extensions.update(decode_handshake(message.payload))
+            self.extensions = {name: i for name, i in self.extensions.items() if i}
+            self.listen_port = decode_listen_port(message.payload) or self.listen_port
+        elif message.extended_id == LOCAL_EXTENSIONS[UT_PEX] and self.peer_exchange:
+            added, _ = decode_pex(message.payload)
+            if added and self.on_peers:
+                self.on_peers(added[: PeerExchange.MAX_RECEIVED])
+
+    @property
+    def listen_address(self) -> Optional[Tuple[str, int]]:
+        """
+        Where the peer accepts connections, None for incoming peers that did not tell
+        """
+        if not self.incoming:
+            return self.address
+        if self.listen_port:
+            return self.address[0], self.listen_port
+        return None
 
-                self.reader, self.writer = await asyncio.open_connection(ip, port)
-                logging.info("connection opened to %s:%d", ip, port)
+    def send_pex(
+        self,
+        connected: Set[Endpoint],
+        now: Optional[float] = None,
+        reachable: Container[Endpoint] = (),
+    ):
+        """
+        Tell the peer about connections that were opened or closed since the last time.
+        `reachable` are the peers we connected to ourselves.
+        """
+        extension_id = self.extensions.get(UT_PEX)
+        if not extension_id or self.peer_exchange is None or not self.peer_exchange.due(now):
+            return
+        if not self.protocol or self.protocol.closed:
+            return
+
+        address = self.listen_address
+        if address is not None:
+            connected = connected - {encode_address(address)}
+        payload = self.peer_exchange.update(connected, now, reachable)
+        if payload:
+            self._send(Extended(extension_id, payload))
+
+    async def _handle_piece(self, message: Piece):
+        if self.metrics is not None:
+            request = self.pipeline.outstanding.get((message.index, message.begin))
+            if request is not None:
+                self.metrics.request_latency.observe(time.monotonic() - request[1])
+
+        self.downloaded += len(message.data)
+        self.download_rate.add(len(message.data))
+        self.pipeline.received(message.index, message.begin, len(message.data))
+
+        # with the leaf hashes of the piece a bad block is dropped right away (v2)
+        if self.hash_tree is not None and 0 <= message.index < self.piece_manager.piece_count:
+            if self.hash_tree.verify_block(message.index, message.begin, message.data) is False:
+                logging.warning(
+                    "Block %d:%d from %s failed the hash check", message.index, message.begin, self
+                )
+                failures = self.piece_manager.block_failed(self, message.index, message.begin)
+                if failures >= PeerConnection.MAX_HASH_FAILURES:
+                    self.disconnect()
+                return
+
+        complete, cancels = self.piece_manager.block_received(
+            self, message.index, message.begin, message.data
+        )
 
-                buffer = await self._handshake()
+        for peer, request in cancels:
+            peer.cancel(*request)
+
+        if complete:
+            logging.info("Piece %d complete", message.index)
+            if self.verifier:
+                data = self.piece_manager.piece_data(message.index)
+                await self.verifier.submit(message.index, data)
+
+    async def _serve_hashes(self, request: HashRequest):
+        file = self.hash_tree.file_of(request.pieces_root) if self.hash_tree else None
+        hashes = None
+        if file is not None:
+            pieces = await self._read_pieces(file, request) if request.base_layer == 0 else {}
+            args = (_hashes_from_pieces, file, request, pieces)
+            if self.verifier is not None:
+                hashes = await self.verifier.run(*args)
+            else:
+                hashes = await asyncio.get_running_loop().run_in_executor(None, *args)
+
+        fields = (
+            request.pieces_root,
+            request.base_layer,
+            request.index,
+            request.length,
+            request.proof_layers,
+        )
+        if hashes is None:
+            self._send(HashReject(*fields))
+        else:
+            self._send(Hashes(*fields, hashes))
 
-                self.states.append("choked")
-                await self._send_interested()
-                self.states.append("interested")
+    async def _read_pieces(self, file: FileHashes, request: HashRequest) -> Dict[int, bytes]:
+        """
+        The data of the pieces we have whose leaves a request covers, for hashing
+        """
+        pieces = {}
+        if self.uploader is None or request.length > MAX_HASHES:
+            return pieces
+
+        width = file.piece_width
+        first = request.index // width
+        last = min(-(-(request.index + request.length) // width), file.piece_count)
+        for piece in range(first, last):
+            index = file.first_piece + piece
+            if file.known_leaves(piece) is None and index in self.uploader.have:
+                try:
+                    pieces[piece] = await self.uploader.cache.read(
+                        index, 0, file.piece_size(piece)
+                    )
+                except OSError as e:
+                    logging.warning("Unable to read piece %d: %s", index, e)
+        return pieces
+
+    def _add_hashes(self, message: Hashes):
+        key = (message.pieces_root, message.base_layer, message.index, message.length)
+        if key not in self.hash_requests:
+            return
+
+        self.hash_requests.discard(key)
+        file = self.hash_tree.file_of(message.pieces_root)
+        if not file.add_hashes(message.base_layer, message.index, message.length, message.hashes):
+            logging.info("Invalid hashes for %s from %s", message.pieces_root.hex(), self)
+
+    def _peer_interested(self):
+        self.peer_interested = True
+        if not self.uploader:
+            return
+
+        if self.choker:
+            self.choker.interested(self)
+        else:
+            self.unchoke()
+
+    def choke(self):
+        if self.am_choking:
+            return
+
+        # requests still queued are dropped, the peer asks again when unchoked. With the fast
+        # extension each one is rejected, except those for allowed fast pieces.
+        self.am_choking = True
+        uploads, self.uploads = self.uploads, deque()
+        if not self.protocol or self.protocol.closed:
+            return
+
+        self._send(Choke())
+        for request in uploads:
+            if request[0] in self.allowed_for_peer:
+                self.uploads.append(request)
+            else:
+                self._reject(*request)
+
+    def unchoke(self):
+        if not self.am_choking:
+            return
+
+        self.am_choking = False
+        if self.protocol and not self.protocol.closed:
+            self._send(UnChoke())
+
+    def _queue_upload(self, index: int, begin: int, length: int):
+        if self.am_choking and index not in self.allowed_for_peer:
+            logging.debug("Ignoring request from choked peer %s", self)
+            self._reject(index, begin, length)
+            return
+        if not self.uploader.validate(index, begin, length):
+            logging.info("Invalid request %d:%d+%d from %s", index, begin, length, self)
+            self._reject(index, begin, length)
+            return
+        if len(self.uploads) >= PeerConnection.MAX_UPLOAD_QUEUE:
+            logging.info("Too many requests queued by %s", self)
+            self._reject(index, begin, length)
+            return
+
+        self.uploads.append((index, begin, length))
+        if self._upload_task is None or self._upload_task.done():
+            self._upload_task = asyncio.ensure_future(self._upload())
+
+    async def _upload(self):
+        try:
+            # choking leaves only requests for allowed fast pieces in the queue
+            while self.uploads:
+                index, begin, length = self.uploads.popleft()
+                await self.uploader.send(self.protocol, index, begin, length)
+                self.uploaded += length
+                if self.metrics is not None:
+                    self.metrics.message_sent("Piece")
+                self.upload_rate.add(length)
+                await self.protocol.drain()
+
+                if self.upload_limit is not None:
+                    delay = self.upload_limit.consume(length)
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+        except (OSError, ValueError) as e:
+            logging.info("Upload to %s failed: %s", self, e)
+            self.disconnect()
+
+    def _reject(self, index: int, begin: int, length: int):
+        if self.supports_fast:
+            self._send(RejectRequest(index, begin, length))
+
+    def send_have(self, index: int):
+        if self.protocol and not self.protocol.closed:
+            self._send(Have(index))
+
+    def update_interest(self):
+        """
+        Tell the peer whether it has pieces we need, after its pieces or ours changed
+        """
+        if not self.protocol or self.protocol.closed:
+            return
+
+        interested = self.piece_manager.is_interesting(self)
+        if interested != self.am_interested:
+            self.am_interested = interested
+            self._send(Interested() if interested else NotInterested())
+
+    def _send(self, message: PeerMessage):
+        self.protocol.write(message.encode())
+        if self.metrics is not None:
+            self.metrics.message_sent(type(message).__name__)
+
+    def _request_pieces(self):
+        # a peer choking us may still serve its allowed fast pieces
+        allowed = None
+        if self.peer_choking:
+            if not self.allowed_fast:
+                return
+            allowed = self.allowed_fast
+
+        missing = self.pipeline.wanted
+        if missing <= 0:
+            return
+
+        requests = self.piece_manager.next_requests(self, missing, allowed)
+        if not requests:
+            return
+
+        # the leaf hashes go first so they arrive before the blocks
+        if self.hash_tree is not None and self.supports_v2:
+            for index in sorted({index for index, _, _ in requests}):
+                hash_range = self.hash_tree.hash_request(index)
+                if hash_range is not None and hash_range[:4] not in self.hash_requests:
+                    self.hash_requests.add(hash_range[:4])
+                    self._send(HashRequest(*hash_range))
+
+        # the whole batch is packed into a single frame buffer
+        frames = bytearray(_REQUEST.size * len(requests))
+        for offset, (index, begin, length) in enumerate(requests):
+            self.pipeline.sent(index, begin, length)
+            _REQUEST.pack_into(
+                frames, offset * _REQUEST.size, 13, PeerMessage.Request, index, begin, length
+            )
+        self.protocol.write(frames)
+        if self.metrics is not None:
+            self.metrics.message_sent("Request", len(requests))
+
+    async def _check_timeouts(self):
+        while True:
+            await asyncio.sleep(PeerConnection.TIMEOUT_CHECK_INTERVAL)
 
-                async for message in PeerStreamIterator(self.reader, buffer):
-                    if "stopped" in self.states:
-                        break
+            expired = self.pipeline.expired()
+            if expired:
+                logging.info("%d requests timed out", len(expired))
+                for index, begin in expired:
+                    self.piece_manager.release(self, index, begin)
+                self._request_pieces()
 
-                    logging.debug("Got message %s", message)
+    def cancel(self, index: int, begin: int, length: int):
+        """
+        Cancel a request because the block arrived from another peer
+        """
+        if self.pipeline.discard(index, begin) and self.protocol:
+            self._send(Cancel(index, begin, length))
 
-            except Exception as e:
-                self.stop()
-                raise e
+    def disconnect(self):
+        """
+        Drop the current peer, e.g. after it sent data that failed the hash check
+        """
+        if self.transport:
+            self.transport.close()
 
     def stop(self):
-        self.states.append("stopped")
-        if not self.future.done():
-            self.future.cancel()
+        self.stopped = True
+        self.disconnect()
 
     async def _handshake(self):
-        self.writer.write(Handshake(self.info_hash, self.peer_id).encode())
-        await self.writer.drain()
+        self._send(Handshake(self.info_hash, self.peer_id))
+        await self.protocol.drain()
+
+        if not await self.protocol.wait_for(Handshake.length):
+            raise ProtocolError("Unable receive and parse a handshake")
 
-        tries = 1
-        buffer = b""
-        while len(buffer) < Handshake.length and tries < 10:
-            tries += 1
-            buffer = await self.reader.read(PeerStreamIterator.CHUNK_SIZE)
+        buffer = self.protocol.buffer
+        response = Handshake.decode(buffer.view[buffer.start : buffer.start + Handshake.length])
+        buffer.consume(Handshake.length)
 
-        response = Handshake.decode(buffer[: Handshake.length])
         if not response:
             raise ProtocolError("Unable receive and parse a handshake")
         if not response.info_hash == self.info_hash:
             raise ProtocolError("Handshake with invalid info_hash")
 
         self.remote_id = response.peer_id
-        logging.info("Handshake with peer '%s' was successful", self.remote_id.decode())
+        self.remote_reserved = response.reserved
+        logging.info("Handshake with peer %s (%s) was successful", self, self.remote_id)
+
+
+class ReceiveBuffer:
+    """
+    Growable receive buffer that the transport reads straight into.
+
+    Unconsumed data lives in `data[start:end]` and is parsed in place. While `pinned` is set a
+    memoryview handed out to a consumer may still reference consumed bytes, so the buffer is
+    reallocated instead of compacted over them.
+    """
+
+    INITIAL_SIZE = 64 * 1024
+    MIN_READ_SIZE = 16 * 1024
+
+    def __init__(self, size: int = INITIAL_SIZE):
+        self.data = bytearray(size)
+        self.view = memoryview(self.data)
+        self.start = 0
+        self.end = 0
+        self.pinned = False
+
+    def __len__(self):
+        return self.end - self.start
+
+    def get_buffer(self, sizehint: int = -1) -> memoryview:
+        self.reserve(max(sizehint, ReceiveBuffer.MIN_READ_SIZE))
+        return self.view[self.end :]
+
+    def buffer_updated(self, nbytes: int):
+        self.end += nbytes
 
-        return buffer[Handshake.length :]
+    def consume(self, nbytes: int):
+        self.start += nbytes
+        if self.start == self.end and not self.pinned:
+            self.start = self.end = 0
 
-    async def _send_interested(self):
+    def release(self):
+        self.pinned = False
+        if self.start == self.end:
+            self.start = self.end = 0
 
-        logging.debug("Sending interested")
-        self.writer.write(Interested().encode())
-        await self.writer.drain()
-        logging.debug("Sent interested")
+    def reserve(self, nbytes: int):
+        """
+        Make sure at least `nbytes` can be written after the unconsumed data
+        """
+        if len(self.data) - self.end >= nbytes:
+            return
+
+        size = self.end - self.start
+        if size + nbytes <= len(self.data) and not self.pinned:
+            self.view[:size] = self.view[self.start : self.end]
+        else:
+            capacity = len(self.data)
+            while capacity < size + nbytes:
+                capacity *= 2
+
+            data = bytearray(capacity)
+            data[:size] = self.view[self.start : self.end]
+            self.data = data
+            self.view = memoryview(data)
+            self.pinned = False
+
+        self.start = 0
+        self.end = size
+
+
+class PeerProtocol(asyncio.BufferedProtocol):
+    """
+    Reading is paused while more than `HIGH_WATER` bytes wait to be parsed, and while the
+    download limit is exceeded until its tokens have been refilled.
+    """
+
+    HIGH_WATER = 1024 * 1024
+
+    def __init__(
+        self, limit: Optional[TokenBucket] = None, metrics: Optional[TorrentMetrics] = None
+    ):
+        self.buffer = ReceiveBuffer()
+        self.limit = limit
+        self.metrics = metrics
+        self.received = 0
+        self.sent = 0
+        self.transport: asyncio.Transport = None
+        self.closed = False
+        self.exception: Optional[Exception] = None
+
+        self._waiter: Optional[asyncio.Future] = None
+        self._drain_waiters: Deque[asyncio.Future] = deque()
+        self._reading_paused = False
+        self._buffer_full = False
+        self._throttled: Optional[asyncio.TimerHandle] = None
+        self._writing_paused = False
+
+        # small writes are queued and handed to the transport together once per loop
+        # iteration, and held back while the kernel sends a file
+        self.sendfile_available = False
+        self._sending_file = False
+        self._outgoing: List[bytes] = []
+        self._flush_scheduled = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+        # loops not based on asyncio's, e.g. uvloop, do not implement `loop.sendfile`
+        self.sendfile_available = (
+            transport.get_extra_info("socket") is not None
+            and transport.get_extra_info("sslcontext") is None
+            and isinstance(asyncio.get_running_loop(), asyncio.BaseEventLoop)
+        )
+
+    def get_buffer(self, sizehint):
+        return self.buffer.get_buffer(sizehint)
+
+    def buffer_updated(self, nbytes):
+        self.buffer.buffer_updated(nbytes)
+        self.received += nbytes
+        if self.metrics is not None:
+            self.metrics.received.inc(nbytes)
+
+        if len(self.buffer) > PeerProtocol.HIGH_WATER and not self._buffer_full:
+            self._buffer_full = True
+            self._update_reading()
+
+        if self.limit is not None and self._throttled is None:
+            delay = self.limit.consume(nbytes)
+            if delay > 0:
+                self._throttled = asyncio.get_running_loop().call_later(delay, self._unthrottle)
+                self._update_reading()
+
+        self._wakeup()
+
+    def eof_received(self):
+        self.closed = True
+        self._wakeup()
+        return False
+
+    def connection_lost(self, exc):
+        self.closed = True
+        self.exception = exc
+        if self._throttled:
+            self._throttled.cancel()
+            self._throttled = None
+        self._wakeup()
+        self._wake_drainers()
+
+    def pause_writing(self):
+        self._writing_paused = True
+
+    def resume_writing(self):
+        self._writing_paused = False
+        self._wake_drainers()
+
+    def _wake_drainers(self):
+        # the run loop and the upload task may both be waiting
+        while self._drain_waiters:
+            waiter = self._drain_waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def write(self, data: bytes):
+        self._outgoing.append(data)
+        self._schedule_flush()
+
+    def writelines(self, data: List[bytes]):
+        self._outgoing.extend(data)
+        self._schedule_flush()
+
+    def flush(self):
+        """
+        Hand everything queued to the transport in one `writelines`, which uses a single
+        scatter/gather send where the event loop supports it
+        """
+        self._flush_scheduled = False
+        if self._sending_file or not self._outgoing:
+            return
+
+        outgoing, self._outgoing = self._outgoing, []
+        if not self.closed:
+            self.transport.writelines(outgoing)
+            self._count_sent(sum(map(len, outgoing)))
+
+    def _count_sent(self, nbytes: int):
+        self.sent += nbytes
+        if self.metrics is not None:
+            self.metrics.sent.inc(nbytes)
+
+    def _schedule_flush(self):
+        if not self._flush_scheduled and not self._sending_file:
+            self._flush_scheduled = True
+            asyncio.get_running_loop().call_soon(self.flush)
+
+    async def sendfile(self, header: bytes, file, offset: int, count: int):
+        """
+        Write `header` followed by `count` bytes of `file` at `offset` straight from the page
+        cache. Raises `asyncio.SendfileNotAvailableError` when the transport does not allow it.
+        """
+        if self.closed:
+            raise ConnectionResetError("Connection lost")
+
+        self._outgoing.append(header)
+        self.flush()
+        self._sending_file = True
+        try:
+            await asyncio.get_running_loop().sendfile(
+                self.transport, file, offset, count, fallback=False
+            )
+            self._count_sent(count)
+        finally:
+            self._sending_file = False
+            self.flush()
+
+    async def drain(self):
+        if self.closed:
+            raise ConnectionResetError("Connection lost")
+
+        self.flush()
+
+        if self._writing_paused:
+            waiter = asyncio.get_running_loop().create_future()
+            self._drain_waiters.append(waiter)
+            try:
+                await waiter
+            finally:
+                if waiter in self._drain_waiters:
+                    self._drain_waiters.remove(waiter)
+
+    async def wait_for(self, nbytes: int) -> bool:
+        """
+        Wait until at least `nbytes` of unconsumed data are buffered, False if the peer closed
+        """
+        self.buffer.reserve(nbytes - len(self.buffer))
+
+        while len(self.buffer) < nbytes:
+            if self.closed:
+                return False
+
+            if self._buffer_full:
+                self._buffer_full = False
+                self._update_reading()
+
+            self._waiter = asyncio.get_running_loop().create_future()
+            try:
+                await self._waiter
+            finally:
+                self._waiter = None
+
+        return True
+
+    def _wakeup(self):
+        if self._waiter and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    def _unthrottle(self):
+        self._throttled = None
+        self._update_reading()
+
+    def _update_reading(self):
+        paused = self._buffer_full or self._throttled is not None
+        if paused == self._reading_paused or self.closed:
+            return
+
+        self._reading_paused = paused
+        if paused:
+            self.transport.pause_reading()
+        else:
+            self.transport.resume_reading()
 
 
 class PeerStreamIterator:
+    """
+    Parses framed messages in place from the protocol's receive buffer.
+
+    `Piece.data` is a memoryview into the receive buffer that stays valid until the next
+    message is requested.
+    """
 
-    CHUNK_SIZE = 10 * 1024
+    HEADER = struct.Struct(">I")
+    MAX_MESSAGE_LENGTH = 4 * 1024 * 1024
 
-    def __init__(self, reader: asyncio.StreamReader, buffer: bytes):
-        self.reader = reader
-        self.buffer = buffer or b""
+    def __init__(self, protocol: PeerProtocol):
+        self.protocol = protocol
+        self.buffer = protocol.buffer
 
     def __aiter__(self):
         return self
 
     async def __anext__(self):
+        self.buffer.release()
 
         while True:
             try:
-                data = await self.reader.read(PeerStreamIterator.CHUNK_SIZE)
-                logging.debug("Got %d bytes of data", len(data))
-                if data:
-                    self.buffer += data
-                    if message := self.parse():
-                        return message
-                else:
-                    if self.buffer:
-                        logging.debug("No data read from stream.")
-                        if message := self.parse():
-                            return message
+                if message := self.parse():
+                    return message
 
+                if not await self.protocol.wait_for(self._wanted()):
+                    logging.debug("Connection closed by peer")
                     raise StopAsyncIteration()
 
             except ConnectionResetError:
                 logging.debug("Connection closed by peer")
                 raise StopAsyncIteration()
 
-            except CancelledError:
-                raise StopAsyncIteration()
-
             except StopAsyncIteration:
                 raise
 
@@ -344,60 +1547,50 @@ class PeerStreamIterator:
                 logging.critical(e)
                 raise StopAsyncIteration()
 
+    def _wanted(self) -> int:
+        header_length = PeerStreamIterator.HEADER.size
+        if len(self.buffer) < header_length:
+            return header_length
+
+        return header_length + PeerStreamIterator.HEADER.unpack_from(
+            self.buffer.data, self.buffer.start
+        )[0]
+
     def parse(self):
-        header_length = 4
-        if len(self.buffer) > 4:
-            logging.debug("buffer: %s", self.buffer.hex())
-            message_length = struct.unpack(">I", self.buffer[0:4])[0]
-
-            if message_length == 0:
-                return KeepAlive()
-
-            if len(self.buffer) >= message_length:
-                message_id = struct.unpack(">b", self.buffer[4:5])[0]
-
-                logging.debug("Got message with id=%d", message_id)
-
-                def _consume():
-                    self.buffer = self.buffer[header_length + message_length :]
-
-                def _data():
-                    return self.buffer[: header_length + message_length]
-
-                if message_id == PeerMessage.Choke:
-                    _consume()
-                    return Choke()
-                elif message_id == PeerMessage.UnChoke:
-                    _consume()
-                    return UnChoke()
-                elif message_id == PeerMessage.Interested:
-                    _consume()
-                    return Interested()
-                elif message_id == PeerMessage.NotInterested:
-                    _consume()
-                    return NotInterested()
-                elif message_id == PeerMessage.Have:
-                    data = _data()
-                    _consume()
-                    return Have.decode(data)
-                elif message_id == PeerMessage.BitField:
-                    data = _data()
-                    _consume()
-                    return BitField.decode(data)
-                elif message_id == PeerMessage.Request:
-                    data = _data()
-                    _consume()
-                    return Request.decode(data)
-                elif message_id == PeerMessage.Piece:
-                    data = _data()
-                    _consume()
-                    return Piece.decode(data)
-                elif message_id == PeerMessage.Cancel:
-                    data = _data()
-                    _consume()
-                    return Cancel.decode(data)
-                else:
-                    logging.info("Unsupported message")
-            else:
-                logging.debug("Not enough in buffer in order to parse")
-        return None
+        header_length = PeerStreamIterator.HEADER.size
+        buffer = self.buffer
+
+        if len(buffer) < header_length:
+            return None
+
+        message_length = PeerStreamIterator.HEADER.unpack_from(buffer.data, buffer.start)[0]
+
+        if message_length == 0:
+            buffer.consume(header_length)
+            return KeepAlive()
+
+        if message_length > PeerStreamIterator.MAX_MESSAGE_LENGTH:
+            raise ProtocolError(f"Message of length {message_length} is too long")
+
+        if len(buffer) < header_length + message_length:
+            return None
+
+        start = buffer.start
+        message_id = buffer.data[start + header_length]
+        frame = buffer.view[start : start + header_length + message_length]
+        buffer.consume(header_length + message_length)
+
+        message_type = MESSAGE_TYPES[message_id] if message_id < len(MESSAGE_TYPES) else None
+        if message_type is None:
+            logging.info("Unsupported message with id=%d", message_id)
+            return None
+
+        if message_type.size is not None and message_type.size != len(frame):
+            raise ProtocolError(f"{message_type.__name__} of invalid length {message_length}")
+
+        if message_type is Piece:
+            if message_length < Piece.length:
+                raise ProtocolError(f"Piece of invalid length {message_length}")
+            buffer.pinned = True
+
+        return message_type.decode(frame)
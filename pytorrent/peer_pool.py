@@ -0,0 +1,468 @@
+import asyncio
+import heapq
+import logging
+import socket
+import time
+from collections import deque
+from typing import Deque, Dict, Iterable, List, Optional, Set, Tuple
+
+from .budget import SessionLimits
+from .choker import Choker
+from .merkle import HashTree
+from .metrics import TorrentMetrics
+from .peer_connection import Handshake, PeerConnection, ProtocolError
+from .peer_store import Address, Endpoint, PeerStore, encode_address
+from .piece_manager import PieceManager
+from .upload import Uploader
+from .verify import PieceVerifier
+
+
+class PeerPool:
+    """
+    Keeps up to `max_peers` connections for one torrent.
+
+    Candidates from the `PeerStore` are dialed in parallel, at most `max_half_open` at a time,
+    with connect and handshake timeouts so dead addresses cost seconds rather than a worker.
+    Addresses that fail are retried with exponential backoff and banned after repeated
+    failures. Every `OPTIMIZE_INTERVAL` the connections are scored on their download rate and,
+    while there are untried candidates, the slowest one is dropped to make room for a possibly
+    better peer. With `pex` connected peers exchange the addresses of their connections
+    (ut_pex), which are dialed like the ones from trackers. While other torrents wait for a
+    slot of the global connection budget, a pool holding more than its fair share stops dialing
+    and drops its slowest connections every `BALANCE_INTERVAL`.
+    """
+
+    MAX_PEERS = 50
+    MAX_HALF_OPEN = 16
+
+    BACKOFF = 30.0
+    MAX_BACKOFF = 30 * 60.0
+    MAX_FAILURES = 5
+    BAN_TIME = 60 * 60.0
+
+    OPTIMIZE_INTERVAL = 30.0
+    BALANCE_INTERVAL = 5.0
+    # connections younger than this are not swapped out, they had no chance to ramp up
+    GRACE_PERIOD = 30.0
+    # how often connections are checked for a due peer exchange, each is sent one a minute
+    PEX_TICK = 5.0
+
+    def __init__(
+        self,
+        info_hash: bytes,
+        peer_id: str,
+        piece_manager: PieceManager,
+        verifier: Optional[PieceVerifier] = None,
+        limits: Optional[SessionLimits] = None,
+        max_peers: int = MAX_PEERS,
+        max_half_open: int = MAX_HALF_OPEN,
+        uploader: Optional[Uploader] = None,
+        metrics: Optional[TorrentMetrics] = None,
+        pex: bool = True,
+        hash_tree: Optional[HashTree] = None,
+    ):
+        self.info_hash = info_hash
+        self.peer_id = peer_id
+        self.piece_manager = piece_manager
+        self.verifier = verifier
+        self.limits = limits or SessionLimits(self)
+        self.max_peers = max_peers
+        self.max_half_open = max_half_open
+        self.uploader = uploader
+        self.metrics = metrics
+        self.pex = pex
+        self.hash_tree = hash_tree
+        self.choker: Optional[Choker] = None
+
+        self.loop = asyncio.get_event_loop()
+        self.store = PeerStore()
+        # keyed by peer store slot
+        self.connections: Dict[int, PeerConnection] = {}
+        self.connecting: Set[int] = set()
+
+        self._candidates: Deque[int] = deque()
+        self._queued: Set[int] = set()
+        self._retries: List[Tuple[float, int]] = []
+        self._tasks: Set[asyncio.Task] = set()
+        self._changed = asyncio.Event()
+        self._downloaded: Dict[int, int] = {}
+
+        self._dialer: Optional[asyncio.Task] = None
+        self._optimizer: Optional[asyncio.Task] = None
+        self._balancer: Optional[asyncio.Task] = None
+        self._exchanger: Optional[asyncio.Task] = None
+
+    def __len__(self):
+        return len(self.connections)
+
+    @property
+    def candidates(self) -> int:
+        return len(self._candidates)
+
+    def start(self):
+        self._dialer = self.loop.create_task(self._dial())
+        self._optimizer = self.loop.create_task(self._optimize_periodically())
+        self._balancer = self.loop.create_task(self._balance_periodically())
+        if self.pex:
+            self._exchanger = self.loop.create_task(self._exchange_peers())
+
+    def stop(self):
+        tasks = (self._dialer, self._optimizer, self._balancer, self._exchanger, *self._tasks)
+        for task in tasks:
+            if task:
+                task.cancel()
+        for connection in self.connections.values():
+            connection.stop()
+
+    def add(
+        self,
+        addresses: Iterable[Address],
+        source: int = PeerStore.TRACKER,
+        now: Optional[float] = None,
+    ):
+        self._queue(self.store.add(addresses, source, now), now)
+
+    def add_endpoints(
+        self,
+        endpoints: Iterable[Endpoint],
+        source: int = PeerStore.TRACKER,
+        now: Optional[float] = None,
+    ):
+        """
+        Queue peers in compact form, e.g. `TrackerResponse.endpoints`
+        """
+        self._queue(self.store.add_endpoints(endpoints, source, now), now)
+
+    def _queue(self, slots: List[int], now: Optional[float]):
+        now = time.monotonic() if now is None else now
+        store = self.store
+        added = 0
+
+        for slot in slots:
+            if slot in self._queued or slot in self.connections or slot in self.connecting:
+                continue
+            # peers backing off are already scheduled, known ones keep their history
+            if store.retry_at[slot] > now or store.banned_until[slot] > now:
+                continue
+
+            self._candidates.append(slot)
+            self._queued.add(slot)
+            added += 1
+
+        if added:
+            self._changed.set()
+
+    def broadcast_have(self, index: int):
+        for connection in self.connections.values():
+            connection.send_have(index)
+            # peers left with nothing we need are told so
+            connection.update_interest()
+
+    def ban(self, address: Address, now: Optional[float] = None):
+        now = time.monotonic() if now is None else now
+        slot = self.store.add([address], PeerStore.INCOMING, now)[0]
+        self.store.banned_until[slot] = now + PeerPool.BAN_TIME
+        logging.info("Banned peer %s:%d", *address)
+
+        connection = self.connections.get(slot)
+        if connection:
+            connection.disconnect()
+
+    def is_banned(self, address: Address, now: Optional[float] = None) -> bool:
+        slot = self.store.slot(address)
+        now = time.monotonic() if now is None else now
+        return slot is not None and self.store.banned_until[slot] > now
+
+    def failed(self, slot: int, now: Optional[float] = None):
+        """
+        Record a failed attempt: back off exponentially, ban after `MAX_FAILURES` in a row
+        """
+        now = time.monotonic() if now is None else now
+        store = self.store
+        store.failures[slot] += 1
+
+        if store.failures[slot] >= PeerPool.MAX_FAILURES:
+            store.banned_until[slot] = now + PeerPool.BAN_TIME
+            store.failures[slot] = 0
+        else:
+            backoff = PeerPool.BACKOFF * 2 ** (store.failures[slot] - 1)
+            self._retry_at(slot, now + min(backoff, PeerPool.MAX_BACKOFF))
+
+    def optimize(self, now: Optional[float] = None) -> Optional[PeerConnection]:
+        """
+        Score every connection on its rate since the last call and drop the slowest one if a
+        candidate is waiting for its slot
+        """
+        now = time.monotonic() if now is None else now
+        store = self.store
+        slowest: Optional[int] = None
+
+        for slot, connection in self.connections.items():
+            downloaded = connection.downloaded - self._downloaded.get(slot, 0)
+            self._downloaded[slot] = connection.downloaded
+            score = downloaded / PeerPool.OPTIMIZE_INTERVAL / (1 + store.failures[slot])
+            store.score[slot] = score
+
+            if connection.connected_at is None:
+                continue
+            if now - connection.connected_at < PeerPool.GRACE_PERIOD:
+                continue
+            if slowest is None or score < store.score[slowest]:
+                slowest = slot
+
+        full = len(self.connections) + len(self.connecting) >= self.max_peers
+        if not full or not self._candidates or self.piece_manager.complete or slowest is None:
+            return None
+
+        connection = self.connections[slowest]
+        logging.info("Replacing slowest peer %s", connection)
+        self._retry_at(slowest, now + PeerPool.BACKOFF)
+        connection.disconnect()
+        return connection
+
+    def balance(self, now: Optional[float] = None) -> List[PeerConnection]:
+        """
+        Drop the slowest connections held beyond our fair share of the global connection budget
+        while other torrents wait for a slot
+        """
+        excess = self.limits.excess_connections()
+        if not excess:
+            return []
+
+        now = time.monotonic() if now is None else now
+        slots = sorted(self.connections, key=lambda slot: self.store.score[slot])[:excess]
+        logging.info("Dropping %d connections for other torrents", len(slots))
+
+        dropped = []
+        for slot in slots:
+            connection = self.connections[slot]
+            self._retry_at(slot, now + PeerPool.BACKOFF)
+            connection.disconnect()
+            dropped.append(connection)
+        return dropped
+
+    # dialing
+
+    def _next_candidate(self, now: float) -> Optional[int]:
+        while self._retries and self._retries[0][0] <= now:
+            _, slot = heapq.heappop(self._retries)
+            if slot not in self._queued:
+                self._candidates.append(slot)
+                self._queued.add(slot)
+
+        while self._candidates:
+            slot = self._candidates.popleft()
+            self._queued.discard(slot)
+            if slot in self.connections or slot in self.connecting:
+                continue
+            if self.store.banned_until[slot] > now:
+                continue
+            return slot
+
+        return None
+
+    def _retry_at(self, slot: int, when: float):
+        self.store.retry_at[slot] = when
+        heapq.heappush(self._retries, (when, slot))
+
+    async def _dial(self):
+        while True:
+            now = time.monotonic()
+            while (
+                len(self.connections) + len(self.connecting) < self.max_peers
+                and len(self.connecting) < self.max_half_open
+                and not self.limits.excess_connections()
+            ):
+                slot = self._next_candidate(now)
+                if slot is None:
+                    break
+
+                self.connecting.add(slot)
+                task = self.loop.create_task(self._connect(slot))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+
+            self._changed.clear()
+            full = (
+                len(self.connections) + len(self.connecting) >= self.max_peers
+                or len(self.connecting) >= self.max_half_open
+            )
+            # with free slots every due retry has been dialed, the first one left is in the future
+            timeout = self._retries[0][0] - now if self._retries and not full else None
+            try:
+                await asyncio.wait_for(self._changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def accept(
+        self, sock: socket.socket, handshake: Handshake, now: Optional[float] = None
+    ) -> bool:
+        """
+        Take an incoming connection, False when it is refused: it is for another torrent, the
+        peer is banned or already connected, or there is no room for another connection
+        """
+        address = sock.getpeername()[:2]
+        if handshake.info_hash != self.info_hash:
+            return False
+        if self.is_banned(address, now) or self.limits.connections.full:
+            return False
+        if len(self.connections) + len(self.connecting) >= self.max_peers:
+            return False
+
+        slot = self.store.add([address], PeerStore.INCOMING, now)[0]
+        if slot in self.connections or slot in self.connecting:
+            return False
+
+        self.connecting.add(slot)
+        task = self.loop.create_task(self._accept(slot, sock, handshake))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return True
+
+    async def _accept(self, slot: int, sock: socket.socket, handshake: Handshake):
+        connection = self._new_connection(slot)
+        try:
+            async with self.limits.connection():
+                try:
+                    await asyncio.wait_for(
+                        connection.accept(sock, handshake), PeerConnection.HANDSHAKE_TIMEOUT
+                    )
+                except (OSError, asyncio.TimeoutError) as e:
+                    logging.debug("Unable to accept %s: %s", connection, e or type(e).__name__)
+                    return
+                finally:
+                    self.connecting.discard(slot)
+
+                self.connections[slot] = connection
+                self._changed.set()
+                # the address is the ephemeral port the peer dialed from, it is not retried
+                await self._run(slot, connection, retry=False)
+
+        finally:
+            self._closed(slot, connection)
+            if connection.transport is None:
+                sock.close()
+
+    def _new_connection(self, slot: int) -> PeerConnection:
+        download_limit, upload_limit = self.limits.peer_buckets()
+        return PeerConnection(
+            self.store.address(slot),
+            self.info_hash,
+            self.peer_id,
+            self.piece_manager,
+            self.loop,
+            self.verifier,
+            self.uploader,
+            self.choker,
+            download_limit,
+            upload_limit,
+            self.metrics,
+            pex=self.pex,
+            on_peers=self._on_pex_peers,
+            hash_tree=self.hash_tree,
+        )
+
+    async def _connect(self, slot: int):
+        connection = self._new_connection(slot)
+        try:
+            async with self.limits.connection():
+                try:
+                    async with self.limits.connecting():
+                        await connection.connect()
+                except (OSError, asyncio.TimeoutError, ProtocolError) as e:
+                    logging.debug("Unable to connect to %s: %s", connection, e or type(e).__name__)
+                    self._connect_outcome(_outcome(e))
+                    self.failed(slot)
+                    return
+                finally:
+                    self.connecting.discard(slot)
+
+                self._connect_outcome("connected")
+
+                self.connections[slot] = connection
+                self._changed.set()
+                await self._run(slot, connection)
+
+        finally:
+            self._closed(slot, connection)
+
+    def _closed(self, slot: int, connection: PeerConnection):
+        self.connecting.discard(slot)
+        self.connections.pop(slot, None)
+        self._downloaded.pop(slot, None)
+        connection.disconnect()
+        self._changed.set()
+
+    def _on_pex_peers(self, endpoints: List[Endpoint]):
+        self.add_endpoints(endpoints, PeerStore.PEX)
+
+    def exchange_peers(self, now: Optional[float] = None):
+        """
+        Send every peer our connections, only those others can connect to
+        """
+        connected = set()
+        reachable = set()
+        for connection in self.connections.values():
+            address = connection.listen_address
+            if address is None:
+                continue
+            endpoint = encode_address(address)
+            connected.add(endpoint)
+            if not connection.incoming:
+                reachable.add(endpoint)
+
+        for connection in self.connections.values():
+            connection.send_pex(connected, now, reachable)
+
+    def _connect_outcome(self, outcome: str):
+        if self.metrics is not None:
+            self.metrics.connect_attempt(outcome)
+
+    async def _run(self, slot: int, connection: PeerConnection, retry: bool = True):
+        try:
+            await connection.run()
+        except (OSError, ProtocolError) as e:
+            logging.info("Connection to %s lost: %s", connection, e)
+        except Exception:
+            # a bug triggered by one peer must not take the others down
+            logging.exception("Connection to %s failed", connection)
+
+        if not retry:
+            return
+        if connection.downloaded or self.piece_manager.complete:
+            self.store.failures[slot] = 0
+        else:
+            self.failed(slot)
+            return
+
+        # productive peers come back after the shortest backoff, unless they were swapped out
+        now = time.monotonic()
+        if self.store.retry_at[slot] <= now:
+            self._retry_at(slot, now + PeerPool.BACKOFF)
+
+    async def _optimize_periodically(self):
+        while True:
+            await asyncio.sleep(PeerPool.OPTIMIZE_INTERVAL)
+            self.optimize()
+
+    async def _balance_periodically(self):
+        while True:
+            await asyncio.sleep(PeerPool.BALANCE_INTERVAL)
+            self.balance()
+            # dialing stops while over the share, it resumes once the others are served
+            self._changed.set()
+
+    async def _exchange_peers(self):
+        while True:
+            await asyncio.sleep(PeerPool.PEX_TICK)
+            self.exchange_peers()
+
+
+def _outcome(error: BaseException) -> str:
+    if isinstance(error, asyncio.TimeoutError):
+        return "timeout"
+    if isinstance(error, ConnectionRefusedError):
+        return "refused"
+    if isinstance(error, ProtocolError):
+        return "handshake_failed"
+    return "error"
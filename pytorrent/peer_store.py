@@ -0,0 +1,108 @@
+import socket
+import struct
+import time
+from array import array
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+
+Address = Tuple[str, int]
+# compact form of an address: 4 or 16 address bytes and the port in network order, or the
+# address itself when the peer was given by host name
+Endpoint = Union[bytes, Address]
+
+COMPACT_SIZE = 6
+COMPACT6_SIZE = 18
+
+
+def split_compact(data: bytes, size: int = COMPACT_SIZE) -> List[bytes]:
+    """
+    Split a compact peer blob (`peers` or `peers6`) into one endpoint per peer
+    """
+    data = memoryview(data)[: len(data) // size * size]
+    return [endpoint for (endpoint,) in struct.iter_unpack(f"{size}s", data)]
+
+
+def encode_address(address: Address) -> Endpoint:
+    ip, port = address
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            return socket.inet_pton(family, ip) + port.to_bytes(2, "big")
+        except OSError:
+            pass
+    return address
+
+
+def decode_endpoint(endpoint: Endpoint) -> Address:
+    if not isinstance(endpoint, bytes):
+        return endpoint
+    family = socket.AF_INET if len(endpoint) == COMPACT_SIZE else socket.AF_INET6
+    return socket.inet_ntop(family, endpoint[:-2]), int.from_bytes(endpoint[-2:], "big")
+
+
+class PeerStore:
+    """
+    Every peer address learned for one torrent, from any tracker, announce or peer.
+
+    Addresses are kept in the compact form trackers send and are only turned into
+    `(ip, port)` tuples when dialed. Each address gets a slot on first sight, the per peer
+    state lives in parallel arrays indexed by that slot, so tens of thousands of candidates
+    cost a few dozen bytes each and an announce only touches a dictionary per peer.
+    """
+
+    TRACKER = 1
+    PEX = 2
+    INCOMING = 4
+
+    def __init__(self):
+        self.endpoints: List[Endpoint] = []
+        self.last_seen = array("d")
+        self.retry_at = array("d")
+        self.banned_until = array("d")
+        self.score = array("d")
+        self.failures = array("H")
+        self.sources = array("B")
+
+        self._slots: Dict[Endpoint, int] = {}
+
+    def __len__(self):
+        return len(self.endpoints)
+
+    def __contains__(self, address: Address) -> bool:
+        return encode_address(address) in self._slots
+
+    def slot(self, address: Address) -> Optional[int]:
+        return self._slots.get(encode_address(address))
+
+    def address(self, slot: int) -> Address:
+        return decode_endpoint(self.endpoints[slot])
+
+    def add(
+        self, addresses: Iterable[Address], source: int, now: Optional[float] = None
+    ) -> List[int]:
+        return self.add_endpoints(map(encode_address, addresses), source, now)
+
+    def add_endpoints(
+        self, endpoints: Iterable[Endpoint], source: int, now: Optional[float] = None
+    ) -> List[int]:
+        """
+        Add or refresh addresses, returns their slots
+        """
+        now = time.monotonic() if now is None else now
+        slots = []
+
+        for endpoint in endpoints:
+            slot = self._slots.get(endpoint)
+            if slot is None:
+                slot = self._slots[endpoint] = len(self.endpoints)
+                self.endpoints.append(endpoint)
+                self.last_seen.append(now)
+                self.retry_at.append(0.0)
+                self.banned_until.append(0.0)
+                self.score.append(0.0)
+                self.failures.append(0)
+                self.sources.append(source)
+            else:
+                self.last_seen[slot] = now
+                self.sources[slot] |= source
+            slots.append(slot)
+
+        return slots
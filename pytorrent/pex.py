@@ -0,0 +1,146 @@
+import time
+from typing import Container, Dict, Iterable, List, Optional, Set, Tuple
+
+from .bcode import BDecodeError, bdecode, bencode
+from .peer_store import COMPACT6_SIZE, COMPACT_SIZE, Endpoint, split_compact
+
+# extended message id of the extension handshake (BEP 10)
+EXTENDED_HANDSHAKE = 0
+
+UT_PEX = b"ut_pex"
+
+# ids peers use for the extension messages they send us
+LOCAL_EXTENSIONS = {UT_PEX: 1}
+
+CLIENT_VERSION = b"pytorrent 0.0.1"
+
+# added.f flag of peers we connected to ourselves, so they accept incoming connections
+FLAG_REACHABLE = 0x10
+
+
+def encode_handshake(extensions: Dict[bytes, int], max_requests: Optional[int] = None) -> bytes:
+    handshake = {"m": extensions, "v": CLIENT_VERSION}
+    if max_requests:
+        handshake["reqq"] = max_requests
+    return bencode(handshake)
+
+
+def decode_handshake(payload: bytes) -> Dict[bytes, int]:
+    """
+    Extension names and the ids the peer wants them sent with, id 0 means disabled
+    """
+    try:
+        handshake = bdecode(payload)
+    except BDecodeError:
+        return {}
+
+    extensions = handshake.get(b"m") if isinstance(handshake, dict) else None
+    if not isinstance(extensions, dict):
+        return {}
+
+    return {
+        bytes(name): extension_id
+        for name, extension_id in extensions.items()
+        if isinstance(extension_id, int) and 0 <= extension_id < 256
+    }
+
+
+def decode_listen_port(payload: bytes) -> Optional[int]:
+    """
+    The port the peer accepts connections on (`p`), None if it did not tell
+    """
+    try:
+        handshake = bdecode(payload)
+    except BDecodeError:
+        return None
+
+    port = handshake.get(b"p") if isinstance(handshake, dict) else None
+    return port if isinstance(port, int) and 0 < port < 65536 else None
+
+
+def encode_pex(
+    added: Iterable[Endpoint], dropped: Iterable[Endpoint], reachable: Container[Endpoint] = ()
+) -> bytes:
+    """
+    Only the added peers in `reachable`, those we connected to, are flagged as reachable
+    """
+    added = [endpoint for endpoint in added if isinstance(endpoint, bytes)]
+    dropped = [endpoint for endpoint in dropped if isinstance(endpoint, bytes)]
+
+    message = {}
+    for key, size, endpoints in (
+        ("added", COMPACT_SIZE, added),
+        ("added6", COMPACT6_SIZE, added),
+        ("dropped", COMPACT_SIZE, dropped),
+        ("dropped6", COMPACT6_SIZE, dropped),
+    ):
+        endpoints = [endpoint for endpoint in endpoints if len(endpoint) == size]
+        message[key] = b"".join(endpoints)
+        if key.startswith("added"):
+            message[key + ".f"] = bytes(
+                FLAG_REACHABLE if endpoint in reachable else 0 for endpoint in endpoints
+            )
+
+    return bencode(message)
+
+
+def decode_pex(payload: bytes) -> Tuple[List[Endpoint], List[Endpoint]]:
+    """
+    The added and dropped endpoints of a ut_pex message
+    """
+    try:
+        message = bdecode(payload)
+    except BDecodeError:
+        return [], []
+    if not isinstance(message, dict):
+        return [], []
+
+    def _endpoints(key: bytes, size: int) -> List[Endpoint]:
+        value = message.get(key)
+        return split_compact(value, size) if isinstance(value, bytes) else []
+
+    added = _endpoints(b"added", COMPACT_SIZE) + _endpoints(b"added6", COMPACT6_SIZE)
+    dropped = _endpoints(b"dropped", COMPACT_SIZE) + _endpoints(b"dropped6", COMPACT6_SIZE)
+    return added, dropped
+
+
+class PeerExchange:
+    """
+    What one peer has been told about our connections. Every `INTERVAL` it gets the peers
+    connected and disconnected since, at most `MAX_PEERS` of each per message (BEP 11).
+    """
+
+    INTERVAL = 60.0
+    MAX_PEERS = 50
+    # added peers taken from one incoming message
+    MAX_RECEIVED = 200
+
+    def __init__(self):
+        self.sent: Set[Endpoint] = set()
+        self.last_sent: Optional[float] = None
+
+    def due(self, now: Optional[float] = None) -> bool:
+        now = time.monotonic() if now is None else now
+        return self.last_sent is None or now - self.last_sent >= PeerExchange.INTERVAL
+
+    def update(
+        self,
+        connected: Set[Endpoint],
+        now: Optional[float] = None,
+        reachable: Container[Endpoint] = (),
+    ) -> Optional[bytes]:
+        """
+        The next ut_pex payload for a peer, None when nothing changed
+        """
+        self.last_sent = time.monotonic() if now is None else now
+
+        added = [endpoint for endpoint in connected if endpoint not in self.sent]
+        dropped = [endpoint for endpoint in self.sent if endpoint not in connected]
+        added = added[: PeerExchange.MAX_PEERS]
+        dropped = dropped[: PeerExchange.MAX_PEERS]
+        if not added and not dropped:
+            return None
+
+        self.sent.update(added)
+        self.sent.difference_update(dropped)
+        return encode_pex(added, dropped, reachable)
@@ -0,0 +1,568 @@
+import logging
+import random
+import time
+from array import array
+from typing import Dict, Hashable, List, Optional, Set, Tuple
+
+BLOCK_SIZE = 2 ** 14
+
+BlockRequest = Tuple[int, int, int]
+
+_BITS = tuple(tuple(bit for bit in range(8) if byte & (0x80 >> bit)) for byte in range(256))
+
+
+class Bitfield:
+    """
+    Fixed size set of piece indexes stored as a BitTorrent bitfield (MSB first)
+    """
+
+    __slots__ = ("data", "length", "count")
+
+    def __init__(self, length: int, data: Optional[bytes] = None):
+        self.length = length
+        self.data = bytearray((length + 7) // 8)
+
+        if data is not None:
+            size = min(len(self.data), len(data))
+            self.data[:size] = data[:size]
+            if length % 8:
+                self.data[-1] &= (0xFF00 >> (length % 8)) & 0xFF
+
+        self.count = bin(int.from_bytes(self.data, "big")).count("1")
+
+    def __contains__(self, index: int) -> bool:
+        return bool(self.data[index >> 3] & (0x80 >> (index & 7)))
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for byte_index, byte in enumerate(self.data):
+            if byte:
+                base = byte_index << 3
+                for bit in _BITS[byte]:
+                    yield base + bit
+
+    def add(self, index: int) -> bool:
+        mask = 0x80 >> (index & 7)
+        if self.data[index >> 3] & mask:
+            return False
+
+        self.data[index >> 3] |= mask
+        self.count += 1
+        return True
+
+    def discard(self, index: int) -> bool:
+        mask = 0x80 >> (index & 7)
+        if not self.data[index >> 3] & mask:
+            return False
+
+        self.data[index >> 3] &= ~mask & 0xFF
+        self.count -= 1
+        return True
+
+    def all(self) -> bool:
+        return self.count == self.length
+
+    def missing_from(self, other: "Bitfield") -> bool:
+        """
+        True if this bitfield has any piece that `other` does not
+        """
+        return bool(int.from_bytes(self.data, "big") & ~int.from_bytes(other.data, "big"))
+
+    def to_bytes(self) -> bytes:
+        return bytes(self.data)
+
+
+class _PieceProgress:
+
+    FREE = 0
+    REQUESTED = 1
+    RECEIVED = 2
+
+    __slots__ = ("index", "length", "states", "owners", "received", "data", "contributors")
+
+    def __init__(self, index: int, length: int, block_size: int):
+        block_count = (length + block_size - 1) // block_size
+
+        self.index = index
+        self.length = length
+        self.states = bytearray(block_count)
+        self.owners: Dict[int, Set[Hashable]] = {}
+        self.received = 0
+        self.data = bytearray(length)
+        self.contributors: Set[Hashable] = set()
+
+    @property
+    def complete(self) -> bool:
+        return self.received == len(self.states)
+
+
+class PieceManager:
+    """
+    Decides which blocks to request from which peer.
+
+    Availability is kept as one counter per piece; peers that have every piece are only counted
+    in `seeds`. Pieces nobody asked for yet are kept in buckets by availability so the rarest
+    piece a peer has can be found without scanning every piece. Large bitfields only update the
+    counters and the buckets are rebuilt at most every `REBUILD_INTERVAL` seconds. The pieces
+    of peers that have fewer than one in `SPARSE_RATIO` are also kept as a set, their rarest
+    piece is picked from it rather than by scanning buckets they have little of.
+
+    Hash failures are counted per peer address, so a peer does not start over by reconnecting
+    and the counts do not keep closed connections alive.
+
+    Once every missing piece is in progress the manager switches to endgame and hands out blocks
+    that are already requested from other peers, the duplicates are cancelled when the first
+    copy arrives.
+    """
+
+    ENDGAME_DUPLICATES = 2
+    REBUILD_INTERVAL = 1.0
+    SPARSE_RATIO = 16
+
+    def __init__(
+        self, piece_count: int, piece_length: int, total_length: int, block_size: int = BLOCK_SIZE
+    ):
+        self.piece_count = piece_count
+        self.piece_length = piece_length
+        self.total_length = total_length
+        self.block_size = block_size
+
+        self.have = Bitfield(piece_count)
+        self.availability = array("I", bytes(4 * piece_count))
+        self.seeds = 0
+        # keyed by peer address
+        self.hash_failures: Dict[Hashable, int] = {}
+
+        self._peers: Dict[Hashable, Optional[Bitfield]] = {}
+        self._sparse: Dict[Hashable, Set[int]] = {}
+        self._buckets: List[List[int]] = [list(range(piece_count))]
+        self._bucket_of = array("i", bytes(4 * piece_count))
+        self._positions = array("i", range(piece_count))
+        self._unstarted = piece_count
+        self._dirty = False
+        self._rebuilt_at = 0.0
+
+        self._active: Dict[int, _PieceProgress] = {}
+        self._partial: Dict[int, _PieceProgress] = {}
+
+    @classmethod
+    def from_torrent(cls, torrent, block_size: int = BLOCK_SIZE) -> "PieceManager":
+        return cls(
+            torrent.info.piece_count, torrent.info.piece_length, torrent.total_size, block_size
+        )
+
+    @property
+    def complete(self) -> bool:
+        return self.have.all()
+
+    @property
+    def endgame(self) -> bool:
+        return not self._unstarted and not self._partial
+
+    def piece_size(self, index: int) -> int:
+        if index == self.piece_count - 1:
+            return self.total_length - index * self.piece_length
+        return self.piece_length
+
+    def peer_availability(self, index: int) -> int:
+        return self.availability[index] + self.seeds
+
+    # peers
+
+    def add_peer(self, peer: Hashable):
+        if peer not in self._peers:
+            self._peers[peer] = Bitfield(self.piece_count)
+            self._sparse[peer] = set()
+
+    def remove_peer(self, peer: Hashable):
+        self._forget_pieces(peer)
+
+        for progress in list(self._active.values()):
+            for block, owners in list(progress.owners.items()):
+                if peer in owners:
+                    self._release_block(progress, block, peer)
+
+    def _forget_pieces(self, peer: Hashable):
+        if peer not in self._peers:
+            return
+
+        pieces = self._peers.pop(peer)
+        self._sparse.pop(peer, None)
+        if pieces is None:
+            self.seeds -= 1
+        else:
+            self._update_availability(pieces, -1)
+
+    def peer_bitfield(self, peer: Hashable, data: bytes):
+        self._forget_pieces(peer)
+
+        pieces = Bitfield(self.piece_count, data)
+        if pieces.all():
+            self.peer_have_all(peer)
+            return
+
+        self._peers[peer] = pieces
+        if len(pieces) * PieceManager.SPARSE_RATIO < self.piece_count:
+            self._sparse[peer] = set(pieces)
+        self._update_availability(pieces, 1)
+
+    def peer_have_all(self, peer: Hashable):
+        self._forget_pieces(peer)
+        self._peers[peer] = None
+        self.seeds += 1
+
+    def peer_have_none(self, peer: Hashable):
+        self._forget_pieces(peer)
+        self._peers[peer] = Bitfield(self.piece_count)
+        self._sparse[peer] = set()
+
+    def peer_have(self, peer: Hashable, index: int):
+        if not 0 <= index < self.piece_count:
+            raise ValueError(f"Invalid piece index {index}")
+
+        self.add_peer(peer)
+        pieces = self._peers[peer]
+        if pieces is not None and pieces.add(index):
+            self.availability[index] += 1
+            self._move(index)
+
+            sparse = self._sparse.get(peer)
+            if sparse is not None:
+                sparse.add(index)
+                if len(sparse) * PieceManager.SPARSE_RATIO >= self.piece_count:
+                    del self._sparse[peer]
+
+    def peer_has(self, peer: Hashable, index: int) -> bool:
+        pieces = self._peers.get(peer, False)
+        return pieces is None or (pieces is not False and index in pieces)
+
+    def is_interesting(self, peer: Hashable) -> bool:
+        if peer not in self._peers:
+            return False
+
+        pieces = self._peers[peer]
+        if pieces is None:
+            return not self.complete
+        return pieces.missing_from(self.have)
+
+    # picking
+
+    def next_requests(
+        self, peer: Hashable, count: int, allowed: Optional[Set[int]] = None
+    ) -> List[BlockRequest]:
+        """
+        Pick up to `count` blocks to request from `peer`, partially downloaded pieces first.
+        `allowed` limits the pieces, e.g. to the allowed fast set of a peer that chokes us.
+        """
+        requests: List[BlockRequest] = []
+
+        for progress in list(self._partial.values()):
+            if len(requests) >= count:
+                return requests
+            if allowed is not None and progress.index not in allowed:
+                continue
+            if self.peer_has(peer, progress.index):
+                self._take_free_blocks(progress, peer, count, requests)
+
+        while len(requests) < count:
+            if allowed is None:
+                index = self._pick_rarest(peer)
+            else:
+                index = self._pick_allowed(peer, allowed)
+            if index is None:
+                break
+
+            progress = self._active[index] = self._partial[index] = _PieceProgress(
+                index, self.piece_size(index), self.block_size
+            )
+            self._take_free_blocks(progress, peer, count, requests)
+
+        if len(requests) < count and self.endgame:
+            self._take_endgame_blocks(peer, count, requests, allowed)
+
+        return requests
+
+    def _take_free_blocks(self, progress: _PieceProgress, peer, count, requests):
+        states = progress.states
+        block = states.find(_PieceProgress.FREE)
+
+        while block != -1 and len(requests) < count:
+            states[block] = _PieceProgress.REQUESTED
+            progress.owners[block] = {peer}
+            requests.append(self._block_request(progress, block))
+            block = states.find(_PieceProgress.FREE, block + 1)
+
+        if block == -1:
+            del self._partial[progress.index]
+
+    def _take_endgame_blocks(self, peer, count, requests, allowed=None):
+        for progress in self._active.values():
+            if allowed is not None and progress.index not in allowed:
+                continue
+            if not self.peer_has(peer, progress.index):
+                continue
+
+            for block, owners in progress.owners.items():
+                if len(requests) >= count:
+                    return
+                if peer not in owners and len(owners) < PieceManager.ENDGAME_DUPLICATES:
+                    owners.add(peer)
+                    requests.append(self._block_request(progress, block))
+
+    def _block_request(self, progress: _PieceProgress, block: int) -> BlockRequest:
+        begin = block * self.block_size
+        return progress.index, begin, min(self.block_size, progress.length - begin)
+
+    def _pick_allowed(self, peer: Hashable, allowed: Set[int]) -> Optional[int]:
+        for index in sorted(allowed):
+            # still in a bucket means neither downloaded nor started
+            if self._positions[index] >= 0 and self.peer_has(peer, index):
+                self._remove_from_bucket(index)
+                return index
+        return None
+
+    def _pick_rarest(self, peer: Hashable) -> Optional[int]:
+        pieces = self._peers.get(peer, False)
+        if pieces is False:
+            return None
+
+        sparse = self._sparse.get(peer)
+        if sparse is not None:
+            return self._pick_sparse(sparse)
+
+        if self._dirty and time.monotonic() - self._rebuilt_at > PieceManager.REBUILD_INTERVAL:
+            self._rebuild()
+
+        # pieces of bucket 0 are only available from seeds, unless the buckets are stale
+        first = 0 if pieces is None or self._dirty else 1
+        for bucket in self._buckets[first:]:
+            size = len(bucket)
+            if not size:
+                continue
+
+            offset = random.randrange(size)
+            for i in range(size):
+                index = bucket[(offset + i) % size]
+                if pieces is None or index in pieces:
+                    self._remove_from_bucket(index)
+                    return index
+
+        return None
+
+    def _pick_sparse(self, pieces: Set[int]) -> Optional[int]:
+        # the counters are exact even while the buckets are stale
+        pieces.difference_update([index for index in pieces if index in self.have])
+        candidates = [index for index in pieces if self._positions[index] >= 0]
+        if not candidates:
+            return None
+
+        index = min(candidates, key=lambda i: (self.availability[i], random.random()))
+        self._remove_from_bucket(index)
+        return index
+
+    # block results
+
+    def block_received(
+        self, peer: Hashable, index: int, begin: int, data: bytes
+    ) -> Tuple[bool, List[Tuple[Hashable, BlockRequest]]]:
+        """
+        Store a received block, returns whether the piece is now complete together with the
+        duplicate requests other peers should be sent a `Cancel` for
+        """
+        progress = self._active.get(index)
+        if progress is None or begin % self.block_size:
+            return False, []
+
+        block = begin // self.block_size
+        if block >= len(progress.states) or progress.states[block] == _PieceProgress.RECEIVED:
+            return False, []
+
+        request = self._block_request(progress, block)
+        if len(data) != request[2]:
+            logging.debug("Block %d:%d has invalid length %d", index, begin, len(data))
+            return False, []
+
+        progress.data[begin : begin + len(data)] = data
+        progress.states[block] = _PieceProgress.RECEIVED
+        progress.received += 1
+        progress.contributors.add(peer)
+
+        owners = progress.owners.pop(block, set())
+        owners.discard(peer)
+
+        return progress.complete, [(other, request) for other in owners]
+
+    def release(self, peer: Hashable, index: int, begin: int):
+        """
+        Give back a request that timed out, was rejected or dropped because of a choke
+        """
+        progress = self._active.get(index)
+        if progress is not None:
+            self._release_block(progress, begin // self.block_size, peer)
+
+    def block_failed(self, peer: Hashable, index: int, begin: int) -> int:
+        """
+        Give back a block that failed its hash check (v2), returns the hash failures of the peer
+        """
+        self.release(peer, index, begin)
+        return self._hash_failed(peer)
+
+    def peer_hash_failures(self, peer: Hashable) -> int:
+        return self.hash_failures.get(_address(peer), 0)
+
+    def _hash_failed(self, peer: Hashable) -> int:
+        address = _address(peer)
+        self.hash_failures[address] = self.hash_failures.get(address, 0) + 1
+        return self.hash_failures[address]
+
+    def _release_block(self, progress: _PieceProgress, block: int, peer: Hashable):
+        owners = progress.owners.get(block)
+        if owners is None or peer not in owners:
+            return
+
+        owners.discard(peer)
+        if not owners:
+            del progress.owners[block]
+            progress.states[block] = _PieceProgress.FREE
+            self._partial[progress.index] = progress
+
+            if not progress.received and not progress.owners:
+                del self._active[progress.index]
+                del self._partial[progress.index]
+                self._add_to_bucket(progress.index)
+
+    def piece_data(self, index: int) -> bytearray:
+        return self._active[index].data
+
+    def piece_verified(self, index: int, valid: bool) -> Set[Hashable]:
+        """
+        Record the hash check result of a completed piece, returns the peers that supplied it
+        """
+        progress = self._active.pop(index)
+        self._partial.pop(index, None)
+
+        if valid:
+            self.have.add(index)
+        else:
+            for peer in progress.contributors:
+                self._hash_failed(peer)
+            self._add_to_bucket(index)
+
+        return progress.contributors
+
+    def partial_pieces(self) -> Dict[int, Tuple[Bitfield, memoryview]]:
+        """
+        Received blocks of every piece in progress, as a block bitfield and the piece buffer
+        """
+        partial = {}
+
+        for index, progress in self._active.items():
+            if not progress.received:
+                continue
+
+            blocks = Bitfield(len(progress.states))
+            for block, state in enumerate(progress.states):
+                if state == _PieceProgress.RECEIVED:
+                    blocks.add(block)
+            partial[index] = (blocks, memoryview(progress.data))
+
+        return partial
+
+    def restore_partial(self, index: int, blocks: Bitfield, data: bytes) -> bool:
+        """
+        Resume a piece from previously saved blocks, returns whether the piece is complete
+        """
+        if index in self.have or index in self._active:
+            return False
+
+        progress = _PieceProgress(index, self.piece_size(index), self.block_size)
+        for block in blocks:
+            if block < len(progress.states):
+                progress.states[block] = _PieceProgress.RECEIVED
+                progress.received += 1
+
+        if not progress.received:
+            return False
+
+        progress.data[:] = data[: progress.length]
+        self._remove_from_bucket(index)
+        self._active[index] = progress
+        if not progress.complete:
+            self._partial[index] = progress
+
+        return progress.complete
+
+    def mark_have(self, index: int):
+        """
+        Mark a piece as already present, e.g. from resume data
+        """
+        self._active.pop(index, None)
+        self._partial.pop(index, None)
+        self._remove_from_bucket(index)
+        self.have.add(index)
+
+    # buckets
+
+    def _update_availability(self, pieces: Bitfield, delta: int):
+        if len(pieces) * 64 < self.piece_count:
+            for index in pieces:
+                self.availability[index] += delta
+                self._move(index)
+            return
+
+        # too many pieces to move one by one, leave the buckets stale until the next rebuild
+        availability = self.availability
+        for index in pieces:
+            availability[index] += delta
+        self._dirty = True
+
+    def _rebuild(self):
+        pieces = [index for bucket in self._buckets for index in bucket]
+        self._buckets = [[]]
+        self._unstarted = 0
+        for index in pieces:
+            self._positions[index] = -1
+            self._add_to_bucket(index)
+
+        self._dirty = False
+        self._rebuilt_at = time.monotonic()
+
+    def _move(self, index: int):
+        if self._positions[index] >= 0 and self._bucket_of[index] != self.availability[index]:
+            self._remove_from_bucket(index)
+            self._add_to_bucket(index)
+
+    def _add_to_bucket(self, index: int):
+        if self._positions[index] >= 0 or index in self.have:
+            return
+
+        availability = self.availability[index]
+        while len(self._buckets) <= availability:
+            self._buckets.append([])
+
+        bucket = self._buckets[availability]
+        self._bucket_of[index] = availability
+        self._positions[index] = len(bucket)
+        self._unstarted += 1
+        bucket.append(index)
+
+    def _remove_from_bucket(self, index: int):
+        position = self._positions[index]
+        if position < 0:
+            return
+
+        bucket = self._buckets[self._bucket_of[index]]
+        last = bucket.pop()
+        if last != index:
+            bucket[position] = last
+            self._positions[last] = position
+
+        self._positions[index] = -1
+        self._unstarted -= 1
+
+
+def _address(peer: Hashable) -> Hashable:
+    # connections are counted by their address, other peers, e.g. in tests, by themselves
+    return getattr(peer, "address", peer)
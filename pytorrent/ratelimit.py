@@ -0,0 +1,77 @@
+import time
+from typing import Optional
+
+
+class TokenBucket:
+    """
+    Byte rate limit, optionally nested in a parent limit (global, torrent, peer).
+
+    Transfers are charged after the fact and may leave a bucket in debt, `consume` returns how
+    long the caller has to stay idle until every bucket up the chain is paid back. A bucket
+    without a rate only forwards to its parent and never reads the clock, so unset limits cost
+    a few attribute lookups per read.
+    """
+
+    __slots__ = ("rate", "burst", "parent", "tokens", "_last", "__weakref__")
+
+    # seconds worth of the rate that may be used in one burst
+    BURST = 1.0
+    MIN_BURST = 16 * 1024
+
+    def __init__(self, rate: Optional[float] = None, parent: Optional["TokenBucket"] = None):
+        self.parent = parent
+        self.rate: Optional[float] = None
+        self.burst = 0.0
+        self.tokens = 0.0
+        self._last = 0.0
+        self.set_rate(rate)
+
+    @property
+    def limited(self) -> bool:
+        bucket = self
+        while bucket is not None:
+            if bucket.rate is not None:
+                return True
+            bucket = bucket.parent
+        return False
+
+    def set_rate(self, rate: Optional[float]):
+        """
+        Change the rate in bytes per second, `None` or 0 removes the limit
+        """
+        now = time.monotonic()
+        was_limited = self.rate is not None
+        if was_limited:
+            self._refill(now)
+
+        self.rate = rate or None
+        if self.rate is None:
+            return
+
+        self.burst = max(self.rate * TokenBucket.BURST, TokenBucket.MIN_BURST)
+        self.tokens = min(self.tokens, self.burst) if was_limited else self.burst
+        self._last = now
+
+    def consume(self, nbytes: int, now: Optional[float] = None) -> float:
+        """
+        Charge `nbytes` to this bucket and its parents, returns the delay in seconds before
+        the next transfer, 0 while within every limit
+        """
+        delay = 0.0
+        bucket = self
+
+        while bucket is not None:
+            if bucket.rate is not None:
+                if now is None:
+                    now = time.monotonic()
+                bucket._refill(now)
+                bucket.tokens -= nbytes
+                if bucket.tokens < 0:
+                    delay = max(delay, -bucket.tokens / bucket.rate)
+            bucket = bucket.parent
+
+        return delay
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self._last) * self.rate)
+        self._last = now
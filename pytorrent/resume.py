@@ -0,0 +1,138 @@
+import logging
+import os
+import pathlib
+import tempfile
+from typing import Dict, Optional, Sequence, Tuple
+
+from .bcode import BDecodeError, bdecode, bencode
+from .piece_manager import Bitfield, PieceManager
+from .storage import Storage
+from .verify import HashPiece, hash_storage, sha1_piece
+
+
+class ResumeData:
+    """
+    State that lets a restarted client skip rehashing: the verified pieces, the size and mtime
+    of every file when it was saved and the received blocks of pieces still in progress.
+    """
+
+    VERSION = 1
+
+    def __init__(
+        self,
+        info_hash: bytes,
+        pieces: bytes,
+        files: Sequence[Tuple[int, int]],
+        partial: Dict[int, bytes],
+    ):
+        self.info_hash = info_hash
+        self.pieces = pieces
+        self.files = [tuple(file) for file in files]
+        self.partial = partial
+
+    @staticmethod
+    def path_for(resume_dir, info_hash: bytes) -> pathlib.Path:
+        return pathlib.Path(resume_dir) / f"{info_hash.hex()}.resume"
+
+    def encode(self) -> bytes:
+        return bencode(
+            {
+                "version": ResumeData.VERSION,
+                "info-hash": self.info_hash,
+                "pieces": self.pieces,
+                "files": [list(file) for file in self.files],
+                "partial": {str(index): blocks for index, blocks in self.partial.items()},
+            }
+        )
+
+    @classmethod
+    def decode(cls, data: bytes) -> "ResumeData":
+        decoded = bdecode(data)
+
+        if decoded.get(b"version") != ResumeData.VERSION:
+            raise ValueError(f"Unsupported resume data version {decoded.get(b'version')}")
+
+        return cls(
+            decoded[b"info-hash"],
+            decoded[b"pieces"],
+            decoded[b"files"],
+            {int(index): blocks for index, blocks in decoded[b"partial"].items()},
+        )
+
+    @classmethod
+    def load(cls, path) -> Optional["ResumeData"]:
+        try:
+            with open(path, "rb") as file:
+                return cls.decode(file.read())
+        except FileNotFoundError:
+            return None
+        except (BDecodeError, KeyError, ValueError) as e:
+            logging.warning("Ignoring invalid resume data %s: %s", path, e)
+            return None
+
+    def save(self, path):
+        """
+        Write atomically: a temporary file in the same directory is synced and renamed over
+        """
+        path = pathlib.Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        fd, temporary = tempfile.mkstemp(dir=path.parent, prefix=path.name, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as file:
+                file.write(self.encode())
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temporary, path)
+        except BaseException:
+            os.unlink(temporary)
+            raise
+
+    def matches(self, info_hash: bytes, storage: Storage) -> bool:
+        return info_hash == self.info_hash and storage.file_stats() == self.files
+
+
+class ResumeSnapshot:
+    """
+    Resume state captured on the event loop, `save` does the blocking part on any thread
+    """
+
+    def __init__(self, info_hash: bytes, have: Bitfield, piece_manager: PieceManager):
+        self.info_hash = info_hash
+        self.pieces = have.to_bytes()
+        self.partial = piece_manager.partial_pieces()
+        self.block_size = piece_manager.block_size
+
+    def save(self, path, storage: Storage):
+        # received blocks of unfinished pieces only exist in memory, put them on disk first
+        for index, (blocks, data) in self.partial.items():
+            for block in blocks:
+                begin = block * self.block_size
+                storage.write_blocking(index, begin, data[begin : begin + self.block_size])
+
+        ResumeData(
+            self.info_hash,
+            self.pieces,
+            storage.file_stats(),
+            {index: blocks.to_bytes() for index, (blocks, _) in self.partial.items()},
+        ).save(path)
+
+
+def recheck(
+    storage: Storage,
+    piece_hashes: Sequence[bytes],
+    workers: Optional[int] = None,
+    hash_piece: HashPiece = sha1_piece,
+) -> Bitfield:
+    """
+    Hash the data on disk in parallel and return the pieces that are valid
+    """
+    digests = hash_storage(
+        storage, len(piece_hashes), workers, hash_piece, thread_name_prefix="pytorrent-recheck"
+    )
+
+    have = Bitfield(len(piece_hashes))
+    for index, digest in enumerate(digests):
+        if digest is not None and digest == piece_hashes[index]:
+            have.add(index)
+    return have
@@ -0,0 +1,427 @@
+import asyncio
+import logging
+import threading
+from typing import Dict, List, Optional, Sequence, Set
+
+import aiohttp
+
+from .budget import SessionLimits
+from .merkle import HashTree
+from .choker import Choker
+from .metrics import Registry, TorrentMetrics
+from .peer_connection import PeerConnection
+from .peer_pool import PeerPool
+from .piece_manager import Bitfield, PieceManager
+from .resume import ResumeData, ResumeSnapshot, recheck
+from .storage import Storage
+from .torrent import Torrent, Tracker
+from .udp_tracker import ConnectionCache
+from .upload import Uploader
+from .verify import PieceVerifier, sha1_piece
+
+
+class TorrentSession:
+    """
+    Everything that belongs to one torrent: picker, verifier, storage, resume data, tracker
+    announces and peer connections. Sessions share the event loop, the HTTP client and the
+    global budgets of the `Manager` that owns them.
+    """
+
+    RESUME_INTERVAL = 60
+    ANNOUNCE_RETRY = 60
+    # how long a stopping torrent waits for its trackers
+    STOPPED_TIMEOUT = 5
+    DEFAULT_INTERVAL = 30 * 60
+
+    def __init__(
+        self,
+        torrent: Torrent,
+        http_session: aiohttp.ClientSession,
+        limits: SessionLimits,
+        download_dir: str,
+        resume_dir: str,
+        max_peers: int = PeerPool.MAX_PEERS,
+        preallocate: bool = False,
+        force_recheck: bool = False,
+        max_open_files: int = Storage.MAX_OPEN_FILES,
+        udp_connections: Optional[ConnectionCache] = None,
+        registry: Optional[Registry] = None,
+    ):
+        self.torrent = torrent
+        self.http_session = http_session
+        self.limits = limits
+        self.download_dir = download_dir
+        self.resume_path = ResumeData.path_for(resume_dir, torrent.info_hash)
+        self.force_recheck = force_recheck
+
+        self.loop = asyncio.get_event_loop()
+        self.max_peers = max_peers
+        self.pool: Optional[PeerPool] = None
+
+        self.piece_manager = PieceManager.from_torrent(torrent)
+        # blocks of v2 torrents are checked as they arrive, v2 only torrents also by piece
+        self.hash_tree = HashTree.from_torrent(torrent) if torrent.info.has_v2 else None
+        self.piece_hashes: Sequence[bytes] = torrent.info.pieces
+        self.hash_piece = sha1_piece
+        if not torrent.info.has_v1:
+            self.piece_hashes = self.hash_tree.piece_hashes
+            self.hash_piece = self.hash_tree.hash_piece
+        self.verifier = PieceVerifier(
+            self.piece_hashes, self._on_piece_verified, hash_piece=self.hash_piece
+        )
+        self.storage = Storage.from_torrent(
+            torrent, download_dir, preallocate=preallocate, max_open_files=max_open_files
+        )
+        self.written: Optional[Bitfield] = None
+        self.uploader: Optional[Uploader] = None
+        self.choker: Optional[Choker] = None
+        self.tracker = Tracker(torrent, http_session, udp_connections)
+        self.downloaded = 0
+
+        self.metrics = TorrentMetrics(registry or Registry(), torrent.info_hash)
+        self.storage.write_latency = self.metrics.write_latency
+        self._register_metrics()
+
+        self._tasks: List[asyncio.Task] = []
+        # verified pieces waiting for room in the write queue, and the tasks that queue them
+        self._unsaved: Dict[int, bytes] = {}
+        self._saving: Set[asyncio.Task] = set()
+        # trackers are told about the stop once they know about the torrent
+        self._announced = False
+        self._completed = asyncio.Event()
+        self.stopped = False
+
+    @property
+    def info_hash(self) -> bytes:
+        return self.torrent.info_hash
+
+    async def start(self):
+        await self._load_resume()
+        await self.storage.run(self.storage.allocate)
+        self.written = Bitfield(self.piece_manager.piece_count, self.piece_manager.have.to_bytes())
+        self.uploader = Uploader(self.storage, self.written, self.piece_manager)
+
+        self.pool = PeerPool(
+            self.info_hash,
+            self.tracker.peer_id,
+            self.piece_manager,
+            self.verifier,
+            self.limits,
+            self.max_peers,
+            uploader=self.uploader,
+            metrics=self.metrics,
+            pex=not self.torrent.info.private,
+            hash_tree=self.hash_tree,
+        )
+        self.choker = Choker(self.pool, self.piece_manager)
+        self.pool.choker = self.choker
+        self.pool.start()
+
+        self._tasks = [
+            self.loop.create_task(self.choker.run()),
+            self.loop.create_task(self._announce()),
+            self.loop.create_task(self._save_resume_periodically()),
+        ]
+
+    async def stop(self):
+        """
+        Stop a running session, e.g. when the torrent is removed at runtime
+        """
+        self._stop_tasks()
+
+        if self._announced:
+            await self._announce_stopped(self.tracker)
+        if self._saving:
+            await asyncio.gather(*self._saving, return_exceptions=True)
+        await self.storage.flush()
+        snapshot = ResumeSnapshot(self.info_hash, self.piece_manager.have, self.piece_manager)
+        try:
+            await self.storage.run(snapshot.save, self.resume_path, self.storage)
+        except OSError as e:
+            logging.error("Unable to save resume data: %s", e)
+
+        self.close()
+
+    def stop_blocking(self):
+        """
+        Same as `stop` for when the event loop is no longer running
+        """
+        self._stop_tasks()
+        if self._announced:
+            self._announce_stopped_blocking()
+
+        self.storage.flush_blocking()
+        for index, data in self._unsaved.items():
+            try:
+                self.storage.write_blocking(index, 0, data)
+            except OSError as e:
+                logging.error("Unable to save piece %d: %s", index, e)
+        # everything verified has been flushed by now, not only what was confirmed written
+        snapshot = ResumeSnapshot(self.info_hash, self.piece_manager.have, self.piece_manager)
+        try:
+            snapshot.save(self.resume_path, self.storage)
+        except OSError as e:
+            logging.error("Unable to save resume data: %s", e)
+
+        self.close()
+
+    def _stop_tasks(self):
+        self.stopped = True
+        for task in self._tasks:
+            task.cancel()
+        if self.pool:
+            self.pool.stop()
+
+    def close(self):
+        """
+        Release everything without saving resume data
+        """
+        self._stop_tasks()
+        for task in self._saving:
+            task.cancel()
+        self.verifier.close()
+        self.storage.close()
+        self.limits.close()
+        self.metrics.close()
+
+    # metrics
+
+    def _register_metrics(self):
+        metrics = self.metrics
+        metrics.counter(
+            "pytorrent_downloaded_bytes_total",
+            "Verified piece data downloaded",
+            lambda: self.downloaded,
+        )
+        metrics.counter(
+            "pytorrent_uploaded_bytes_total",
+            "Block data uploaded to peers",
+            lambda: self.uploader.uploaded if self.uploader else 0,
+        )
+        metrics.gauge(
+            "pytorrent_pieces", "Pieces verified so far", lambda: len(self.piece_manager.have)
+        )
+        metrics.gauge(
+            "pytorrent_peers", "Connected peers", lambda: len(self.pool) if self.pool else 0
+        )
+        metrics.gauge(
+            "pytorrent_hash_queue_pieces",
+            "Pieces waiting for their hash check",
+            lambda: self.verifier.pending_pieces,
+        )
+        metrics.gauge(
+            "pytorrent_hash_queue_bytes",
+            "Bytes waiting for their hash check",
+            lambda: self.verifier.pending_bytes,
+        )
+        metrics.gauge(
+            "pytorrent_disk_queue_bytes",
+            "Bytes waiting to be written",
+            lambda: self.storage.pending_bytes,
+        )
+
+    def stats(self) -> dict:
+        """
+        Snapshot of the torrent and each of its connections
+        """
+        peers = []
+        for connection in self.pool.connections.values() if self.pool else ():
+            protocol = connection.protocol
+            peers.append(
+                {
+                    "address": "%s:%d" % connection.address,
+                    "downloaded": connection.downloaded,
+                    "uploaded": connection.uploaded,
+                    "received_bytes": protocol.received if protocol else 0,
+                    "sent_bytes": protocol.sent if protocol else 0,
+                    "download_rate": connection.download_rate.rate(),
+                    "upload_rate": connection.upload_rate.rate(),
+                    "am_choking": connection.am_choking,
+                    "peer_choking": connection.peer_choking,
+                    "requests": len(connection.pipeline),
+                    "srtt": connection.pipeline.srtt,
+                }
+            )
+
+        return {
+            "pieces": len(self.piece_manager.have),
+            "piece_count": self.piece_manager.piece_count,
+            "left": self._left(),
+            "downloaded": self.downloaded,
+            "uploaded": self.uploader.uploaded if self.uploader else 0,
+            "received_bytes": self.metrics.received.get(),
+            "sent_bytes": self.metrics.sent.get(),
+            "hash_queue": self.verifier.pending_pieces,
+            "disk_queue_bytes": self.storage.pending_bytes,
+            "known_peers": len(self.pool.store) if self.pool else 0,
+            "peers": peers,
+        }
+
+    # pieces
+
+    def _on_piece_verified(self, index: int, valid: bool) -> Optional[asyncio.Task]:
+        data = self.piece_manager.piece_data(index)
+        peers = self.piece_manager.piece_verified(index, valid)
+
+        if valid:
+            logging.info("Piece %d verified", index)
+            if self.hash_tree is not None:
+                self.hash_tree.discard_leaves(index)
+            self.downloaded += len(data)
+            if self.piece_manager.complete:
+                self._completed.set()
+            # the verifier holds the piece against its limit until it is written
+            self._unsaved[index] = data
+            task = self.loop.create_task(self._save_piece(index, data))
+            self._saving.add(task)
+            task.add_done_callback(self._saving.discard)
+            return task
+
+        logging.warning("Piece %d failed the hash check, downloading it again", index)
+        for peer in peers:
+            if self.piece_manager.peer_hash_failures(peer) >= PeerConnection.MAX_HASH_FAILURES:
+                logging.warning("Banning peer %s after repeated hash failures", peer)
+                self.pool.ban(peer.address)
+
+    async def _save_piece(self, index: int, data: bytes):
+        await self.storage.wait_for_room(len(data))
+        # queued from here on, shutdown flushes it with the rest
+        del self._unsaved[index]
+
+        try:
+            await self.storage.write_nowait(index, 0, data)
+        except OSError as e:
+            logging.error("Unable to save piece %d: %s", index, e)
+            return
+
+        # only pieces on disk are announced and served
+        self.written.add(index)
+        self.uploader.piece_written(index, data)
+        self.pool.broadcast_have(index)
+
+    # resume
+
+    async def _load_resume(self):
+        resume = await self.storage.run(ResumeData.load, self.resume_path)
+
+        if not self.force_recheck and resume:
+            if await self.storage.run(resume.matches, self.info_hash, self.storage):
+                logging.info("Resuming from %s", self.resume_path)
+                await self._restore(resume)
+                return
+            logging.info("Files changed since the resume data was saved")
+
+        if self.force_recheck or await self.storage.run(self.storage.has_data):
+            logging.info("Checking existing data")
+            have = await self.storage.run(
+                recheck, self.storage, self.piece_hashes, None, self.hash_piece
+            )
+            logging.info("%d of %d pieces are valid", len(have), have.length)
+            for index in have:
+                self.piece_manager.mark_have(index)
+
+    async def _restore(self, resume: ResumeData):
+        for index in Bitfield(self.piece_manager.piece_count, resume.pieces):
+            self.piece_manager.mark_have(index)
+
+        for index, blocks in resume.partial.items():
+            if not 0 <= index < self.piece_manager.piece_count:
+                continue
+
+            size = self.piece_manager.piece_size(index)
+            block_count = -(-size // self.piece_manager.block_size)
+            data = await self.storage.read(index, 0, size)
+            blocks = Bitfield(block_count, blocks)
+            if self.piece_manager.restore_partial(index, blocks, data):
+                await self.verifier.submit(index, self.piece_manager.piece_data(index))
+
+    async def _save_resume_periodically(self):
+        while True:
+            await asyncio.sleep(TorrentSession.RESUME_INTERVAL)
+
+            snapshot = ResumeSnapshot(self.info_hash, self.written, self.piece_manager)
+            try:
+                await self.storage.run(snapshot.save, self.resume_path, self.storage)
+            except OSError as e:
+                logging.error("Unable to save resume data: %s", e)
+
+    # tracker
+
+    async def _announce(self):
+        interval = TorrentSession.DEFAULT_INTERVAL
+        event = "started"
+        # a torrent that starts out complete has no completion to report
+        completed = self.piece_manager.complete
+
+        while True:
+            if not event and not completed and self.piece_manager.complete:
+                event = "completed"
+
+            try:
+                tracker_response = await self.tracker.announce(event=event, **self._transfer())
+            except (aiohttp.ClientError, OSError, asyncio.TimeoutError) as e:
+                logging.warning("Announce failed: %s", e)
+                await asyncio.sleep(TorrentSession.ANNOUNCE_RETRY)
+                continue
+
+            if failed_reason := tracker_response.failure_reason:
+                logging.error(failed_reason)
+                await asyncio.sleep(TorrentSession.ANNOUNCE_RETRY)
+                continue
+
+            self._announced = True
+            completed = completed or event == "completed"
+            event = ""
+            if warning_message := tracker_response.warning_message:
+                logging.warning(warning_message)
+
+            interval = tracker_response.interval or interval
+            endpoints = tracker_response.endpoints
+            if endpoints:
+                self.pool.add_endpoints(endpoints)
+                logging.info("Got %d peers, %d known", len(endpoints), len(self.pool.store))
+
+            logging.debug("Next announce in %d seconds", interval)
+            if completed:
+                await asyncio.sleep(interval)
+                continue
+            # the completion is announced right away
+            try:
+                await asyncio.wait_for(self._completed.wait(), interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _announce_stopped(self, tracker: Tracker):
+        try:
+            await asyncio.wait_for(
+                tracker.announce(event="stopped", **self._transfer()),
+                TorrentSession.STOPPED_TIMEOUT,
+            )
+        except (aiohttp.ClientError, OSError, asyncio.TimeoutError) as e:
+            logging.warning("Announcing the stop failed: %s", e)
+
+    def _announce_stopped_blocking(self):
+        # the loop of the session cannot run here, announce from a thread with its own
+        async def _announce():
+            async with aiohttp.ClientSession() as client:
+                tracker = Tracker(self.torrent, client)
+                tracker.peer_id = self.tracker.peer_id
+                tracker.port = self.tracker.port
+                await self._announce_stopped(tracker)
+
+        thread = threading.Thread(
+            target=asyncio.run, args=(_announce(),), name="pytorrent-announce", daemon=True
+        )
+        thread.start()
+        thread.join(TorrentSession.STOPPED_TIMEOUT)
+
+    def _transfer(self) -> dict:
+        return {
+            "uploaded": self.uploader.uploaded if self.uploader else 0,
+            "downloaded": self.downloaded,
+            "left": self._left(),
+        }
+
+    def _left(self) -> int:
+        have = sum(self.piece_manager.piece_size(index) for index in self.piece_manager.have)
+        return self.piece_manager.total_length - have
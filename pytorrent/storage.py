@@ -0,0 +1,512 @@
+import asyncio
+import bisect
+import contextlib
+import logging
+import os
+import pathlib
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from concurrent.futures import Executor, Future, ThreadPoolExecutor, wait
+from typing import Iterator, List, Optional, Sequence, Set, Tuple
+
+from .metrics import Histogram
+from .torrent import TorrentInfo
+
+Segment = Tuple[int, int, int]
+
+_IOV_MAX = 1024
+
+
+class FileEntry:
+    __slots__ = ("path", "length", "offset")
+
+    def __init__(self, path: Optional[pathlib.Path], length: int, offset: int):
+        self.path = path
+        self.length = length
+        self.offset = offset
+
+    @property
+    def padding(self) -> bool:
+        return self.path is None
+
+
+def _safe_component(component: bytes) -> str:
+    name = component.decode(errors="replace") if isinstance(component, bytes) else component
+    if name in ("", ".", "..") or "/" in name or "\0" in name:
+        raise ValueError(f"Invalid path component {component!r}")
+    return name
+
+
+def _positions(segments: List[Segment]) -> Iterator[int]:
+    position = 0
+    for _, _, size in segments:
+        yield position
+        position += size
+
+
+class Storage:
+    """
+    Maps piece ranges onto the files of a torrent and does the disk I/O on a thread pool.
+
+    Files are created sparse (or preallocated) on first use and accessed with positional
+    `os.pwrite`/`os.pread` through a small LRU pool of open descriptors. Writes issued in the
+    same loop iteration are sorted and adjacent ranges of a file are merged into a single
+    `os.pwritev` call. A `readonly` storage only opens existing files for reading, e.g. to hash
+    data that is being shared. Pad files, given without a path, are never written and read
+    back as zeros.
+    """
+
+    MAX_OPEN_FILES = 64
+    MAX_PENDING_BYTES = 64 * 1024 * 1024
+
+    def __init__(
+        self,
+        files: Sequence[Tuple[Optional[pathlib.Path], int]],
+        piece_length: int,
+        preallocate: bool = False,
+        max_open_files: int = MAX_OPEN_FILES,
+        executor: Optional[Executor] = None,
+        readonly: bool = False,
+    ):
+        self.piece_length = piece_length
+        self.preallocate = preallocate
+        self.max_open_files = max_open_files
+        self.readonly = readonly
+
+        self.files: List[FileEntry] = []
+        offset = 0
+        for path, length in files:
+            self.files.append(
+                FileEntry(pathlib.Path(path) if path is not None else None, length, offset)
+            )
+            offset += length
+        self.total_length = offset
+
+        # cumulative start offsets of the non-empty files, for bisecting
+        self._file_indexes = [i for i, file in enumerate(self.files) if file.length]
+        self._offsets = [self.files[i].offset for i in self._file_indexes]
+
+        piece_count = (self.total_length + piece_length - 1) // piece_length
+        self._piece_first_file = array(
+            "I", (self._find_file(i * piece_length) for i in range(piece_count))
+        )
+
+        # file index -> [descriptor, number of threads using it]
+        self._fds: "OrderedDict[int, List[int]]" = OrderedDict()
+        self._fds_lock = threading.Lock()
+
+        self._owns_executor = executor is None
+        self._executor = executor or ThreadPoolExecutor(
+            max_workers=4, thread_name_prefix="pytorrent-storage"
+        )
+
+        self._pending: List[Tuple[List[Segment], memoryview, asyncio.Future]] = []
+        self._unfinished: Set[asyncio.Future] = set()
+        # batches handed to the executor and not written yet
+        self._writing: Set[Future] = set()
+        self._flush_handle: Optional[asyncio.Handle] = None
+        self.pending_bytes = 0
+        self._waiters: List[asyncio.Future] = []
+        # observes how long each coalesced batch takes to hit the disk
+        self.write_latency: Optional[Histogram] = None
+
+    @classmethod
+    def from_torrent(cls, torrent, base_dir, **kwargs) -> "Storage":
+        base_dir = pathlib.Path(base_dir)
+        name = _safe_component(torrent.info.name)
+
+        if torrent.info.mode == TorrentInfo.SINGLE_FILE_MODE:
+            files = [(base_dir / name, torrent.info.length)]
+        else:
+            files = [
+                (
+                    None
+                    if file.padding
+                    else base_dir.joinpath(name, *map(_safe_component, file.path)),
+                    file.length,
+                )
+                for file in torrent.info.files
+            ]
+
+        return cls(files, torrent.info.piece_length, **kwargs)
+
+    # layout
+
+    def _find_file(self, offset: int) -> int:
+        position = bisect.bisect_right(self._offsets, offset) - 1
+        return self._file_indexes[max(position, 0)] if self._file_indexes else 0
+
+    def segments(self, offset: int, length: int) -> List[Segment]:
+        """
+        Split a torrent-wide byte range into (file index, file offset, length) segments
+        """
+        if offset < 0 or offset + length > self.total_length:
+            raise ValueError(f"Range {offset}+{length} is outside of the torrent")
+
+        return self._segments_from(self._find_file(offset), offset, length)
+
+    def piece_segments(
+        self, index: int, begin: int = 0, length: Optional[int] = None
+    ) -> List[Segment]:
+        offset = index * self.piece_length + begin
+        if length is None:
+            length = min(self.piece_length, self.total_length - index * self.piece_length) - begin
+
+        if begin >= self.piece_length or offset + length > self.total_length:
+            raise ValueError(f"Range {begin}+{length} is outside of piece {index}")
+
+        first = self._piece_first_file[index]
+        if begin:
+            first = self._find_file(offset)
+
+        return self._segments_from(first, offset, length)
+
+    def _segments_from(self, file_index: int, offset: int, length: int) -> List[Segment]:
+        segments = []
+
+        while length > 0:
+            file = self.files[file_index]
+            file_offset = offset - file.offset
+            size = min(length, file.length - file_offset)
+
+            if size > 0:
+                segments.append((file_index, file_offset, size))
+                offset += size
+                length -= size
+
+            file_index += 1
+
+        return segments
+
+    # async api
+
+    async def write(self, index: int, begin: int, data: bytes):
+        """
+        Write `data` at `begin` of piece `index`, waits while too much data is pending
+        """
+        await self.wait_for_room(len(data))
+        await self.write_nowait(index, begin, data)
+
+    async def wait_for_room(self, size: int):
+        """
+        Wait until `size` more bytes can be queued without exceeding `MAX_PENDING_BYTES`
+        """
+        while self.pending_bytes and self.pending_bytes + size > Storage.MAX_PENDING_BYTES:
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            await waiter
+
+    def write_nowait(self, index: int, begin: int, data: bytes) -> asyncio.Future:
+        """
+        Queue a write right away without waiting for room, returns its completion future
+        """
+        segments = self.piece_segments(index, begin, len(data))
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        self.pending_bytes += len(data)
+        self._pending.append((segments, memoryview(data), future))
+        self._unfinished.add(future)
+        future.add_done_callback(self._unfinished.discard)
+        if self._flush_handle is None:
+            self._flush_handle = loop.call_soon(self._flush)
+
+        return future
+
+    async def flush(self):
+        """
+        Wait until every write queued so far is on disk
+        """
+        self._flush()
+        if self._unfinished:
+            await asyncio.gather(*self._unfinished, return_exceptions=True)
+
+    async def read(self, index: int, begin: int, length: int) -> bytes:
+        segments = self.piece_segments(index, begin, length)
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, self._read_segments, segments
+        )
+
+    async def run(self, function, *args):
+        """
+        Run a blocking function on the storage thread pool
+        """
+        return await asyncio.get_running_loop().run_in_executor(self._executor, function, *args)
+
+    def flush_blocking(self):
+        """
+        Write out everything still queued from the calling thread and wait for the writes
+        already under way, used on shutdown when the event loop is no longer running
+        """
+        wait(list(self._writing))
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+        pending, self._pending = self._pending, []
+        self._write_coalesced(
+            [
+                (file_index, file_offset, data[position : position + size])
+                for segments, data, _ in pending
+                for (file_index, file_offset, size), position in zip(
+                    segments, _positions(segments)
+                )
+            ]
+        )
+        self.pending_bytes -= sum(len(data) for _, data, _ in pending)
+
+    def close(self):
+        if self._owns_executor:
+            self._executor.shutdown(wait=True)
+
+        with self._fds_lock:
+            for fd, _ in self._fds.values():
+                os.close(fd)
+            self._fds.clear()
+
+    def _flush(self):
+        self._flush_handle = None
+        pending, self._pending = self._pending, []
+        if not pending:
+            return
+
+        writes = [
+            (file_index, file_offset, data[position : position + size])
+            for segments, data, _ in pending
+            for (file_index, file_offset, size), position in zip(segments, _positions(segments))
+        ]
+
+        started = time.monotonic()
+        writing = self._executor.submit(self._write_coalesced, writes)
+        self._writing.add(writing)
+        writing.add_done_callback(self._writing.discard)
+        future = asyncio.wrap_future(writing)
+        future.add_done_callback(lambda result: self._written(pending, result, started))
+
+    def _written(self, pending, result: asyncio.Future, started: float):
+        if self.write_latency is not None:
+            self.write_latency.observe(time.monotonic() - started)
+
+        exception = result.exception()
+        if exception:
+            logging.error("Writing %d blocks failed: %s", len(pending), exception)
+
+        for _, data, future in pending:
+            self.pending_bytes -= len(data)
+            if future.done():
+                continue
+            if exception:
+                future.set_exception(exception)
+            else:
+                future.set_result(None)
+
+        waiters, self._waiters = self._waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    # blocking helpers, run on the executor
+
+    def _write_coalesced(self, writes: List[Tuple[int, int, memoryview]]):
+        writes = [write for write in writes if not self.files[write[0]].padding]
+        writes.sort(key=lambda write: (write[0], write[1]))
+
+        run: List[memoryview] = []
+        run_file = run_offset = run_end = -1
+
+        for file_index, offset, data in writes:
+            if file_index == run_file and offset == run_end and len(run) < _IOV_MAX:
+                run.append(data)
+                run_end += len(data)
+                continue
+
+            if run:
+                self._pwritev(run_file, run_offset, run)
+            run, run_file, run_offset, run_end = [data], file_index, offset, offset + len(data)
+
+        if run:
+            self._pwritev(run_file, run_offset, run)
+
+    def _pwritev(self, file_index: int, offset: int, buffers: List[memoryview]):
+        with self.open_file(file_index) as fd:
+            self._pwritev_fd(fd, offset, buffers)
+
+    @staticmethod
+    def _pwritev_fd(fd: int, offset: int, buffers: List[memoryview]):
+        total = sum(len(buffer) for buffer in buffers)
+
+        while total:
+            if len(buffers) == 1:
+                written = os.pwrite(fd, buffers[0], offset)
+            else:
+                written = os.pwritev(fd, buffers, offset)
+
+            offset += written
+            total -= written
+
+            # partial write, skip what went out and retry the rest
+            while buffers and written >= len(buffers[0]):
+                written -= len(buffers[0])
+                buffers = buffers[1:]
+            if written:
+                buffers[0] = buffers[0][written:]
+
+    def write_blocking(self, index: int, begin: int, data: bytes):
+        data = memoryview(data)
+        segments = self.piece_segments(index, begin, len(data))
+        self._write_coalesced(
+            [
+                (file_index, file_offset, data[position : position + size])
+                for (file_index, file_offset, size), position in zip(
+                    segments, _positions(segments)
+                )
+            ]
+        )
+
+    def read_blocking(self, index: int, begin: int = 0, length: Optional[int] = None) -> bytes:
+        return self._read_segments(self.piece_segments(index, begin, length))
+
+    def read_into(self, index: int, buffer: memoryview) -> int:
+        """
+        Read a whole piece into a reusable buffer, returns the piece length
+        """
+        segments = self.piece_segments(index)
+        self._read_segments(segments, buffer)
+        return sum(size for _, _, size in segments)
+
+    def file_stats(self) -> List[Tuple[int, int]]:
+        """
+        (size, mtime in ns) of every file, (-1, -1) for files that do not exist and (0, 0) for
+        pad files
+        """
+        stats = []
+        for file in self.files:
+            if file.padding:
+                stats.append((0, 0))
+                continue
+            try:
+                stat = os.stat(file.path)
+                stats.append((stat.st_size, stat.st_mtime_ns))
+            except FileNotFoundError:
+                stats.append((-1, -1))
+        return stats
+
+    def has_data(self) -> bool:
+        return any(size > 0 for size, _ in self.file_stats())
+
+    def _read_segments(self, segments: List[Segment], out: Optional[memoryview] = None) -> bytes:
+        if out is None:
+            out = bytearray(sum(size for _, _, size in segments))
+        view = memoryview(out)
+        position = 0
+
+        for file_index, offset, size in segments:
+            if self.files[file_index].padding:
+                view[position : position + size] = bytes(size)
+                position += size
+                continue
+
+            with self.open_file(file_index) as fd:
+                while size:
+                    read = os.preadv(fd, [view[position : position + size]], offset)
+                    if not read:
+                        raise IOError(f"Unexpected end of {self.files[file_index].path}")
+                    position += read
+                    offset += read
+                    size -= read
+
+        return out
+
+    def allocate(self):
+        """
+        Create every file up front, sparse or preallocated, including empty ones
+        """
+        for file_index, file in enumerate(self.files):
+            if not file.padding:
+                with self.open_file(file_index):
+                    pass
+
+    @contextlib.contextmanager
+    def open_file(self, file_index: int) -> Iterator[int]:
+        """
+        Borrow the descriptor of a file from the LRU pool, the file is created on first use
+        unless the storage is readonly.
+        Descriptors in use are never closed by eviction.
+        """
+        fd = self.borrow_file(file_index)
+        try:
+            yield fd
+        finally:
+            self.return_file(file_index, fd)
+
+    def borrow_file(self, file_index: int) -> int:
+        """
+        Like `open_file`, for a descriptor used across threads, it may block on the disk.
+        Every borrowed descriptor is given back with `return_file`.
+        """
+        return self._acquire(file_index)
+
+    def return_file(self, file_index: int, fd: int):
+        with self._fds_lock:
+            entry = self._fds.get(file_index)
+            if entry is not None and entry[0] == fd:
+                entry[1] -= 1
+                return
+        # evicted while borrowed
+        os.close(fd)
+
+    def _acquire(self, file_index: int) -> int:
+        with self._fds_lock:
+            entry = self._fds.get(file_index)
+            if entry is not None:
+                self._fds.move_to_end(file_index)
+                entry[1] += 1
+                return entry[0]
+
+        # creating and preallocating a file can take long, other files stay usable meanwhile
+        fd = self._open(self.files[file_index])
+
+        with self._fds_lock:
+            entry = self._fds.get(file_index)
+            if entry is not None:
+                # another thread opened it first
+                os.close(fd)
+                self._fds.move_to_end(file_index)
+                entry[1] += 1
+                return entry[0]
+
+            self._fds[file_index] = [fd, 1]
+            self._evict()
+            return fd
+
+    def _open(self, file: FileEntry) -> int:
+        if self.readonly:
+            fd = os.open(file.path, os.O_RDONLY)
+            if hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            return fd
+
+        file.path.parent.mkdir(parents=True, exist_ok=True)
+        fd = os.open(file.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size < file.length:
+                if self.preallocate and hasattr(os, "posix_fallocate"):
+                    os.posix_fallocate(fd, 0, file.length)
+                else:
+                    os.ftruncate(fd, file.length)
+        except OSError:
+            os.close(fd)
+            raise
+        return fd
+
+    def _evict(self):
+        for file_index in list(self._fds):
+            if len(self._fds) <= self.max_open_files:
+                return
+
+            fd, users = self._fds[file_index]
+            if not users:
+                del self._fds[file_index]
+                os.close(fd)
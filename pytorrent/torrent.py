@@ -1,20 +1,30 @@
 import io
+import mmap
 import pathlib
 from datetime import datetime
 from re import S
-from typing import Union, Optional
+from typing import List, Sequence, Union, Optional
 import asyncio
 import json
-from random import randrange
+import random
 import hashlib
 import urllib
 import urllib.parse
-import struct
-import socket
+import logging
 
 import aiohttp
 
-from .bcode import bdecode, bencode
+from .bcode import bdecode
+from .peer_store import (
+    COMPACT6_SIZE,
+    COMPACT_SIZE,
+    Address,
+    Endpoint,
+    decode_endpoint,
+    encode_address,
+    split_compact,
+)
+from .udp_tracker import ConnectionCache, UDPTracker
 
 #   announce
 #   announce_list
@@ -27,14 +37,126 @@ from .bcode import bdecode, bencode
 #   url_list
 
 
+def _bytes(value):
+    if isinstance(value, memoryview):
+        return value.tobytes()
+    return value
+
+
+def _text(value, default: bytes = b"") -> str:
+    if value is None:
+        value = default
+    return _bytes(value).decode()
+
+
 class TorrentFileInfo:
     def __init__(self, info):
-        self.crc32 = info.get(b"crc32")
+        self.attr = _bytes(info.get(b"attr", b""))
+        self.crc32 = _bytes(info.get(b"crc32"))
         self.length = info.get(b"length")
-        self.md5 = info.get(b"md5")
+        self.md5 = _bytes(info.get(b"md5"))
         self.mtime = info.get(b"mtime")
-        self.path = info.get(b"path")
-        self.sha1 = info.get(b"sha1")
+        self.path = [_bytes(x) for x in info.get(b"path", [])]
+        self.sha1 = _bytes(info.get(b"sha1"))
+
+    @property
+    def padding(self) -> bool:
+        """
+        Pad files (BEP 47) only align the next file to a piece boundary, they are all zeros
+        """
+        return b"p" in self.attr
+
+
+class TreeFile:
+    """
+    A file of the v2 `file tree` (BEP 52), `pieces_root` is None for empty files
+    """
+
+    __slots__ = ("path", "length", "pieces_root")
+
+    def __init__(self, path: List[bytes], length: int, pieces_root: Optional[bytes]):
+        self.path = path
+        self.length = length
+        self.pieces_root = pieces_root
+
+
+def _walk_file_tree(tree, path: List[bytes]) -> List[TreeFile]:
+    files = []
+    for name in sorted(tree):
+        node = tree[name]
+        if not isinstance(node, dict):
+            raise ValueError(f"Invalid file tree entry {name!r}")
+
+        # a file is a directory with a single entry keyed by the empty string
+        file = node.get(b"")
+        if file is None:
+            files += _walk_file_tree(node, path + [bytes(name)])
+            continue
+
+        length = file.get(b"length")
+        root = _bytes(file.get(b"pieces root"))
+        if not isinstance(length, int) or length < 0 or (length and len(root or b"") != 32):
+            raise ValueError(f"Invalid file tree entry {name!r}")
+        files.append(TreeFile(path + [bytes(name)], length, root if length else None))
+
+    return files
+
+
+class TorrentFileList(Sequence):
+    """
+    Files of a multi-file torrent, `TorrentFileInfo` objects are only built when accessed
+    """
+
+    def __init__(self, files):
+        self._files = files
+        self._cache = {}
+
+    def __len__(self):
+        return len(self._files)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+
+        if index < 0:
+            index += len(self._files)
+
+        file = self._cache.get(index)
+        if file is None:
+            file = self._cache[index] = TorrentFileInfo(self._files[index])
+
+        return file
+
+    @property
+    def total_length(self) -> int:
+        return sum(file[b"length"] for file in self._files)
+
+
+class PieceHashes(Sequence):
+    """
+    Indexable view over the concatenated SHA-1 digests of the `pieces` value
+    """
+
+    DIGEST_SIZE = 20
+
+    def __init__(self, data):
+        self.raw = memoryview(data or b"")
+
+    def __len__(self):
+        return len(self.raw) // PieceHashes.DIGEST_SIZE
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+
+        if index < 0:
+            index += len(self)
+
+        if not 0 <= index < len(self):
+            raise IndexError("piece index out of range")
+
+        start = index * PieceHashes.DIGEST_SIZE
+        return self.raw[start : start + PieceHashes.DIGEST_SIZE].tobytes()
 
 
 class TorrentInfo:
@@ -45,17 +167,69 @@ class TorrentInfo:
     def __init__(self, info):
 
         self.length = info.get(b"length")
-        self.name = info.get(b"name")
-        self.pieces = info.get(b"pieces")
+        self.name = _bytes(info.get(b"name"))
+        self.pieces = PieceHashes(info.get(b"pieces"))
         self.piece_length = info.get(b"piece length")
 
-        self.files = [TorrentFileInfo(x) for x in info.get(b"files", [])]
+        self.files = TorrentFileList(info.get(b"files", []))
         self.mode = TorrentInfo.MULTI_FILE_MODE if self.files else TorrentInfo.SINGLE_FILE_MODE
 
         self.collections = info.get(b"collections")
+        # private torrents only get peers from their trackers (BEP 27)
+        self.private = info.get(b"private") == 1
+
+        # v2 (BEP 52): one merkle tree per file, files start on piece boundaries
+        self.meta_version = info.get(b"meta version", 1)
+        self.file_tree_files: List[TreeFile] = []
+        if self.meta_version == 2:
+            self.file_tree_files = _walk_file_tree(info.get(b"file tree", {}), [])
+            if not info.get(b"pieces"):
+                self._lay_out_v2_files()
 
         self._raw_data = info
 
+    @property
+    def has_v1(self) -> bool:
+        return bool(self.pieces)
+
+    @property
+    def has_v2(self) -> bool:
+        return self.meta_version == 2
+
+    @property
+    def total_length(self) -> int:
+        """
+        Length of the piece space, including pad files
+        """
+        if self.mode == TorrentInfo.SINGLE_FILE_MODE:
+            return self.length
+        return self.files.total_length
+
+    @property
+    def piece_count(self) -> int:
+        if self.has_v1:
+            return len(self.pieces)
+        return -(-self.total_length // self.piece_length)
+
+    def _lay_out_v2_files(self):
+        """
+        The files of a v2 only torrent as v1 would list them, with pad files between them
+        """
+        files = self.file_tree_files
+        if len(files) == 1 and len(files[0].path) == 1:
+            self.length = files[0].length
+            return
+
+        entries = []
+        for position, file in enumerate(files):
+            entries.append({b"length": file.length, b"path": file.path})
+            gap = -file.length % self.piece_length
+            if gap and position < len(files) - 1:
+                entries.append({b"attr": b"p", b"length": gap, b"path": [b".pad", b"%d" % gap]})
+
+        self.files = TorrentFileList(entries)
+        self.mode = TorrentInfo.MULTI_FILE_MODE
+
 
 class TrackerResponse:
     def __init__(self, data):
@@ -69,26 +243,47 @@ class TrackerResponse:
         self._complete = self._decoded_data.get(b"complete")
         self._incomplete = self._decoded_data.get(b"incomplete")
         self._peers = self._decoded_data.get(b"peers")
+        self._peers6 = self._decoded_data.get(b"peers6")
 
     @property
     def failure_reason(self):
         if self._failure_reason:
-            return self._failure_reason.encode()
+            return self._failure_reason.decode(errors="replace")
 
     @property
     def warning_message(self):
         if self._warning_message:
-            return self._warning_message.encode()
+            return self._warning_message.decode(errors="replace")
 
     @property
-    def peers(self):
-        if type(self._peers) == bytes:
-            data = [self._peers[i : i + 6] for i in range(0, len(self._peers), 6)]
+    def peers(self) -> List[Address]:
+        """
+        Every peer as an `(ip, port)` tuple, prefer `endpoints` for bulk use
+        """
+        return [decode_endpoint(endpoint) for endpoint in self.endpoints]
 
-            def _decode_port(bts):
-                return struct.unpack(">H", bts)[0]
-
-            return [(socket.inet_ntoa(d[:4]), _decode_port(d[4:])) for d in data]
+    @property
+    def endpoints(self) -> List[Endpoint]:
+        """
+        Every peer in compact form, from compact (BEP 23), dictionary model and `peers6`
+        (BEP 7) lists
+        """
+        endpoints = []
+
+        if isinstance(self._peers, (bytes, memoryview)):
+            endpoints += split_compact(self._peers, COMPACT_SIZE)
+        elif isinstance(self._peers, list):
+            for peer in self._peers:
+                try:
+                    address = (_text(peer[b"ip"]), int(peer[b"port"]))
+                except (KeyError, TypeError, ValueError, UnicodeDecodeError):
+                    continue
+                endpoints.append(encode_address(address))
+
+        if isinstance(self._peers6, (bytes, memoryview)):
+            endpoints += split_compact(self._peers6, COMPACT6_SIZE)
+
+        return endpoints
 
     @property
     def interval(self):
@@ -97,14 +292,16 @@ class TrackerResponse:
 
 
 class TrackerConnectionProxy:
-    def __init__(self, client, torrent, peer_id):
+    def __init__(self, client, torrent, peer_id, url=None, params=None):
         self.client = client
         self.torrent = torrent
         self.peer_id = peer_id
+        self.url = url or torrent.tracker_url
+        self.params = params
 
     async def __aenter__(self) -> TrackerResponse:
 
-        params = {
+        params = self.params or {
             "info_hash": self.torrent.info_hash,
             "peer_id": self.peer_id,
             "port": 51413,
@@ -115,71 +312,222 @@ class TrackerConnectionProxy:
             "event": "started",
         }
 
-        tracker_url = self.torrent.tracker_url + "?" + urllib.parse.urlencode(params)
-        print("conencting to", tracker_url)
+        tracker_url = self.url + ("&" if "?" in self.url else "?") + urllib.parse.urlencode(params)
+        logging.debug("Announcing to %s", self.url)
         async with self.client.get(tracker_url) as response:
             if response.status != 200:
-                raise ConnectionError()
+                raise ConnectionError(f"{self.url} answered with status {response.status}")
 
             data = await response.read()
             return TrackerResponse(bdecode(data))
 
     async def __aexit__(self, *args, **kwargs):
-        await self.client.__aexit__(*args, **kwargs)
+        # the client session is shared between announces and torrents, it is not closed here
+        pass
 
 
 class Tracker:
-    def __init__(self, torrent, client=None):
+    """
+    Announces a torrent following the tiers of its announce-list (BEP 12).
+
+    The trackers of a tier are queried concurrently and the first usable answer wins, the
+    tracker that gave it moves to the front of its tier. A tier only falls through to the next
+    one when none of its trackers answered. Both HTTP and UDP (BEP 15) trackers are supported.
+    """
+
+    TIMEOUT = 60.0
+
+    def __init__(self, torrent, client=None, udp_connections: Optional[ConnectionCache] = None):
         self.torrent = torrent
         self._client = client or aiohttp.ClientSession()
         self.peer_id = "-PT9000-t3qn65w1qoni"
+        self.port = 51413
+        self.tiers = [list(tier) for tier in torrent.announce_tiers]
+        self.udp_connections = {} if udp_connections is None else udp_connections
 
     def connect(self) -> TrackerConnectionProxy:
 
         return TrackerConnectionProxy(self._client, self.torrent, self.peer_id)
 
+    async def announce(
+        self, uploaded: int = 0, downloaded: int = 0, left: int = None, event: str = ""
+    ) -> TrackerResponse:
+        """
+        Raises `ConnectionError` when no tracker answered. When trackers answered but all of
+        them refused the announce, the last refusal is returned.
+        """
+        params = {
+            "info_hash": self.torrent.info_hash,
+            "peer_id": self.peer_id,
+            "port": self.port,
+            "uploaded": uploaded,
+            "downloaded": downloaded,
+            "left": self.torrent.total_size if left is None else left,
+            "compact": 1,
+        }
+        if event:
+            params["event"] = event
+
+        refused = None
+        for tier in self.tiers:
+            response = await self._announce_tier(tier, params)
+            if response is None:
+                continue
+            if not response.failure_reason:
+                return response
+            refused = response
+
+        if refused:
+            return refused
+        raise ConnectionError("No tracker answered")
+
+    async def _announce_tier(self, tier: List[str], params: dict) -> Optional[TrackerResponse]:
+        tasks = {asyncio.ensure_future(self._announce_url(url, params)): url for url in tier}
+        refused = None
+
+        try:
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+
+                for task in done:
+                    url = tasks[task]
+                    try:
+                        response = task.result()
+                    except Exception as e:
+                        logging.info("Announce to %s failed: %s", url, e or type(e).__name__)
+                        continue
+
+                    if response.failure_reason:
+                        logging.info("%s refused: %s", url, response.failure_reason)
+                        refused = response
+                        continue
+
+                    tier.remove(url)
+                    tier.insert(0, url)
+                    return response
+
+        finally:
+            for task in tasks:
+                task.cancel()
+
+        return refused
+
+    async def _announce_url(self, url: str, params: dict) -> TrackerResponse:
+        parsed = urllib.parse.urlsplit(url)
+
+        if parsed.scheme == "udp":
+            tracker = UDPTracker(parsed.hostname, parsed.port, self.udp_connections)
+            data = await asyncio.wait_for(
+                tracker.announce(
+                    params["info_hash"],
+                    params["peer_id"].encode(),
+                    params["port"],
+                    params["uploaded"],
+                    params["downloaded"],
+                    params["left"],
+                    params.get("event", ""),
+                ),
+                Tracker.TIMEOUT,
+            )
+            return TrackerResponse(data)
+
+        if parsed.scheme in ("http", "https"):
+            proxy = TrackerConnectionProxy(self._client, self.torrent, self.peer_id, url, params)
+            return await asyncio.wait_for(proxy.__aenter__(), Tracker.TIMEOUT)
+
+        raise ValueError(f"Unsupported tracker {url}")
+
 
 class Torrent:
-    def __init__(self, file_handle_or_path: Union[str, pathlib.Path, io.RawIOBase]):
+    """
+    With `lazy` the file is memory mapped where possible and string values are zero-copy
+    views into it, so large `pieces` blobs and file lists are never copied.
+    """
+
+    def __init__(
+        self, file_handle_or_path: Union[str, pathlib.Path, io.RawIOBase, bytes], lazy=False
+    ):
 
         if isinstance(file_handle_or_path, str):
             file_handle_or_path = pathlib.Path(file_handle_or_path)
 
-        if isinstance(file_handle_or_path, pathlib.Path):
+        if isinstance(file_handle_or_path, (bytes, bytearray, memoryview)):
+            buffer = file_handle_or_path
+
+        elif isinstance(file_handle_or_path, pathlib.Path):
             with open(file_handle_or_path, "rb") as file_handle:
-                data = bdecode(file_handle.read())
+                buffer = self._read(file_handle, lazy)
 
         elif isinstance(file_handle_or_path, io.BufferedIOBase) or hasattr(
             file_handle_or_path, "read"
         ):
-            data = bdecode(file_handle_or_path.read())
+            buffer = self._read(file_handle_or_path, lazy)
 
         else:
             raise ValueError
 
-        self.announce = data[b"announce"].decode()
-        self.announce_list = [x[0] for x in data.get(b"announce-list", [[]])]
-        if not self.announce_list:
-            self.announce_list = [self.announce]
-        self.comment = data.get(b"comment", b"").decode()
-        self.created_by = data.get(b"created by", b"").decode()
+        data = bdecode(buffer, views=lazy)
+
+        self.announce = _text(data.get(b"announce"))
+        # BEP 12: trackers within a tier are tried in random order
+        self.announce_tiers = [
+            random.sample([_text(url) for url in tier], len(tier))
+            for tier in data.get(b"announce-list", [])
+            if tier
+        ]
+        if not self.announce_tiers and self.announce:
+            self.announce_tiers = [[self.announce]]
+        self.announce_list = [url for tier in self.announce_tiers for url in tier]
+        self.comment = _text(data.get(b"comment"))
+        self.created_by = _text(data.get(b"created by"))
         self.creation_date = datetime.utcfromtimestamp(data.get(b"creation date", 0))
         self.info = TorrentInfo(data[b"info"])
-        self.locale = data.get(b"locale", b"").decode()
-        self.title = data.get(b"title", b"").decode()
-        self.url_list = [x.decode() for x in data.get(b"url-list", [])]
+        # pieces root -> the concatenated piece hashes of that file, for v2 torrents
+        self.piece_layers = {
+            bytes(root): layer for root, layer in data.get(b"piece layers", {}).items()
+        }
+        self.locale = _text(data.get(b"locale"))
+        self.title = _text(data.get(b"title"))
+        self.url_list = [_text(x) for x in data.get(b"url-list", [])]
 
         self._raw_data = data
+        # the metainfo as read, encoding `_raw_data` again does not give the same info hash for
+        # info dicts that are not in canonical form
+        self._buffer = buffer
 
+        info_start, info_end = data[b"info"].span
         self.tracker_url = self.announce
-        self.info_hash = hashlib.sha1(bencode(self.info._raw_data)).digest()
+        info_bytes = memoryview(buffer)[info_start:info_end]
+        self.info_hash_v2 = hashlib.sha256(info_bytes).digest() if self.info.has_v2 else None
+        # v2 only torrents are known by their truncated v2 info hash on the wire and to trackers
+        if self.info.has_v1 or not self.info.has_v2:
+            self.info_hash = hashlib.sha1(info_bytes).digest()
+        else:
+            self.info_hash = self.info_hash_v2[:20]
         self.downloaded = 0
         self.peer_id = "-PT9000-t3qn65w1qoni"
         self.port = 51413
-        self.total_size = self.info.length or sum([file.length for file in self.info.files])
+        self.total_size = self.info.total_length
 
         self.peers = None
 
+    def to_bytes(self) -> bytes:
+        """
+        The metainfo as read, e.g. to hand the torrent to another process
+        """
+        return bytes(self._buffer)
+
+    @staticmethod
+    def _read(file_handle, lazy: bool):
+        if lazy:
+            try:
+                return mmap.mmap(file_handle.fileno(), 0, access=mmap.ACCESS_READ)
+            except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+                pass
+
+        return file_handle.read()
+
     def get_params(self):
         return {
             "info_hash": urllib.parse.quote(self.info_hash),
@@ -0,0 +1,193 @@
+import asyncio
+import logging
+import random
+import struct
+import time
+from typing import Callable, Dict, Optional, Tuple
+
+_CONNECT = struct.Struct(">QII")
+_ANNOUNCE = struct.Struct(">QII20s20sQQQIIIiH")
+_ANNOUNCE_RESPONSE = struct.Struct(">IIIII")
+_CONNECT_RESPONSE = struct.Struct(">IIQ")
+_HEADER = struct.Struct(">II")
+
+# cached connection ids by tracker address, shared by every torrent announcing to it
+ConnectionCache = Dict[Tuple[str, int], Tuple[int, float]]
+
+
+class UDPTrackerError(ConnectionError):
+    pass
+
+
+class _UDPTrackerProtocol(asyncio.DatagramProtocol):
+    """
+    Matches responses to requests by transaction id, anything else is dropped
+    """
+
+    def __init__(self):
+        self.transport: Optional[asyncio.DatagramTransport] = None
+        self._waiters: Dict[int, asyncio.Future] = {}
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if len(data) < _HEADER.size:
+            return
+
+        _, transaction_id = _HEADER.unpack_from(data)
+        waiter = self._waiters.pop(transaction_id, None)
+        if waiter and not waiter.done():
+            waiter.set_result(data)
+
+    def error_received(self, exc):
+        # e.g. ICMP port unreachable, the tracker is not there
+        self._fail(exc)
+
+    def connection_lost(self, exc):
+        self._fail(exc or ConnectionError("Tracker socket closed"))
+
+    async def request(self, build: Callable[[int], bytes], timeout: float) -> bytes:
+        transaction_id = random.getrandbits(32)
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters[transaction_id] = waiter
+
+        try:
+            self.transport.sendto(build(transaction_id))
+            return await asyncio.wait_for(waiter, timeout)
+        finally:
+            self._waiters.pop(transaction_id, None)
+
+    def _fail(self, exc: Exception):
+        for waiter in self._waiters.values():
+            if not waiter.done():
+                waiter.set_exception(exc)
+        self._waiters.clear()
+
+
+class UDPTracker:
+    """
+    Announces over the UDP tracker protocol (BEP 15).
+
+    A connection id is obtained once and reused by every announce to the same tracker until it
+    expires. Unanswered requests are sent again after `BASE_TIMEOUT * 2 ** n` seconds, `n`
+    growing up to `MAX_RETRIES`.
+    """
+
+    PROTOCOL_ID = 0x41727101980
+
+    CONNECT = 0
+    ANNOUNCE = 1
+    SCRAPE = 2
+    ERROR = 3
+
+    EVENTS = {"": 0, "completed": 1, "started": 2, "stopped": 3}
+
+    BASE_TIMEOUT = 15.0
+    MAX_RETRIES = 8
+    CONNECTION_ID_TTL = 60.0
+
+    def __init__(self, host: str, port: int, connections: Optional[ConnectionCache] = None):
+        self.host = host
+        self.port = port
+        self.connections = {} if connections is None else connections
+        self.key = random.getrandbits(32)
+
+    async def announce(
+        self,
+        info_hash: bytes,
+        peer_id: bytes,
+        port: int,
+        uploaded: int = 0,
+        downloaded: int = 0,
+        left: int = 0,
+        event: str = "",
+        num_want: int = -1,
+    ) -> dict:
+        """
+        Returns the response in the same shape as a decoded HTTP tracker response
+        """
+        loop = asyncio.get_running_loop()
+        transport, protocol = await loop.create_datagram_endpoint(
+            _UDPTrackerProtocol, remote_addr=(self.host, self.port)
+        )
+
+        def _announce(connection_id: int) -> Callable[[int], bytes]:
+            return lambda transaction_id: _ANNOUNCE.pack(
+                connection_id,
+                UDPTracker.ANNOUNCE,
+                transaction_id,
+                info_hash,
+                peer_id,
+                downloaded,
+                left,
+                uploaded,
+                UDPTracker.EVENTS[event],
+                0,
+                self.key,
+                num_want,
+                port,
+            )
+
+        try:
+            for attempt in range(UDPTracker.MAX_RETRIES + 1):
+                timeout = UDPTracker.BASE_TIMEOUT * 2 ** attempt
+
+                try:
+                    connection_id = self._connection_id()
+                    if connection_id is None:
+                        connection_id = await self._connect(protocol, timeout)
+                    data = await protocol.request(_announce(connection_id), timeout)
+                except asyncio.TimeoutError:
+                    logging.debug("No answer from udp://%s:%d, retrying", self.host, self.port)
+                    continue
+
+                return self._parse_announce(data, transport.get_extra_info("peername"))
+
+            raise asyncio.TimeoutError(f"udp://{self.host}:{self.port} did not answer")
+
+        finally:
+            transport.close()
+
+    def _connection_id(self) -> Optional[int]:
+        cached = self.connections.get((self.host, self.port))
+        if cached and time.monotonic() - cached[1] < UDPTracker.CONNECTION_ID_TTL:
+            return cached[0]
+        return None
+
+    async def _connect(self, protocol: _UDPTrackerProtocol, timeout: float) -> int:
+        data = await protocol.request(
+            lambda transaction_id: _CONNECT.pack(
+                UDPTracker.PROTOCOL_ID, UDPTracker.CONNECT, transaction_id
+            ),
+            timeout,
+        )
+
+        action = _HEADER.unpack_from(data)[0]
+        if action == UDPTracker.ERROR:
+            raise UDPTrackerError(data[_HEADER.size :].decode(errors="replace"))
+        if action != UDPTracker.CONNECT or len(data) < _CONNECT_RESPONSE.size:
+            raise UDPTrackerError("Invalid connect response")
+
+        connection_id = _CONNECT_RESPONSE.unpack_from(data)[2]
+        self.connections[(self.host, self.port)] = (connection_id, time.monotonic())
+        return connection_id
+
+    def _parse_announce(self, data: bytes, peername) -> dict:
+        action = _HEADER.unpack_from(data)[0]
+        if action == UDPTracker.ERROR:
+            # possibly an expired connection id, get a new one next time
+            self.connections.pop((self.host, self.port), None)
+            return {b"failure reason": data[_HEADER.size :]}
+        if action != UDPTracker.ANNOUNCE or len(data) < _ANNOUNCE_RESPONSE.size:
+            raise UDPTrackerError("Invalid announce response")
+
+        _, _, interval, leechers, seeders = _ANNOUNCE_RESPONSE.unpack_from(data)
+        # the peers have the address family of the tracker, compact 6 or 18 byte entries
+        ipv6 = peername is not None and len(peername) == 4
+        return {
+            b"interval": interval,
+            b"incomplete": leechers,
+            b"complete": seeders,
+            b"peers6" if ipv6 else b"peers": bytes(data[_ANNOUNCE_RESPONSE.size :]),
+        }
@@ -0,0 +1,198 @@
+import asyncio
+import logging
+import os
+from collections import OrderedDict
+from functools import partial
+from typing import Dict, Optional
+
+from .peer_connection import Piece
+from .piece_manager import BLOCK_SIZE, Bitfield, PieceManager
+from .storage import Storage
+
+
+class BlockCache:
+    """
+    Bounded LRU cache of whole pieces for serving requests.
+
+    A miss reads the complete piece in one go, peers usually request every block of a piece in
+    order, so the following blocks are served from memory. Concurrent misses on the same piece
+    share one read.
+    """
+
+    MAX_BYTES = 32 * 1024 * 1024
+
+    def __init__(self, storage: Storage, max_bytes: int = MAX_BYTES):
+        self.storage = storage
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+        self._pieces: "OrderedDict[int, bytes]" = OrderedDict()
+        self._reading: Dict[int, asyncio.Future] = {}
+
+    def __contains__(self, index: int) -> bool:
+        return index in self._pieces
+
+    def put(self, index: int, data: bytes):
+        if len(data) > self.max_bytes or index in self._pieces:
+            return
+
+        self._pieces[index] = data
+        self.size += len(data)
+        while self.size > self.max_bytes:
+            _, evicted = self._pieces.popitem(last=False)
+            self.size -= len(evicted)
+
+    async def read(self, index: int, begin: int, length: int) -> memoryview:
+        piece = self._pieces.get(index)
+
+        if piece is not None:
+            self.hits += 1
+            self._pieces.move_to_end(index)
+        else:
+            self.misses += 1
+            future = self._reading.get(index)
+            if future is None:
+                future = self._reading[index] = asyncio.ensure_future(
+                    self.storage.read(index, 0, None)
+                )
+                future.add_done_callback(lambda _: self._reading.pop(index, None))
+
+            # one cancelled reader must not cancel the read for the others
+            piece = await asyncio.shield(future)
+            self.put(index, piece)
+
+        return memoryview(piece)[begin : begin + length]
+
+
+class _FileView:
+    """
+    What `loop.sendfile` needs of a file, for a descriptor borrowed from the storage pool.
+    Only positional reads are done on the descriptor so the seek is not needed.
+    """
+
+    __slots__ = ("fd",)
+    mode = "rb"
+
+    def __init__(self, fd: int):
+        self.fd = fd
+
+    def fileno(self) -> int:
+        return self.fd
+
+    def seek(self, offset: int, whence: int = 0):
+        pass
+
+
+class Uploader:
+    """
+    Serves the block requests of every connection of a torrent.
+
+    Requests are only honoured for pieces on disk. Blocks of pieces that are cached are
+    written from memory, others are handed to the kernel with `loop.sendfile` when the
+    transport supports it so the data never passes through user space, the rest is read
+    through the `BlockCache`.
+    """
+
+    MAX_REQUEST_LENGTH = 128 * 1024
+    SENDFILE_MIN_LENGTH = BLOCK_SIZE
+
+    def __init__(
+        self,
+        storage: Storage,
+        have: Bitfield,
+        piece_manager: PieceManager,
+        cache: Optional[BlockCache] = None,
+        sendfile: bool = True,
+    ):
+        self.storage = storage
+        self.have = have
+        self.piece_manager = piece_manager
+        self.cache = cache or BlockCache(storage)
+        self.sendfile = sendfile and hasattr(os, "sendfile")
+        self.uploaded = 0
+
+        self._advised: "OrderedDict[int, None]" = OrderedDict()
+
+    def validate(self, index: int, begin: int, length: int) -> bool:
+        if not 0 <= index < self.piece_manager.piece_count or index not in self.have:
+            return False
+        if not 0 < length <= Uploader.MAX_REQUEST_LENGTH:
+            return False
+        return 0 <= begin and begin + length <= self.piece_manager.piece_size(index)
+
+    def piece_written(self, index: int, data: bytes):
+        """
+        A freshly downloaded piece is likely to be requested soon, keep it around
+        """
+        self.cache.put(index, data)
+
+    async def send(self, protocol, index: int, begin: int, length: int):
+        header = Piece.header(index, begin, length)
+
+        if index not in self.cache and self._can_sendfile(protocol, length):
+            segments = self.storage.piece_segments(index, begin, length)
+            if len(segments) == 1 and not self.storage.files[segments[0][0]].padding:
+                file_index, offset, size = segments[0]
+                try:
+                    fd = await self._borrow(file_index, offset - begin, self._read_ahead(index))
+                    try:
+                        await protocol.sendfile(header, _FileView(fd), offset, size)
+                    finally:
+                        self.storage.return_file(file_index, fd)
+                except asyncio.SendfileNotAvailableError:
+                    logging.debug("sendfile is not available, using the block cache")
+                    protocol.sendfile_available = False
+                else:
+                    self.uploaded += length
+                    return
+
+        data = await self.cache.read(index, begin, length)
+        protocol.writelines([header, data])
+        self.uploaded += length
+
+    def _can_sendfile(self, protocol, length: int) -> bool:
+        return (
+            self.sendfile
+            and length >= Uploader.SENDFILE_MIN_LENGTH
+            and getattr(protocol, "sendfile_available", False)
+        )
+
+    def _read_ahead(self, index: int) -> int:
+        # ask the kernel to fetch the whole piece once, the other blocks follow shortly
+        if index in self._advised or not hasattr(os, "posix_fadvise"):
+            return 0
+
+        self._advised[index] = None
+        if len(self._advised) > 1024:
+            self._advised.popitem(last=False)
+        return self.piece_manager.piece_size(index)
+
+    async def _borrow(self, file_index: int, piece_offset: int, read_ahead: int) -> int:
+        # opening may create the file and the advice may wait for the disk, both run on the
+        # storage pool, only the sendfile itself is driven by the event loop
+        borrowing = asyncio.ensure_future(
+            self.storage.run(_borrow_file, self.storage, file_index, piece_offset, read_ahead)
+        )
+        try:
+            return await asyncio.shield(borrowing)
+        except asyncio.CancelledError:
+            borrowing.add_done_callback(partial(_return_file, self.storage, file_index))
+            raise
+
+
+def _borrow_file(storage: Storage, file_index: int, piece_offset: int, read_ahead: int) -> int:
+    fd = storage.borrow_file(file_index)
+    if read_ahead:
+        try:
+            os.posix_fadvise(fd, max(piece_offset, 0), read_ahead, os.POSIX_FADV_WILLNEED)
+        except OSError:
+            pass
+    return fd
+
+
+def _return_file(storage: Storage, file_index: int, borrowing: asyncio.Future):
+    # the borrow finished after the request was cancelled
+    if not borrowing.cancelled() and borrowing.exception() is None:
+        storage.return_file(file_index, borrowing.result())
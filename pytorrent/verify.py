@@ -0,0 +1,192 @@
+import asyncio
+import hashlib
+import logging
+import os
+from concurrent.futures import Executor, ThreadPoolExecutor
+from functools import partial
+from typing import Callable, List, Optional, Sequence, Tuple
+
+from .storage import Storage
+
+_Job = Tuple[int, bytes, bytes]
+
+# hashes the data of a piece, called with the piece index and its data
+HashPiece = Callable[[int, bytes], bytes]
+
+
+def sha1_piece(index: int, data: bytes) -> bytes:
+    return hashlib.sha1(data).digest()
+
+
+def hash_storage(
+    storage: Storage,
+    count: Optional[int] = None,
+    workers: Optional[int] = None,
+    hash_piece: HashPiece = sha1_piece,
+    progress: Optional[Callable[[int, int], None]] = None,
+    thread_name_prefix: str = "pytorrent-hash",
+) -> List[Optional[bytes]]:
+    """
+    The digests of the first `count` pieces of `storage`, all by default, None for pieces that
+    could not be read. Hashed on a thread pool, `progress(done, total)` is called as they are.
+
+    Every task hashes a run of consecutive pieces, so each thread reads sequentially with large
+    positional reads into its own reusable buffer, across file boundaries where pieces span
+    files. Reads and hashing release the GIL, so threads scale with cores and disks.
+    """
+    workers = workers or os.cpu_count() or 1
+    if count is None:
+        count = -(-storage.total_length // storage.piece_length)
+
+    def _hash(indexes: range) -> List[Optional[bytes]]:
+        buffer = memoryview(bytearray(storage.piece_length))
+        digests = []
+        for index in indexes:
+            try:
+                length = storage.read_into(index, buffer)
+            except OSError as e:
+                logging.debug("Unable to read piece %d: %s", index, e)
+                digests.append(None)
+                continue
+            digests.append(hash_piece(index, buffer[:length]))
+        return digests
+
+    chunk = max(1, min(64, count // (workers * 4)))
+    chunks = [range(i, min(i + chunk, count)) for i in range(0, count, chunk)]
+
+    digests: List[Optional[bytes]] = []
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix=thread_name_prefix) as pool:
+        for result in pool.map(_hash, chunks):
+            digests.extend(result)
+            if progress is not None:
+                progress(len(digests), count)
+
+    return digests
+
+
+def _hash_batch(batch: List[_Job], hash_piece: HashPiece) -> List[bool]:
+    # hashlib releases the GIL for large buffers, so batches hash in parallel on the pool
+    return [hash_piece(index, data) == digest for index, data, digest in batch]
+
+
+class PieceVerifier:
+    """
+    Checks completed pieces against their SHA-1 digests on a thread pool, or against other
+    digests with `hash_piece`, e.g. the merkle roots of v2 torrents.
+
+    Pieces smaller than `BATCH_BYTES` are grouped so one pool task hashes several of them.
+    At most `max_pending_bytes` of piece data wait for a result, `submit` blocks until there is
+    room so a slow disk or CPU pushes back on the peer connections instead of piling up memory.
+    Every result is reported through `on_result(index, valid)` on the event loop. It may return
+    a future, e.g. of writing the piece to disk, the piece counts as pending until it is done so
+    a slow disk pushes back as well.
+    """
+
+    BATCH_BYTES = 1024 * 1024
+    MAX_PENDING_BYTES = 64 * 1024 * 1024
+
+    def __init__(
+        self,
+        piece_hashes: Sequence[bytes],
+        on_result: Callable[[int, bool], Optional[asyncio.Future]],
+        max_pending_bytes: int = MAX_PENDING_BYTES,
+        executor: Optional[Executor] = None,
+        hash_piece: HashPiece = sha1_piece,
+    ):
+        self.piece_hashes = piece_hashes
+        self.on_result = on_result
+        self.hash_piece = hash_piece
+        self.max_pending_bytes = max_pending_bytes
+
+        self.pending_bytes = 0
+        self.pending_pieces = 0
+
+        self._owns_executor = executor is None
+        self._executor = executor or ThreadPoolExecutor(
+            max_workers=min(4, os.cpu_count() or 1), thread_name_prefix="pytorrent-verify"
+        )
+
+        self._batch: List[_Job] = []
+        self._batch_bytes = 0
+        self._flush_handle: Optional[asyncio.Handle] = None
+        self._waiters: List[asyncio.Future] = []
+
+    async def submit(self, index: int, data: bytes):
+        size = len(data)
+
+        while self.pending_bytes and self.pending_bytes + size > self.max_pending_bytes:
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            await waiter
+
+        self.pending_bytes += size
+        self.pending_pieces += 1
+
+        self._batch.append((index, data, self.piece_hashes[index]))
+        self._batch_bytes += size
+
+        if self._batch_bytes >= PieceVerifier.BATCH_BYTES:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_soon(self._flush)
+
+    async def join(self):
+        """
+        Wait until every submitted piece has been reported
+        """
+        while self.pending_pieces:
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            await waiter
+
+    async def run(self, function: Callable, *args):
+        """
+        Run other hashing on the pool of the verifier, e.g. to answer hash requests
+        """
+        return await asyncio.get_running_loop().run_in_executor(self._executor, function, *args)
+
+    def close(self):
+        if self._owns_executor:
+            self._executor.shutdown(wait=False)
+
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+        if not self._batch:
+            return
+
+        batch, self._batch, self._batch_bytes = self._batch, [], 0
+
+        future = asyncio.get_running_loop().run_in_executor(
+            self._executor, _hash_batch, batch, self.hash_piece
+        )
+        future.add_done_callback(partial(self._done, batch))
+
+    def _done(self, batch: List[_Job], future: asyncio.Future):
+        try:
+            results = future.result()
+        except Exception as e:
+            logging.error("Hashing %d pieces failed: %s", len(batch), e)
+            results = [False] * len(batch)
+
+        for (index, data, _), valid in zip(batch, results):
+            self.pending_pieces -= 1
+            saving = self.on_result(index, valid)
+            if saving is None:
+                self.pending_bytes -= len(data)
+            else:
+                saving.add_done_callback(partial(self._saved, len(data)))
+
+        self._wake()
+
+    def _saved(self, size: int, future: asyncio.Future):
+        self.pending_bytes -= size
+        self._wake()
+
+    def _wake(self):
+        waiters, self._waiters = self._waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
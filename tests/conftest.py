@@ -0,0 +1,33 @@
+import asyncio
+
+import pytest
+
+
+class FakeTransport(asyncio.Transport):
+    """
+    Collects what a protocol writes and records flow control calls
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.paused = False
+        self.written = bytearray()
+        self.writes = 0
+
+    def pause_reading(self):
+        self.paused = True
+
+    def resume_reading(self):
+        self.paused = False
+
+    def write(self, data):
+        self.written += data
+
+    def writelines(self, data):
+        self.writes += 1
+        super().writelines(data)
+
+
+@pytest.fixture
+def transport() -> FakeTransport:
+    return FakeTransport()
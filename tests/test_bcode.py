@@ -1,6 +1,9 @@
+import hashlib
+import io
+
 import pytest
 
-from pytorrent.bcode import bencode, bdecode
+from pytorrent.bcode import BDecodeError, bencode, bencode_into, bdecode
 
 
 @pytest.mark.parametrize("test_input,expected", [(0, b"i0e"), (1, b"i1e"), (-1, b"i-1e")])
@@ -96,3 +99,75 @@ def test_decode_complex():
 )
 def test_decode_complex_p(test_input, expected):
     assert bdecode(test_input) == expected
+
+
+@pytest.mark.parametrize(
+    "test_input", [b"i03e", b"i-0e", b"03:abc", b"d1:bi1e1:ai2ee", b"d1:ai1e1:ai2ee", b"i1ei2e"]
+)
+def test_decode_strict_rejects(test_input):
+    bdecode(test_input)
+
+    with pytest.raises(BDecodeError):
+        bdecode(test_input, strict=True)
+
+
+@pytest.mark.parametrize("test_input", [b"", b"i12", b"ie", b"i1_0e", b"5:spam", b"l4:spam", b"x"])
+def test_decode_invalid(test_input):
+    with pytest.raises(BDecodeError):
+        bdecode(test_input)
+
+
+def test_decode_views():
+    data = b"d4:infod6:pieces4:abcde4:spaml3:fooee"
+    decoded = bdecode(data, views=True)
+
+    pieces = decoded[b"info"][b"pieces"]
+    assert isinstance(pieces, memoryview)
+    assert pieces.obj is data
+    assert pieces == b"abcd"
+    assert decoded[b"spam"][0] == b"foo"
+
+
+def test_decode_dict_span():
+    data = b"d8:announce3:url4:infod6:lengthi42e4:name3:fooee"
+    decoded = bdecode(data)
+
+    start, end = decoded[b"info"].span
+    assert data[start:end] == b"d6:lengthi42e4:name3:fooe"
+    assert decoded.span == (0, len(data))
+
+
+def test_encode_dict_sorts_keys():
+    assert bencode({"foo": 42, b"bar": "spam"}) == b"d3:bar4:spam3:fooi42ee"
+
+
+def test_encode_dict_duplicate_keys():
+    with pytest.raises(ValueError):
+        bencode({"foo": 1, b"foo": 2})
+
+
+def test_encode_unicode_string():
+    assert bencode("zażółć") == b"10:" + "zażółć".encode()
+
+
+def test_encode_into_stream_and_hash():
+    data = {b"info": {b"pieces": b"\x00" * 40, b"name": "foo", b"length": 42}}
+    expected = bencode(data)
+
+    out = bytearray(b"prefix")
+    bencode_into(data, out)
+    assert out == b"prefix" + expected
+
+    stream = io.BytesIO()
+    bencode_into(data, stream)
+    assert stream.getvalue() == expected
+
+    digest = hashlib.sha1()
+    bencode_into(data, digest)
+    assert digest.digest() == hashlib.sha1(expected).digest()
+
+
+def test_encode_decode_roundtrip():
+    data = b"d4:infod6:lengthi42e4:name3:foo6:pieces4:abcdee"
+    assert bencode(bdecode(data)) == data
+    assert bencode(bdecode(data, views=True)) == data
@@ -0,0 +1,32 @@
+import json
+
+from benchmarks import run
+
+
+def test_runner_writes_json(tmp_path, capsys):
+    output = tmp_path / "results.json"
+    run.main(["-k", "wire/request", "--min-time", "0.001", "--repeat", "2", "-o", str(output)])
+
+    report = json.loads(output.read_text())
+    assert set(report["results"]) == {"wire/request-encode", "wire/request-decode"}
+    result = report["results"]["wire/request-encode"]
+    assert len(result["samples"]) == 2
+    assert result["mb_per_sec"] > 0
+
+    run.main(["-k", "wire/request-decode", "--min-time", "0.001", "--compare", str(output)])
+    assert "vs baseline" in capsys.readouterr().out
+
+
+def test_benchmarks_set_up():
+    # every benchmark runs once, so they do not rot between runs
+    for name in (
+        "bcode/bdecode-tracker-dict",
+        "wire/framing-1500-reads",
+        "storage/write-blocks",
+        "create/hash-pieces",
+    ):
+        call, nbytes, teardown = run.BENCHMARKS[name]()
+        call()
+        if teardown is not None:
+            teardown()
+        assert nbytes > 0
@@ -0,0 +1,115 @@
+import asyncio
+
+import pytest
+
+from pytorrent.budget import ResourceBudget
+
+
+def test_budget_fair_share():
+    async def _run():
+        budget = ResourceBudget(4)
+        for owner in "abc":
+            budget.register(owner)
+
+        for _ in range(4):
+            await budget.acquire("a")
+
+        # "b" asked first but "c" holds nothing, so both end up with one slot
+        waiters = [asyncio.ensure_future(budget.acquire(owner)) for owner in "bbc"]
+        await asyncio.sleep(0)
+        assert not any(waiter.done() for waiter in waiters)
+
+        budget.release("a")
+        budget.release("a")
+        await asyncio.sleep(0)
+
+        assert [waiter.done() for waiter in waiters] == [True, False, True]
+        assert (budget.in_use("a"), budget.in_use("b"), budget.in_use("c")) == (2, 1, 1)
+
+        budget.unregister("a")
+        await asyncio.sleep(0)
+        assert waiters[1].done()
+        assert budget.used == 3
+
+    asyncio.run(_run())
+
+
+def test_budget_cancelled_waiter():
+    async def _run():
+        budget = ResourceBudget(1)
+        await budget.acquire("a")
+
+        waiter = asyncio.ensure_future(budget.acquire("b"))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        await asyncio.sleep(0)
+
+        budget.release("a")
+        assert budget.used == 0
+
+        async with budget.slot("b"):
+            assert budget.in_use("b") == 1
+        assert budget.used == 0
+
+    asyncio.run(_run())
+
+
+def test_budget_cancelled_waiter_already_dropped():
+    async def _run():
+        budget = ResourceBudget(1)
+        await budget.acquire("a")
+
+        # cancelled, then skipped by the release before it ran again
+        woken = asyncio.ensure_future(budget.acquire("b"))
+        await asyncio.sleep(0)
+        woken.cancel()
+        budget.release("a")
+        with pytest.raises(asyncio.CancelledError):
+            await woken
+        assert budget.used == 0
+
+        # cancelled, then its owner unregistered, as when a torrent is removed
+        await budget.acquire("a")
+        removed = asyncio.ensure_future(budget.acquire("b"))
+        await asyncio.sleep(0)
+        removed.cancel()
+        budget.unregister("b")
+        with pytest.raises(asyncio.CancelledError):
+            await removed
+
+        # granted a slot just before being cancelled, the slot is given back
+        granted = asyncio.ensure_future(budget.acquire("c"))
+        await asyncio.sleep(0)
+        budget.release("a")
+        assert budget.in_use("c") == 1
+        granted.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await granted
+        assert budget.used == 0
+
+    asyncio.run(_run())
+
+
+def test_budget_excess():
+    async def _run():
+        budget = ResourceBudget(4)
+        for owner in "ab":
+            budget.register(owner)
+        for _ in range(4):
+            await budget.acquire("a")
+
+        # nobody else wants a slot
+        assert budget.excess("a") == 0
+
+        waiter = asyncio.ensure_future(budget.acquire("b"))
+        await asyncio.sleep(0)
+        assert budget.fair_share == 2
+        assert (budget.excess("a"), budget.excess("b")) == (2, 0)
+
+        budget.release("a")
+        await waiter
+        # "b" got the slot and waits no more
+        assert budget.excess("a") == 0
+        assert not budget._waiters
+
+    asyncio.run(_run())
@@ -0,0 +1,106 @@
+import pytest
+
+from pytorrent.choker import Choker, RateMeter
+
+
+class FakePeer:
+    def __init__(self, name, download=0, upload=0, interested=True):
+        self.name = name
+        self.am_choking = True
+        self.peer_interested = interested
+        self.connected_at = None
+        self.download_rate = RateMeter()
+        self.upload_rate = RateMeter()
+        self.download_rate.add(0, now=0)
+        self.download_rate.add(download, now=0)
+        self.upload_rate.add(0, now=0)
+        self.upload_rate.add(upload, now=0)
+
+    def choke(self):
+        self.am_choking = True
+
+    def unchoke(self):
+        self.am_choking = False
+
+    def __repr__(self):
+        return self.name
+
+
+class FakePool:
+    def __init__(self, peers):
+        self.connections = {i: peer for i, peer in enumerate(peers)}
+
+
+class FakePieceManager:
+    complete = False
+
+
+def unchoked(peers):
+    return {peer.name for peer in peers if not peer.am_choking}
+
+
+def test_rate_meter():
+    meter = RateMeter()
+    meter.add(0, now=0)
+    meter.add(1000, now=0.5)
+    # nothing is folded before a tick has passed
+    assert meter.rate(now=0.9) == 0
+
+    first = meter.rate(now=1)
+    assert 0 < first < 1000
+    for second in range(1, 60):
+        meter.add(1000, now=second)
+    assert meter.rate(now=60) == pytest.approx(1000, rel=0.1)
+    assert meter.rate(now=120) < 100
+    assert meter.total == 60 * 1000
+
+
+def test_tit_for_tat_and_seed_mode():
+    peers = [
+        FakePeer("fast", download=9000, upload=10),
+        FakePeer("medium", download=5000, upload=20),
+        FakePeer("slow", download=100, upload=9000),
+        FakePeer("idle", interested=False, download=10 ** 6),
+    ]
+    piece_manager = FakePieceManager()
+    choker = Choker(FakePool(peers), piece_manager, slots=2)
+
+    choker.rechoke(now=10)
+    # two regular slots by download rate, the optimistic slot goes to the only other peer
+    assert unchoked(peers) == {"fast", "medium", "slow"}
+    assert choker.optimistic.name == "slow"
+
+    piece_manager.complete = True
+    choker.rechoke(now=20)
+    assert unchoked(peers) == {"slow", "medium", "fast"}
+    assert choker.optimistic.name == "fast"
+
+
+def test_optimistic_rotation():
+    peers = [FakePeer("top", download=1000)] + [FakePeer(f"p{i}") for i in range(5)]
+    choker = Choker(FakePool(peers), FakePieceManager(), slots=1)
+
+    choker.rechoke(now=10)
+    first = choker.optimistic
+    assert unchoked(peers) == {"top", first.name}
+
+    choker.rechoke(now=20)
+    assert choker.optimistic is first
+
+    seen = set()
+    for round in range(30):
+        choker.rechoke(now=50 + round * Choker.OPTIMISTIC_INTERVAL)
+        seen.add(choker.optimistic.name)
+        assert len(unchoked(peers)) == 2
+    assert len(seen) > 1
+
+
+def test_interested_fills_free_slots():
+    peers = [FakePeer(f"p{i}", interested=False) for i in range(4)]
+    choker = Choker(FakePool(peers), FakePieceManager(), slots=2)
+
+    for peer in peers:
+        peer.peer_interested = True
+        choker.interested(peer)
+
+    assert unchoked(peers) == {"p0", "p1", "p2"}
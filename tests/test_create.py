@@ -0,0 +1,129 @@
+import hashlib
+import os
+
+import pytest
+
+from pytorrent.bcode import bdecode, bencode
+from pytorrent.create import (
+    MAX_PIECE_LENGTH,
+    MIN_PIECE_LENGTH,
+    find_files,
+    make_torrent,
+    piece_length_for,
+)
+from pytorrent.torrent import Torrent, TorrentInfo
+
+PIECE_LENGTH = 16 * 1024
+
+
+def _pieces(data: bytes, piece_length: int = PIECE_LENGTH) -> bytes:
+    return b"".join(
+        hashlib.sha1(data[i : i + piece_length]).digest()
+        for i in range(0, len(data), piece_length)
+    )
+
+
+@pytest.fixture
+def shared(tmp_path):
+    # pieces span from a into b, across the empty file, and from b into sub/c
+    root = tmp_path / "shared"
+    (root / "sub").mkdir(parents=True)
+    contents = {
+        "a": os.urandom(20000),
+        "b": os.urandom(30000),
+        "empty": b"",
+        "sub/c": os.urandom(PIECE_LENGTH * 3 + 7),
+    }
+    for name, data in contents.items():
+        (root / name).write_bytes(data)
+    return root, contents
+
+
+def test_piece_length_for():
+    assert piece_length_for(1) == MIN_PIECE_LENGTH
+    assert piece_length_for(1500 * MIN_PIECE_LENGTH) == MIN_PIECE_LENGTH
+    assert piece_length_for(1500 * MIN_PIECE_LENGTH + 1) == 2 * MIN_PIECE_LENGTH
+    assert piece_length_for(4 * 2**30) == 4 * 2**20
+    assert piece_length_for(2**50) == MAX_PIECE_LENGTH
+
+
+def test_find_files(shared):
+    root, _ = shared
+    assert [components for _, components in find_files(root)] == [
+        [b"a"],
+        [b"b"],
+        [b"empty"],
+        [b"sub", b"c"],
+    ]
+    assert find_files(root / "a") == [(root / "a", [])]
+
+
+@pytest.mark.parametrize("workers", [1, 4])
+def test_make_torrent_directory(shared, workers):
+    root, contents = shared
+    metainfo = make_torrent(
+        root,
+        trackers=["http://a/announce", ["http://b/announce", "udp://c:80"]],
+        piece_length=PIECE_LENGTH,
+        comment="test",
+        creation_date=1234,
+        workers=workers,
+    )
+
+    # canonical, so decoding and encoding again gives the same bytes
+    assert bencode(bdecode(metainfo)) == metainfo
+
+    torrent = Torrent(metainfo)
+    assert torrent.info.mode == TorrentInfo.MULTI_FILE_MODE
+    assert torrent.info.name == b"shared"
+    assert [(file.path, file.length) for file in torrent.info.files] == [
+        ([b"a"], 20000),
+        ([b"b"], 30000),
+        ([b"empty"], 0),
+        ([b"sub", b"c"], PIECE_LENGTH * 3 + 7),
+    ]
+    assert torrent.info._raw_data[b"pieces"] == _pieces(b"".join(contents.values()))
+    assert torrent.announce == "http://a/announce"
+    assert sorted(torrent.announce_list) == ["http://a/announce", "http://b/announce", "udp://c:80"]
+    assert torrent.comment == "test"
+    assert torrent.created_by == "pytorrent"
+    assert not torrent.info.private
+
+
+def test_make_torrent_single_file(shared):
+    root, contents = shared
+    metainfo = make_torrent(root / "b", trackers=["http://a/announce"], private=True)
+    data = bdecode(metainfo)
+
+    assert b"announce-list" not in data
+    info = data[b"info"]
+    assert info[b"name"] == b"b"
+    assert info[b"length"] == 30000
+    assert info[b"piece length"] == MIN_PIECE_LENGTH
+    assert info[b"pieces"] == _pieces(contents["b"])
+    assert Torrent(metainfo).info.private
+
+
+def test_make_torrent_errors(tmp_path):
+    (tmp_path / "empty").write_bytes(b"")
+    with pytest.raises(ValueError):
+        make_torrent(tmp_path)
+    with pytest.raises(FileNotFoundError):
+        make_torrent(tmp_path / "missing")
+
+    (tmp_path / "data").write_bytes(b"x")
+    with pytest.raises(ValueError):
+        make_torrent(tmp_path, piece_length=PIECE_LENGTH + 1)
+
+
+def test_create_command(shared, tmp_path, capsys):
+    import main
+
+    root, contents = shared
+    output = tmp_path / "out.torrent"
+    main.main(["create", str(root), "-o", str(output), "-t", "http://a/announce"])
+
+    torrent = Torrent(output)
+    assert torrent.info.total_length == sum(map(len, contents.values()))
+    assert torrent.announce == "http://a/announce"
+    assert "out.torrent" in capsys.readouterr().out
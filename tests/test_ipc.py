@@ -0,0 +1,50 @@
+import asyncio
+import os
+import socket
+
+import pytest
+
+from pytorrent.ipc import Channel, RemoteError
+
+
+def test_calls_and_passed_descriptors():
+    async def _run():
+        received = []
+
+        async def _handle(method, args, fds):
+            if method == "fail":
+                raise ValueError("no")
+            for fd in fds:
+                with os.fdopen(fd, "rb") as f:
+                    received.append(f.read())
+            return {"method": method, **args}
+
+        front_socket, worker_socket = socket.socketpair()
+        front = Channel(front_socket)
+        worker = Channel(worker_socket, _handle)
+        front.start()
+        worker.start()
+
+        assert await front.call("echo", value=[1, "a"]) == {"method": "echo", "value": [1, "a"]}
+        with pytest.raises(RemoteError):
+            await front.call("fail")
+
+        # the sender closes its copy right away, the message holds a duplicate
+        read_end, write_end = os.pipe()
+        os.write(write_end, b"passed")
+        os.close(write_end)
+        front.notify("read", fds=[read_end])
+        os.close(read_end)
+        # messages are handled in the order they arrive
+        await front.call("echo")
+        assert received == [b"passed"]
+
+        # a large message goes out in several writes
+        assert len((await front.call("echo", data="x" * 10 ** 6))["data"]) == 10 ** 6
+
+        worker.close()
+        await front.wait_closed()
+        with pytest.raises(ConnectionResetError):
+            await front.call("echo")
+
+    asyncio.run(_run())
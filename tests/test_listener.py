@@ -0,0 +1,45 @@
+import asyncio
+
+from pytorrent.listener import Listener
+from pytorrent.peer_connection import Handshake
+
+
+def test_listener_hands_over_handshakes():
+    accepted = []
+
+    def _on_handshake(sock, handshake):
+        accepted.append(handshake.info_hash)
+        sock.close()
+        return True
+
+    async def _run():
+        listener = Listener(_on_handshake, "127.0.0.1")
+        await listener.start()
+
+        _, writer = await asyncio.open_connection("127.0.0.1", listener.port)
+        writer.write(Handshake(b"i" * 20, b"-XX0000-000000000000").encode())
+        for _ in range(100):
+            if accepted:
+                break
+            await asyncio.sleep(0.01)
+
+        # a peer that never finishes its handshake is cut off when the listener closes
+        reader, idle = await asyncio.open_connection("127.0.0.1", listener.port)
+        for _ in range(100):
+            if listener._handshakes:
+                break
+            await asyncio.sleep(0.01)
+        handshakes = set(listener._handshakes)
+        listener.close()
+        results = await asyncio.gather(*handshakes, return_exceptions=True)
+        closed = await reader.read()
+
+        writer.close()
+        idle.close()
+        return results, closed
+
+    results, closed = asyncio.run(_run())
+
+    assert accepted == [b"i" * 20]
+    assert results and all(isinstance(result, asyncio.CancelledError) for result in results)
+    assert closed == b""
@@ -0,0 +1,350 @@
+import asyncio
+import hashlib
+import os
+
+import pytest
+
+from pytorrent import merkle
+from pytorrent.bcode import bencode
+from pytorrent.merkle import BLOCK_SIZE, FileHashes, HashTree
+from pytorrent.peer_connection import (
+    Handshake,
+    HashReject,
+    HashRequest,
+    Hashes,
+    HaveAll,
+    Piece,
+    PeerConnection,
+    PeerProtocol,
+    PeerStreamIterator,
+    Request,
+)
+from pytorrent.piece_manager import Bitfield, PieceManager
+from pytorrent.storage import Storage
+from pytorrent.torrent import Torrent, TorrentInfo
+from pytorrent.upload import Uploader
+
+from .conftest import FakeTransport
+
+PIECE_LENGTH = 2 * BLOCK_SIZE
+
+
+def sha256(data: bytes) -> bytes:
+    return hashlib.sha256(data).digest()
+
+
+def reference_root(data: bytes, width: int) -> bytes:
+    # the tree spelled out: every leaf, padding included, then layer by layer
+    layer = [sha256(data[i : i + BLOCK_SIZE]) for i in range(0, len(data), BLOCK_SIZE)]
+    layer += [bytes(32)] * (width - len(layer))
+    while len(layer) > 1:
+        layer = [sha256(layer[i] + layer[i + 1]) for i in range(0, len(layer), 2)]
+    return layer[0]
+
+
+def file_hashes(data: bytes, piece_length: int = PIECE_LENGTH):
+    """
+    The pieces root and the piece layer of a file
+    """
+    blocks = -(-len(data) // BLOCK_SIZE)
+    width = 1 << max(blocks - 1, 0).bit_length()
+    if len(data) <= piece_length:
+        return reference_root(data, width), None
+
+    per_piece = piece_length // BLOCK_SIZE
+    layer = [
+        reference_root(data[i : i + piece_length], per_piece)
+        for i in range(0, len(data), piece_length)
+    ]
+    return reference_root(data, width), b"".join(layer)
+
+
+def make_metainfo(files, piece_length: int = PIECE_LENGTH, hybrid: bool = False) -> bytes:
+    tree = {}
+    layers = {}
+    for path, data in files:
+        node = tree
+        for component in path:
+            node = node.setdefault(component, {})
+        root, layer = file_hashes(data, piece_length)
+        node[b""] = {b"length": len(data), b"pieces root": root} if data else {b"length": 0}
+        if layer:
+            layers[root] = layer
+
+    info = {
+        b"file tree": tree,
+        b"meta version": 2,
+        b"name": b"test",
+        b"piece length": piece_length,
+    }
+    if hybrid:
+        entries = []
+        padded = b""
+        for position, (path, data) in enumerate(files):
+            entries.append({b"length": len(data), b"path": path})
+            padded += data
+            gap = -len(data) % piece_length
+            if gap and position < len(files) - 1:
+                entries.append({b"attr": b"p", b"length": gap, b"path": [b".pad", b"%d" % gap]})
+                padded += bytes(gap)
+        info[b"files"] = entries
+        info[b"pieces"] = b"".join(
+            hashlib.sha1(padded[i : i + piece_length]).digest()
+            for i in range(0, len(padded), piece_length)
+        )
+
+    metainfo = {b"announce": b"http://tracker/announce", b"info": info, b"piece layers": layers}
+    return bencode(metainfo)
+
+
+def padded_data(files, piece_length: int = PIECE_LENGTH) -> bytes:
+    data = b""
+    for position, (_, content) in enumerate(files):
+        data += content
+        if position < len(files) - 1:
+            data += bytes(-len(content) % piece_length)
+    return data
+
+
+@pytest.fixture
+def files():
+    # sorted like the file tree, with a file of several pieces, a small one and an empty one
+    return [
+        ([b"a"], os.urandom(5 * BLOCK_SIZE + 100)),
+        ([b"dir", b"b"], os.urandom(BLOCK_SIZE + 7)),
+        ([b"dir", b"empty"], b""),
+        ([b"z"], os.urandom(3 * BLOCK_SIZE)),
+    ]
+
+
+def test_file_hashes_check_the_piece_layer():
+    data = os.urandom(3 * PIECE_LENGTH + 1)
+    root, layer = file_hashes(data)
+
+    hashes = FileHashes(root, len(data), PIECE_LENGTH, 0, layer)
+    assert hashes.piece_count == 4
+    for piece in range(4):
+        piece_data = data[piece * PIECE_LENGTH : (piece + 1) * PIECE_LENGTH]
+        assert hashes.hash_piece(piece, piece_data) == hashes.piece_layer[piece]
+
+    with pytest.raises(ValueError):
+        FileHashes(root, len(data), PIECE_LENGTH, 0, b"\x00" + layer[1:])
+    with pytest.raises(ValueError):
+        FileHashes(root, len(data), PIECE_LENGTH, 0, None)
+
+
+def test_v2_torrent(files):
+    torrent = Torrent(make_metainfo(files))
+    info = torrent.info
+
+    assert info.has_v2 and not info.has_v1
+    assert [file.path for file in info.file_tree_files] == [path for path, _ in files]
+    # every file starts on a piece boundary
+    assert info.mode == TorrentInfo.MULTI_FILE_MODE
+    assert [(file.path, file.length, file.padding) for file in info.files][:3] == [
+        ([b"a"], 5 * BLOCK_SIZE + 100, False),
+        ([b".pad", b"%d" % (PIECE_LENGTH - BLOCK_SIZE - 100)], 16284, True),
+        ([b"dir", b"b"], BLOCK_SIZE + 7, False),
+    ]
+    data = padded_data(files)
+    assert info.total_length == len(data)
+    assert info.piece_count == 3 + 1 + 2
+
+    info_bytes = bencode(torrent._raw_data[b"info"])
+    assert torrent.info_hash_v2 == sha256(info_bytes)
+    assert torrent.info_hash == torrent.info_hash_v2[:20]
+
+    tree = HashTree.from_torrent(torrent)
+    assert tree.piece_count == info.piece_count
+    for index in range(info.piece_count):
+        piece = data[index * PIECE_LENGTH : (index + 1) * PIECE_LENGTH]
+        assert tree.hash_piece(index, piece) == tree.piece_hashes[index]
+
+
+def test_hybrid_torrent(files):
+    torrent = Torrent(make_metainfo(files, hybrid=True))
+
+    assert torrent.info.has_v1 and torrent.info.has_v2
+    assert torrent.info_hash == hashlib.sha1(bencode(torrent._raw_data[b"info"])).digest()
+    assert len(torrent.info_hash_v2) == 32
+    assert HashTree.from_torrent(torrent).piece_count == len(torrent.info.pieces)
+
+
+def test_hashes_are_checked_against_the_piece_layer():
+    data = os.urandom(4 * PIECE_LENGTH)
+    root, layer = file_hashes(data)
+    seed = FileHashes(root, len(data), PIECE_LENGTH, 0, layer)
+    leecher = FileHashes(root, len(data), PIECE_LENGTH, 0, layer)
+
+    # only pieces whose data we have can be served from the leaves
+    assert seed.serve(0, 2, 2, 0) is None
+    leaves = {1: seed.piece_leaves(1, data[PIECE_LENGTH : 2 * PIECE_LENGTH])}
+    hashes = seed.serve(0, 2, 2, 0, leaves)
+    assert hashes == [sha256(data[i : i + BLOCK_SIZE]) for i in (2 * BLOCK_SIZE, 3 * BLOCK_SIZE)]
+
+    block = data[3 * BLOCK_SIZE : 4 * BLOCK_SIZE]
+    assert leecher.verify_block(1, BLOCK_SIZE, block) is None
+    assert not leecher.add_hashes(0, 2, 2, [hashes[1], hashes[0]])
+    assert leecher.add_hashes(0, 2, 2, hashes)
+    assert leecher.verify_block(1, BLOCK_SIZE, block)
+    assert not leecher.verify_block(1, BLOCK_SIZE, bytes(BLOCK_SIZE))
+
+    # a single leaf is proven through its uncles up to the piece layer
+    proof = seed.serve(0, 3, 1, 5, leaves)
+    assert len(proof) == 1 + 3
+    assert leecher.add_hashes(0, 3, 1, proof)
+    assert not leecher.add_hashes(0, 2, 1, proof)
+
+    # the piece layer itself, with the uncles up to the root
+    assert seed.serve(1, 0, 4, 0) == [layer[i : i + 32] for i in range(0, len(layer), 32)]
+    assert leecher.add_hashes(1, 0, 2, seed.serve(1, 0, 2, 1))
+
+
+def test_serve_builds_each_piece_tree_once(monkeypatch):
+    data = os.urandom(4 * PIECE_LENGTH)
+    root, layer = file_hashes(data)
+    seed = FileHashes(root, len(data), PIECE_LENGTH, 0, layer)
+    leaves = {
+        piece: seed.piece_leaves(piece, data[piece * PIECE_LENGTH : (piece + 1) * PIECE_LENGTH])
+        for piece in range(4)
+    }
+    seed.serve(1, 0, 4, 0)
+
+    calls = []
+    layers = merkle.merkle_layers
+    monkeypatch.setattr(merkle, "merkle_layers", lambda *args: calls.append(args) or layers(*args))
+    hashes = seed.serve(0, 0, 8, 2, leaves)
+
+    assert hashes[:8] == [sha256(data[i : i + BLOCK_SIZE]) for i in range(0, len(data), BLOCK_SIZE)]
+    assert len(calls) == 4
+
+
+def test_padding_blocks_are_zeros():
+    data = os.urandom(PIECE_LENGTH + 100)
+    root, layer = file_hashes(data)
+    hashes = FileHashes(root, len(data), PIECE_LENGTH, 0, layer)
+    last = data[PIECE_LENGTH:]
+    hashes.leaves[1] = hashes.piece_leaves(1, last)
+
+    assert hashes.verify_block(1, 0, last + bytes(BLOCK_SIZE - 100))
+    assert not hashes.verify_block(1, 0, last + b"\x01" + bytes(BLOCK_SIZE - 101))
+    assert hashes.verify_block(1, BLOCK_SIZE, bytes(BLOCK_SIZE))
+    assert not hashes.verify_block(1, BLOCK_SIZE, b"\x01" * BLOCK_SIZE)
+
+
+def test_storage_skips_pad_files(files, tmp_path):
+    torrent = Torrent(make_metainfo(files))
+    storage = Storage.from_torrent(torrent, tmp_path)
+    data = padded_data(files)
+
+    async def _run():
+        await storage.run(storage.allocate)
+        for index in range(torrent.info.piece_count):
+            await storage.write(index, 0, data[index * PIECE_LENGTH : (index + 1) * PIECE_LENGTH])
+        await storage.flush()
+        return await storage.read(0, 0, PIECE_LENGTH), await storage.read(3, 0, PIECE_LENGTH)
+
+    try:
+        first, padded = asyncio.run(_run())
+    finally:
+        storage.close()
+
+    assert first == data[:PIECE_LENGTH]
+    assert padded == files[1][1] + bytes(PIECE_LENGTH - BLOCK_SIZE - 7)
+    assert (tmp_path / "test" / "a").read_bytes() == files[0][1]
+    assert (tmp_path / "test" / "dir" / "b").read_bytes() == files[1][1]
+    assert not (tmp_path / "test" / ".pad").exists()
+
+
+def connection_for(torrent: Torrent, tmp_path, have: bool = False) -> PeerConnection:
+    piece_manager = PieceManager.from_torrent(torrent)
+    uploader = None
+    if have:
+        storage = Storage.from_torrent(torrent, tmp_path)
+        written = Bitfield(piece_manager.piece_count)
+        for index in range(piece_manager.piece_count):
+            written.add(index)
+        uploader = Uploader(storage, written, piece_manager)
+
+    connection = PeerConnection(
+        ("10.0.0.1", 6881),
+        torrent.info_hash,
+        b"p" * 20,
+        piece_manager,
+        None,
+        uploader=uploader,
+        hash_tree=HashTree.from_torrent(torrent),
+    )
+    connection.remote_reserved = Handshake.RESERVED
+    connection.protocol = PeerProtocol()
+    connection.transport = FakeTransport()
+    connection.protocol.connection_made(connection.transport)
+    piece_manager.add_peer(connection)
+    return connection
+
+
+def sent(connection: PeerConnection):
+    connection.protocol.flush()
+    protocol = PeerProtocol()
+    protocol.connection_made(FakeTransport())
+    data = bytes(connection.transport.written)
+    connection.transport.written.clear()
+    buffer = protocol.get_buffer(len(data))
+    buffer[: len(data)] = data
+    protocol.buffer_updated(len(data))
+
+    messages = []
+    iterator = PeerStreamIterator(protocol)
+    while message := iterator.parse():
+        messages.append(message)
+    return messages
+
+
+def test_blocks_are_verified_as_they_arrive(tmp_path):
+    # a single file torrent, named like its file
+    files = [([b"test"], os.urandom(3 * PIECE_LENGTH))]
+    torrent = Torrent(make_metainfo(files))
+    data = files[0][1]
+    (tmp_path / "seed").mkdir()
+    (tmp_path / "seed" / "test").write_bytes(data)
+
+    async def _run():
+        leecher = connection_for(torrent, tmp_path / "leecher")
+        seed = connection_for(torrent, tmp_path / "seed", have=True)
+        leecher.peer_choking = False
+
+        # the leaf hashes of every new piece are asked for before its blocks
+        await leecher._handle_message(HaveAll())
+        messages = sent(leecher)
+        hash_requests = [message for message in messages if isinstance(message, HashRequest)]
+        requests = [message for message in messages if isinstance(message, Request)]
+        assert hash_requests and requests
+        assert messages.index(hash_requests[-1]) < messages.index(requests[0])
+
+        # the seed hashes the pieces from disk to answer
+        for request in hash_requests:
+            await seed._handle_message(request)
+        answers = sent(seed)
+        assert all(isinstance(message, Hashes) for message in answers)
+        for message in answers:
+            await leecher._handle_message(message)
+        sent(leecher)
+
+        # a bad block is dropped right away and requested again
+        index, begin = requests[0].index, requests[0].begin
+        await leecher._handle_message(Piece(index, begin, bytes(BLOCK_SIZE)))
+        assert leecher.piece_manager.hash_failures[leecher.address] == 1
+        resent = [message for message in sent(leecher) if isinstance(message, Request)]
+        assert (index, begin) in [(message.index, message.begin) for message in resent]
+
+        offset = index * PIECE_LENGTH + begin
+        await leecher._handle_message(Piece(index, begin, data[offset : offset + BLOCK_SIZE]))
+        assert leecher.piece_manager.hash_failures[leecher.address] == 1
+
+        # hashes of a file we do not know are rejected
+        await seed._handle_message(HashRequest(bytes(32), 0, 0, 2, 0))
+        assert isinstance(sent(seed)[0], HashReject)
+
+        seed.uploader.storage.close()
+
+    asyncio.run(_run())
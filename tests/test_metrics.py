@@ -0,0 +1,96 @@
+import asyncio
+
+import aiohttp
+import pytest
+
+from main import Manager
+from pytorrent.metrics import Histogram, Registry, TorrentMetrics
+
+from .test_peer_pool import unused_port
+
+
+def test_registry_series():
+    registry = Registry()
+    counter = registry.counter("requests_total", "Requests", peer="a")
+    assert registry.counter("requests_total", "Requests", peer="a") is counter
+    counter.inc()
+    counter.inc(2)
+    registry.counter("requests_total", "Requests", peer="b").inc()
+    registry.gauge("queue", "Queue depth", lambda: 7)
+
+    snapshot = registry.snapshot()
+    assert snapshot["requests_total"] == [
+        {"labels": {"peer": "a"}, "value": 3},
+        {"labels": {"peer": "b"}, "value": 1},
+    ]
+    assert snapshot["queue"] == [{"labels": {}, "value": 7}]
+
+    with pytest.raises(ValueError):
+        registry.gauge("requests_total", "Requests")
+
+    registry.remove(peer="a")
+    assert [series["labels"] for series in registry.snapshot()["requests_total"]] == [
+        {"peer": "b"}
+    ]
+
+
+def test_histogram_buckets():
+    histogram = Histogram((0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 3.0):
+        histogram.observe(value)
+
+    assert histogram.get() == {"count": 4, "sum": pytest.approx(3.65), "buckets": {0.1: 2, 1.0: 3}}
+
+
+def test_prometheus_format():
+    registry = Registry()
+    registry.counter("bytes_total", "Bytes", torrent='a"b').inc(10)
+    registry.histogram("latency_seconds", "Latency", (0.5,)).observe(0.25)
+
+    assert registry.prometheus() == (
+        "# HELP bytes_total Bytes\n"
+        "# TYPE bytes_total counter\n"
+        'bytes_total{torrent="a\\"b"} 10\n'
+        "# HELP latency_seconds Latency\n"
+        "# TYPE latency_seconds histogram\n"
+        'latency_seconds_bucket{le="0.5"} 1\n'
+        'latency_seconds_bucket{le="+Inf"} 1\n'
+        "latency_seconds_sum 0.25\n"
+        "latency_seconds_count 1\n"
+    )
+
+
+def test_torrent_metrics_are_removed_with_the_torrent():
+    registry = Registry()
+    metrics = TorrentMetrics(registry, b"\x01" * 20)
+    metrics.message_received("Piece")
+    metrics.connect_attempt("timeout")
+    assert registry.snapshot()["pytorrent_messages_total"][0]["labels"]["type"] == "Piece"
+
+    metrics.close()
+    assert registry.snapshot() == {}
+
+
+def test_manager_serves_metrics(tmp_path):
+    async def _run():
+        manager = Manager(str(tmp_path))
+        manager.loop_monitor.interval = 0.01
+        port = manager.metrics_port = unused_port()
+        await manager.run()
+        await asyncio.sleep(0.05)
+
+        async with aiohttp.ClientSession() as client:
+            async with client.get(f"http://127.0.0.1:{port}/metrics") as response:
+                assert response.status == 200
+                assert response.headers["Content-Type"].startswith("text/plain; version=0.0.4")
+                text = await response.text()
+
+        stats = manager.stats()
+        manager.stop()
+        await asyncio.sleep(0)
+        return text, stats
+
+    text, stats = asyncio.run(_run())
+    assert "# TYPE pytorrent_event_loop_lag_seconds gauge" in text
+    assert "pytorrent_event_loop_lag_distribution_seconds_count" in text
+    assert stats["torrents"] == {} and stats["event_loop_lag"] >= 0
@@ -0,0 +1,397 @@
+import asyncio
+import struct
+
+import pytest
+
+from pytorrent.peer_connection import (
+    AllowedFast,
+    BitField,
+    Cancel,
+    Choke,
+    Extended,
+    Handshake,
+    HashReject,
+    HashRequest,
+    Hashes,
+    Have,
+    HaveAll,
+    HaveNone,
+    Interested,
+    KeepAlive,
+    NotInterested,
+    Piece,
+    PeerConnection,
+    PeerProtocol,
+    Port,
+    ProtocolError,
+    PeerStreamIterator,
+    ReceiveBuffer,
+    RejectRequest,
+    Request,
+    RequestPipeline,
+    Suggest,
+    UnChoke,
+    allowed_fast_set,
+)
+from pytorrent.piece_manager import PieceManager
+
+from .conftest import FakeTransport
+
+
+def feed(protocol: PeerProtocol, data: bytes, chunk_size: int):
+    for i in range(0, len(data), chunk_size):
+        chunk = data[i : i + chunk_size]
+        buffer = protocol.get_buffer(len(chunk))
+        buffer[: len(chunk)] = chunk
+        protocol.buffer_updated(len(chunk))
+
+
+def piece_frame(index: int, begin: int, data: bytes) -> bytes:
+    return struct.pack(">IbII", 9 + len(data), 7, index, begin) + data
+
+
+def collect(stream: bytes, chunk_size: int):
+    async def _collect():
+        protocol = PeerProtocol()
+        protocol.connection_made(FakeTransport())
+        feed(protocol, stream, chunk_size)
+        protocol.eof_received()
+
+        messages = []
+        async for message in PeerStreamIterator(protocol):
+            if isinstance(message, Piece):
+                assert isinstance(message.data, memoryview)
+                message.data = bytes(message.data)
+            messages.append(message)
+        return messages
+
+    return asyncio.run(_collect())
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 1000, 1 << 20])
+def test_framing(chunk_size):
+    block = bytes(range(256)) * 64
+    stream = (
+        struct.pack(">I", 0)
+        + struct.pack(">Ib", 1, 1)
+        + Have(42).encode()
+        + Request(1, 2, 3).encode()
+        + piece_frame(3, 16384, block)
+        + struct.pack(">IbI", 5, 99, 0)
+        + piece_frame(4, 0, b"tail")
+    )
+
+    messages = collect(stream, chunk_size)
+
+    assert [type(m) for m in messages] == [KeepAlive, UnChoke, Have, Request, Piece, Piece]
+    assert messages[2].index == 42
+    assert (messages[3].index, messages[3].begin, messages[3].length) == (1, 2, 3)
+    assert (messages[4].index, messages[4].begin, messages[4].data) == (3, 16384, block)
+    assert messages[5].data == b"tail"
+
+
+def test_iteration_is_cancellable():
+    async def _run():
+        protocol = PeerProtocol()
+        protocol.connection_made(FakeTransport())
+
+        async def _iterate():
+            async for _ in PeerStreamIterator(protocol):
+                pass
+
+        task = asyncio.ensure_future(_iterate())
+        await asyncio.sleep(0)
+        task.cancel()
+        # a stopped connection is not mistaken for the peer hanging up
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(_run())
+
+
+def test_receive_buffer_keeps_pinned_views():
+    buffer = ReceiveBuffer(32)
+    buffer.get_buffer(8)[:8] = b"abcdefgh"
+    buffer.buffer_updated(8)
+
+    view = buffer.view[buffer.start : buffer.start + 4]
+    buffer.consume(4)
+    buffer.pinned = True
+
+    buffer.reserve(28)
+    buffer.get_buffer(4)[:4] = b"ijkl"
+    buffer.buffer_updated(4)
+
+    assert view == b"abcd"
+    assert buffer.view[buffer.start : buffer.end] == b"efghijkl"
+
+
+def test_receive_buffer_grows_for_large_frames():
+    buffer = ReceiveBuffer(16)
+    buffer.reserve(100)
+
+    assert len(buffer.data) >= 100
+    assert len(buffer) == 0
+
+
+def test_pipeline_depth_follows_bandwidth_delay_product():
+    pipeline = RequestPipeline(block_size=16384)
+    rtt = 0.2
+    now = 0.0
+
+    # a 1 MiB/s link with 200 ms latency needs ~13 blocks in flight
+    for i in range(400):
+        pipeline.sent(i, 0, 16384, now)
+        now += 16384 / (1024 * 1024)
+        pipeline.received(i, 0, 16384, now + rtt)
+
+    bdp = 1024 * 1024 * rtt / 16384
+    assert pipeline.min_rtt == pytest.approx(rtt, rel=0.1)
+    assert bdp < pipeline.depth <= 2 * bdp + RequestPipeline.MIN_DEPTH
+
+
+def test_pipeline_expired_requests():
+    pipeline = RequestPipeline()
+    pipeline.depth = 16
+    pipeline.sent(1, 0, 16384, now=0.0)
+    pipeline.sent(1, 16384, 16384, now=100.0)
+
+    assert pipeline.expired(now=100.0) == [(1, 0)]
+    assert (1, 16384) in pipeline
+    assert pipeline.depth == 8
+    assert not pipeline.received(1, 0, 16384, now=101.0)
+
+
+@pytest.mark.parametrize(
+    "message",
+    [
+        Choke(),
+        Have(7),
+        BitField(b"\xff\x80"),
+        Request(1, 16384, 16384),
+        Cancel(1, 16384, 16384),
+        Piece(2, 0, b"data"),
+        Port(6881),
+        Suggest(3),
+        HaveAll(),
+        HaveNone(),
+        RejectRequest(1, 16384, 16384),
+        AllowedFast(9),
+        Extended(1, b"d5:addedi0ee"),
+        HashRequest(b"r" * 32, 0, 4, 4, 2),
+        Hashes(b"r" * 32, 0, 4, 2, 1, [b"a" * 32, b"b" * 32, b"c" * 32]),
+        HashReject(b"r" * 32, 0, 4, 4, 2),
+    ],
+    ids=lambda message: str(message),
+)
+def test_message_roundtrip(message):
+    frame = message.encode()
+    decoded = collect(frame, len(frame))[0]
+
+    assert type(decoded) is type(message)
+    assert decoded.encode() == frame
+    with pytest.raises(AttributeError):
+        message.extra = 1
+
+
+def test_handshake_roundtrip():
+    handshake = Handshake(b"i" * 20, b"p" * 20, reserved=b"\x00" * 5 + b"\x10" + b"\x00" * 2)
+    decoded = Handshake.decode(handshake.encode())
+
+    assert (decoded.info_hash, decoded.peer_id, decoded.reserved) == (
+        handshake.info_hash,
+        handshake.peer_id,
+        handshake.reserved,
+    )
+    assert Handshake.decode(b"\x13" + b"x" * 67) is None
+
+
+def test_fixed_size_message_with_wrong_length():
+    with pytest.raises(ProtocolError):
+        collect(struct.pack(">IBIB", 6, 4, 1, 0), 16)
+
+
+def test_writes_are_coalesced(transport):
+    async def _run():
+        protocol = PeerProtocol()
+        protocol.connection_made(transport)
+
+        for index in range(10):
+            protocol.write(Have(index).encode())
+        protocol.writelines([Piece(0, 0, b"abc").encode_header(), b"abc"])
+        assert not transport.written
+
+        await asyncio.sleep(0)
+        return transport
+
+    transport = asyncio.run(_run())
+    assert transport.writes == 1
+    assert transport.written == b"".join(Have(i).encode() for i in range(10)) + Piece(
+        0, 0, b"abc"
+    ).encode()
+
+
+def test_every_drainer_is_woken():
+    async def _run():
+        protocol = PeerProtocol()
+        protocol.connection_made(FakeTransport())
+        protocol.pause_writing()
+
+        # the run loop and the upload task wait at the same time
+        first = asyncio.ensure_future(protocol.drain())
+        second = asyncio.ensure_future(protocol.drain())
+        await asyncio.sleep(0)
+        assert not first.done() and not second.done()
+
+        protocol.resume_writing()
+        await asyncio.wait_for(asyncio.gather(first, second), 1)
+
+        protocol.pause_writing()
+        third = asyncio.ensure_future(protocol.drain())
+        await asyncio.sleep(0)
+        protocol.connection_lost(None)
+        await asyncio.wait_for(third, 1)
+
+    asyncio.run(_run())
+
+
+def test_cancel_is_not_a_request():
+    message = collect(Cancel(1, 0, 16384).encode(), 64)[0]
+
+    assert isinstance(message, Cancel)
+    assert not isinstance(message, Request)
+
+
+def test_allowed_fast_set():
+    # the example of BEP 6
+    info_hash = b"\xaa" * 20
+    assert allowed_fast_set(info_hash, "80.4.4.200", 1313, 7) == {
+        1059,
+        431,
+        808,
+        1217,
+        287,
+        376,
+        1188,
+    }
+    assert allowed_fast_set(info_hash, "80.4.4.200", 1313, 9) == allowed_fast_set(
+        info_hash, "80.4.4.1", 1313, 7
+    ) | {353, 508}
+    assert allowed_fast_set(info_hash, "::1", 1313) == set()
+    assert allowed_fast_set(info_hash, "80.4.4.200", 3) == {0, 1, 2}
+
+
+def fast_connection(piece_count: int = 4):
+    piece_manager = PieceManager(piece_count, 32 * 1024, piece_count * 32 * 1024)
+    connection = PeerConnection(("80.4.4.200", 6881), b"i" * 20, b"p" * 20, piece_manager, None)
+    connection.remote_reserved = Handshake.RESERVED
+    connection.protocol = PeerProtocol()
+    connection.transport = FakeTransport()
+    connection.protocol.connection_made(connection.transport)
+    piece_manager.add_peer(connection)
+    return connection
+
+
+def written(connection):
+    """
+    Messages the connection sent since the last call
+    """
+    connection.protocol.flush()
+    protocol = PeerProtocol()
+    protocol.connection_made(FakeTransport())
+    feed(protocol, bytes(connection.transport.written), 1024)
+    connection.transport.written.clear()
+
+    messages = []
+    iterator = PeerStreamIterator(protocol)
+    while message := iterator.parse():
+        messages.append(message)
+    return messages
+
+
+def test_reject_releases_request():
+    async def _run():
+        connection = fast_connection()
+        connection.peer_choking = False
+        await connection._handle_message(HaveAll())
+        requested = [
+            (message.index, message.begin)
+            for message in written(connection)
+            if isinstance(message, Request)
+        ]
+        assert requested and all(request in connection.pipeline for request in requested)
+
+        # the choke keeps the requests, the peer rejects them one by one
+        await connection._handle_message(Choke())
+        assert len(connection.pipeline) == len(requested)
+
+        index, begin = requested[0]
+        await connection._handle_message(RejectRequest(index, begin, 16384))
+        assert (index, begin) not in connection.pipeline
+
+        # the block is free for other peers again
+        piece_manager = connection.piece_manager
+        piece_manager.add_peer("seed")
+        piece_manager.peer_have_all("seed")
+        assert (index, begin, 16384) in piece_manager.next_requests("seed", 100)
+
+    asyncio.run(_run())
+
+
+def test_interest_follows_pieces():
+    async def _run():
+        connection = fast_connection()
+        await connection._handle_message(HaveNone())
+        assert not written(connection)
+
+        await connection._handle_message(Have(1))
+        assert [type(message) for message in written(connection)] == [Interested]
+
+        # once we have the only piece the peer has, it is no longer interesting
+        connection.piece_manager.mark_have(1)
+        connection.update_interest()
+        assert [type(message) for message in written(connection)] == [NotInterested]
+        connection.update_interest()
+        assert not written(connection)
+
+    asyncio.run(_run())
+
+
+def test_have_of_invalid_piece():
+    async def _run():
+        connection = fast_connection()
+        for index in (4, 2 ** 32 - 1):
+            with pytest.raises(ProtocolError):
+                await connection._handle_message(Have(index))
+        assert not connection.piece_manager.peer_has(connection, 3)
+
+    asyncio.run(_run())
+
+
+def test_allowed_fast_pieces_are_requested_while_choked():
+    async def _run():
+        connection = fast_connection()
+        await connection._handle_message(HaveAll())
+        assert [type(message) for message in written(connection)] == [Interested]
+
+        await connection._handle_message(AllowedFast(2))
+        assert {message.index for message in written(connection)} == {2}
+
+        # a peer that rejects its allowed fast piece is not asked again
+        for begin in (0, 16384):
+            await connection._handle_message(RejectRequest(2, begin, 16384))
+        assert not connection.allowed_fast and not written(connection)
+
+    asyncio.run(_run())
+
+
+def test_requests_from_choked_peer_are_rejected():
+    async def _run():
+        connection = fast_connection()
+        await connection._handle_message(Request(1, 0, 16384))
+
+        message = written(connection)[0]
+        assert isinstance(message, RejectRequest)
+        assert (message.index, message.begin, message.length) == (1, 0, 16384)
+
+    asyncio.run(_run())
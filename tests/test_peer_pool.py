@@ -0,0 +1,183 @@
+import asyncio
+import socket
+
+from pytorrent.budget import ResourceBudget, SessionLimits
+from pytorrent.listener import Listener
+from pytorrent.peer_connection import Handshake
+from pytorrent.peer_pool import PeerPool
+from pytorrent.piece_manager import PieceManager
+
+INFO_HASH = b"\x01" * 20
+
+
+class FakeConnection:
+    def __init__(self, address, downloaded, connected_at=0.0):
+        self.address = address
+        self.downloaded = downloaded
+        self.connected_at = connected_at
+        self.disconnected = False
+
+    def disconnect(self):
+        self.disconnected = True
+
+
+def unused_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def make_pool(**kwargs):
+    return PeerPool(INFO_HASH, "-PT9000-000000000000", PieceManager(4, 32, 128), **kwargs)
+
+
+def test_backoff_and_ban():
+    async def _run():
+        pool = make_pool()
+        address = ("10.0.0.1", 6881)
+        pool.add([address], now=0)
+        slot = pool.store.slot(address)
+
+        assert pool._next_candidate(0) == slot
+        pool.failed(slot, now=0)
+        assert pool.store.retry_at[slot] == PeerPool.BACKOFF
+        pool.failed(slot, now=0)
+        assert pool.store.retry_at[slot] == 2 * PeerPool.BACKOFF
+
+        # tracker announces do not bypass the backoff
+        pool.add([address], now=1)
+        assert pool._next_candidate(1) is None
+        assert pool._next_candidate(2 * PeerPool.BACKOFF) == slot
+
+        for _ in range(PeerPool.MAX_FAILURES - 2):
+            pool.failed(slot, now=0)
+        assert pool.is_banned(address, now=1)
+        assert not pool.is_banned(address, now=PeerPool.BAN_TIME + 1)
+
+        pool.add([address], now=2)
+        assert pool._next_candidate(2) is None
+
+    asyncio.run(_run())
+
+
+def test_optimize_replaces_slowest():
+    async def _run():
+        pool = make_pool(max_peers=3)
+        now = PeerPool.GRACE_PERIOD + 1
+        fast = FakeConnection(("10.0.0.1", 1), 10 ** 6)
+        slow = FakeConnection(("10.0.0.2", 1), 10 ** 3)
+        young = FakeConnection(("10.0.0.3", 1), 0, connected_at=now)
+
+        pool.add([c.address for c in (fast, slow, young)], now=0)
+        while pool._next_candidate(0) is not None:
+            pass
+        for connection in (fast, slow, young):
+            pool.connections[pool.store.slot(connection.address)] = connection
+
+        # nobody is waiting for a slot
+        assert pool.optimize(now) is None
+
+        # scores are rates since the previous call
+        fast.downloaded += 10 ** 6
+        slow.downloaded += 10 ** 3
+        pool.add([("10.0.0.4", 1)], now=now)
+        assert pool.optimize(now) is slow
+        assert slow.disconnected
+        assert pool.store.retry_at[pool.store.slot(slow.address)] > now
+
+    asyncio.run(_run())
+
+
+def test_balance_drops_connections_beyond_fair_share():
+    async def _run():
+        connections = ResourceBudget(4)
+        pool = make_pool(limits=SessionLimits("a", connections))
+        connections.register("b")
+
+        peers = [FakeConnection(("10.0.0.%d" % i, 1), 0) for i in range(1, 5)]
+        pool.add([peer.address for peer in peers], now=0)
+        for score, peer in enumerate(peers):
+            slot = pool.store.slot(peer.address)
+            pool.store.score[slot] = score
+            pool.connections[slot] = peer
+            await connections.acquire("a")
+
+        # nobody else is waiting
+        assert pool.balance(now=0) == []
+
+        waiting = asyncio.ensure_future(connections.acquire("b"))
+        await asyncio.sleep(0)
+        assert pool.balance(now=0) == peers[:2]
+        assert [peer.disconnected for peer in peers] == [True, True, False, False]
+
+        waiting.cancel()
+
+    asyncio.run(_run())
+
+
+def test_parallel_dialing():
+    async def _serve(reader, writer):
+        await reader.readexactly(Handshake.length)
+        writer.write(Handshake(INFO_HASH, b"-XX0000-000000000000").encode())
+        await writer.drain()
+        await reader.read()
+
+    async def _run():
+        server = await asyncio.start_server(_serve, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+
+        pool = make_pool(max_half_open=4)
+        dead = ("127.0.0.1", unused_port())
+        live = [("127.0.0.1", port)] * 3 + [("localhost", port)]
+        pool.add([dead, *live])
+        pool.start()
+
+        for _ in range(100):
+            if len(pool) == 2 and pool.store.failures[pool.store.slot(dead)]:
+                break
+            await asyncio.sleep(0.01)
+
+        connected = {connection.address for connection in pool.connections.values()}
+        assert connected == {("127.0.0.1", port), ("localhost", port)}
+        assert pool.store.retry_at[pool.store.slot(dead)] > 0
+
+        pool.stop()
+        await asyncio.sleep(0)
+        server.close()
+
+    asyncio.run(_run())
+
+
+def test_incoming_connections():
+    async def _run():
+        pool = make_pool(max_peers=1)
+        listener = Listener(pool.accept, "127.0.0.1")
+        await listener.start()
+
+        async def _connect(info_hash):
+            reader, writer = await asyncio.open_connection("127.0.0.1", listener.port)
+            writer.write(Handshake(info_hash, b"-XX0000-000000000000").encode())
+            return reader, writer
+
+        reader, writer = await _connect(INFO_HASH)
+        response = Handshake.decode(await reader.readexactly(Handshake.length))
+        assert response.info_hash == INFO_HASH
+        assert len(pool) == 1
+
+        # refused: unknown torrent, and no room for a second peer
+        for info_hash in (b"\x02" * 20, INFO_HASH):
+            other_reader, other_writer = await _connect(info_hash)
+            assert await other_reader.read() == b""
+            other_writer.close()
+
+        writer.close()
+        for _ in range(100):
+            if not len(pool):
+                break
+            await asyncio.sleep(0.01)
+        assert not len(pool) and not pool._retries
+
+        listener.close()
+        pool.stop()
+
+    asyncio.run(_run())
@@ -0,0 +1,55 @@
+import socket
+import struct
+
+from pytorrent.peer_store import (
+    COMPACT6_SIZE,
+    PeerStore,
+    decode_endpoint,
+    encode_address,
+    split_compact,
+)
+from pytorrent.torrent import TrackerResponse
+
+PEERS = socket.inet_aton("10.0.0.1") + struct.pack(">H", 6881)
+PEERS += socket.inet_aton("10.0.0.2") + struct.pack(">H", 6882)
+PEERS6 = socket.inet_pton(socket.AF_INET6, "2001:db8::1") + struct.pack(">H", 51413)
+
+
+def test_compact_decoding():
+    endpoints = split_compact(PEERS) + split_compact(PEERS6, COMPACT6_SIZE)
+    assert [decode_endpoint(endpoint) for endpoint in endpoints] == [
+        ("10.0.0.1", 6881),
+        ("10.0.0.2", 6882),
+        ("2001:db8::1", 51413),
+    ]
+    # a truncated trailing entry is ignored
+    assert split_compact(PEERS + b"\x01\x02") == [PEERS[:6], PEERS[6:]]
+    assert encode_address(("10.0.0.2", 6882)) == PEERS[6:]
+    assert encode_address(("example.org", 80)) == ("example.org", 80)
+
+
+def test_tracker_response_peer_formats():
+    response = TrackerResponse(
+        {
+            b"peers": [{b"ip": b"10.0.0.3", b"port": 1}, {b"ip": b"peer.example", b"port": 2}],
+            b"peers6": PEERS6,
+        }
+    )
+    assert response.peers == [("10.0.0.3", 1), ("peer.example", 2), ("2001:db8::1", 51413)]
+    assert TrackerResponse({b"peers": PEERS}).peers == [("10.0.0.1", 6881), ("10.0.0.2", 6882)]
+    assert TrackerResponse({}).peers == []
+
+
+def test_store_deduplicates():
+    store = PeerStore()
+    first = store.add_endpoints(TrackerResponse({b"peers": PEERS}).endpoints, PeerStore.TRACKER, 1)
+    second = store.add([("10.0.0.2", 6882), ("2001:db8::1", 51413)], PeerStore.PEX, now=2)
+
+    assert first == [0, 1]
+    assert second == [1, 2]
+    assert len(store) == 3
+    assert ("10.0.0.1", 6881) in store
+    assert store.address(2) == ("2001:db8::1", 51413)
+    assert list(store.last_seen) == [1, 2, 2]
+    both = PeerStore.TRACKER | PeerStore.PEX
+    assert list(store.sources) == [PeerStore.TRACKER, both, PeerStore.PEX]
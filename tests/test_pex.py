@@ -0,0 +1,138 @@
+import asyncio
+import struct
+
+from pytorrent.bcode import bdecode, bencode
+from pytorrent.peer_connection import Extended, Handshake, PeerConnection
+from pytorrent.peer_store import PeerStore, encode_address
+from pytorrent.pex import (
+    UT_PEX,
+    PeerExchange,
+    decode_handshake,
+    decode_listen_port,
+    decode_pex,
+    encode_handshake,
+    encode_pex,
+)
+
+from .test_peer_pool import INFO_HASH, make_pool
+
+V4 = [encode_address(("10.0.0.%d" % i, 6881)) for i in range(1, 4)]
+V6 = encode_address(("2001:db8::1", 51413))
+
+
+def test_pex_payload_roundtrip():
+    payload = encode_pex(V4[:2] + [V6, ("example.com", 80)], V4[2:], reachable={V4[1], V6})
+    message = bdecode(payload)
+
+    assert message[b"added.f"] == b"\x00\x10"
+    assert message[b"added6.f"] == b"\x10"
+    assert decode_pex(payload) == (V4[:2] + [V6], V4[2:])
+    assert decode_pex(b"garbage") == ([], [])
+
+
+def test_extension_handshake():
+    payload = encode_handshake({UT_PEX: 1}, 250)
+    assert bdecode(payload)[b"reqq"] == 250
+    assert decode_handshake(payload) == {UT_PEX: 1}
+    assert decode_handshake(bencode({"m": {"ut_pex": 0, "bad": "x"}})) == {UT_PEX: 0}
+    assert decode_handshake(b"l") == {}
+
+    assert decode_listen_port(bencode({"m": {}, "p": 6881})) == 6881
+    assert decode_listen_port(bencode({"p": 70000})) is None
+    assert decode_listen_port(payload) is None
+
+
+def test_peer_exchange_deltas():
+    exchange = PeerExchange()
+    assert exchange.due(now=0)
+
+    added, _ = decode_pex(exchange.update({V4[0], V4[1]}, now=0))
+    assert set(added) == {V4[0], V4[1]}
+    assert not exchange.due(now=30)
+
+    assert decode_pex(exchange.update({V4[1], V4[2]}, now=60)) == ([V4[2]], [V4[0]])
+    assert exchange.update({V4[1], V4[2]}, now=120) is None
+
+
+def test_only_connectable_peers_are_exchanged():
+    class Connection:
+        listen_address = PeerConnection.listen_address
+
+        def __init__(self, address, incoming=False, listen_port=None):
+            self.address = address
+            self.incoming = incoming
+            self.listen_port = listen_port
+
+        def send_pex(self, connected, now=None, reachable=()):
+            self.sent = connected, reachable
+
+    outgoing = Connection(("10.0.0.1", 6881))
+    told = Connection(("10.0.0.2", 50123), incoming=True, listen_port=6882)
+    ephemeral = Connection(("10.0.0.3", 50124), incoming=True)
+
+    async def _run():
+        pool = make_pool()
+        pool.connections = dict(enumerate([outgoing, told, ephemeral]))
+        pool.exchange_peers()
+
+    asyncio.run(_run())
+    connected, reachable = ephemeral.sent
+    assert connected == {encode_address(("10.0.0.1", 6881)), encode_address(("10.0.0.2", 6882))}
+    assert reachable == {encode_address(("10.0.0.1", 6881))}
+
+
+async def _read_message(reader):
+    length = struct.unpack(">I", await reader.readexactly(4))[0]
+    return await reader.readexactly(length) if length else b""
+
+
+def test_peers_are_exchanged_with_connections():
+    received = []
+
+    async def _serve(reader, writer):
+        await reader.readexactly(Handshake.length)
+        writer.write(Handshake(INFO_HASH, b"-XX0000-000000000000").encode())
+
+        while True:
+            message = await _read_message(reader)
+            if message[:2] == b"\x14\x00":
+                received.append(decode_handshake(message[2:]))
+                break
+
+        writer.write(Extended(0, encode_handshake({UT_PEX: 3})).encode())
+        writer.write(Extended(1, encode_pex(V4, [])).encode())
+        await writer.drain()
+
+        while True:
+            message = await _read_message(reader)
+            if message[:2] == b"\x14\x03":
+                received.append(decode_pex(message[2:]))
+
+    async def _run():
+        server = await asyncio.start_server(_serve, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+
+        pool = make_pool()
+        pool.add([("127.0.0.1", port)])
+        pool.start()
+
+        for _ in range(100):
+            if ("10.0.0.3", 6881) in pool.store:
+                break
+            await asyncio.sleep(0.01)
+
+        # the peer only hears about connections other than itself
+        connection = next(iter(pool.connections.values()))
+        pool.exchange_peers()
+        connection.send_pex({V6, encode_address(connection.address)}, now=10 ** 6)
+        await asyncio.sleep(0.05)
+
+        pool.stop()
+        server.close()
+        return pool
+
+    pool = asyncio.run(_run())
+
+    assert received == [{UT_PEX: 1}, ([V6], [])]
+    for endpoint in V4:
+        assert pool.store.sources[pool.store._slots[endpoint]] & PeerStore.PEX
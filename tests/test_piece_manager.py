@@ -0,0 +1,144 @@
+import pytest
+
+from pytorrent.piece_manager import Bitfield, PieceManager
+
+
+class FakePeer:
+    def __init__(self, address):
+        self.address = address
+
+
+def bitfield(length, pieces):
+    field = Bitfield(length)
+    for index in pieces:
+        field.add(index)
+    return field.to_bytes()
+
+
+@pytest.fixture
+def manager():
+    # 4 pieces of 2 blocks, the last piece is one short block
+    return PieceManager(4, 32, 3 * 32 + 10, block_size=16)
+
+
+def test_bitfield():
+    field = Bitfield(10, b"\xa0\xff")
+
+    assert list(field) == [0, 2, 8, 9]
+    assert len(field) == 4
+    assert field.add(1)
+    assert not field.add(1)
+    assert field.discard(0)
+    assert list(field) == [1, 2, 8, 9]
+
+
+def test_rarest_first(manager):
+    manager.peer_bitfield("a", bitfield(4, [0, 1, 2]))
+    manager.peer_bitfield("b", bitfield(4, [0, 1]))
+    manager.peer_have("c", 0)
+
+    assert manager.next_requests("a", 2) == [(2, 0, 16), (2, 16, 16)]
+    assert manager.next_requests("a", 2) == [(1, 0, 16), (1, 16, 16)]
+    assert manager.next_requests("b", 2) == [(0, 0, 16), (0, 16, 16)]
+    assert manager.next_requests("b", 2) == []
+
+
+def test_rarest_first_for_sparse_peer():
+    manager = PieceManager(1024, 16, 1024 * 16, block_size=16)
+    manager.peer_bitfield("dense", bitfield(1024, range(0, 1024, 2)))
+    manager.peer_bitfield("sparse", bitfield(1024, [2, 5, 9]))
+    assert "sparse" in manager._sparse and "dense" not in manager._sparse
+
+    # the pieces are taken from the peer's own set, rarest first
+    for other in ("b", "c"):
+        manager.peer_have(other, 9)
+    picked = [manager.next_requests("sparse", 1)[0][0] for _ in range(3)]
+    assert picked == [5, 2, 9]
+    assert manager.next_requests("sparse", 1) == []
+
+    # a peer that collects enough pieces is picked for through the buckets again
+    for index in range(1024 // PieceManager.SPARSE_RATIO):
+        manager.peer_have("sparse", 100 + index)
+    assert "sparse" not in manager._sparse
+    assert manager.next_requests("sparse", 1)[0][0] >= 100
+
+
+def test_partial_pieces_first():
+    manager = PieceManager(4, 32, 4 * 32, block_size=16)
+    manager.peer_have_all("a")
+    manager.peer_have_all("b")
+
+    first = manager.next_requests("a", 1)
+    assert manager.next_requests("b", 1) == [(first[0][0], 16, 16)]
+
+
+def test_last_piece_is_short(manager):
+    manager.peer_bitfield("a", bitfield(4, [3]))
+
+    assert manager.next_requests("a", 5) == [(3, 0, 10)]
+
+
+def test_remove_peer_releases_requests(manager):
+    manager.peer_have_all("a")
+    manager.peer_have("b", 1)
+    manager.next_requests("a", 8)
+
+    manager.remove_peer("a")
+
+    assert manager.seeds == 0
+    assert manager.next_requests("b", 8) == [(1, 0, 16), (1, 16, 16)]
+
+
+def test_endgame_and_cancel():
+    manager = PieceManager(4, 32, 4 * 32, block_size=16)
+    manager.peer_have_all("a")
+    manager.peer_have_all("b")
+
+    requests = manager.next_requests("a", 10)
+    assert len(requests) == 8
+    assert manager.endgame
+
+    duplicates = manager.next_requests("b", 10)
+    assert sorted(duplicates) == sorted(requests)
+
+    index, begin, length = requests[0]
+    complete, cancels = manager.block_received("b", index, begin, b"x" * length)
+    assert not complete
+    assert cancels == [("a", requests[0])]
+
+
+def test_verification(manager):
+    manager.peer_have("a", 0)
+    manager.peer_have("b", 0)
+
+    for owner in ("a", "b"):
+        (index, begin, length), = manager.next_requests(owner, 1)
+        complete, _ = manager.block_received(owner, index, begin, bytes([begin]) * length)
+
+    assert complete
+    assert manager.piece_data(0) == b"\x00" * 16 + b"\x10" * 16
+
+    assert manager.piece_verified(0, False) == {"a", "b"}
+    assert manager.hash_failures == {"a": 1, "b": 1}
+    assert len(manager.next_requests("a", 2)) == 2
+
+    manager.mark_have(0)
+    assert 0 in manager.have
+    assert manager.next_requests("a", 2) == []
+
+
+def test_hash_failures_by_address():
+    manager = PieceManager(4, 16, 4 * 16, block_size=16)
+    address = ("10.0.0.1", 6881)
+
+    for index in range(2):
+        # every failure comes from a new connection of the same peer
+        peer = FakePeer(address)
+        manager.peer_have(peer, index)
+        (_, begin, length), = manager.next_requests(peer, 1)
+        manager.block_received(peer, index, begin, bytes(length))
+        manager.piece_verified(index, False)
+        manager.remove_peer(peer)
+
+    assert manager.hash_failures == {address: 2}
+    assert manager.peer_hash_failures(FakePeer(address)) == 2
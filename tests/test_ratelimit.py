@@ -0,0 +1,63 @@
+import asyncio
+
+import pytest
+
+from pytorrent.budget import SessionLimits
+from pytorrent.peer_connection import PeerProtocol
+from pytorrent.ratelimit import TokenBucket
+
+from .test_peer_connection import feed
+
+
+def test_unlimited_bucket():
+    bucket = TokenBucket(parent=TokenBucket())
+
+    assert not bucket.limited
+    assert bucket.consume(10 ** 9) == 0
+
+
+def test_hierarchy():
+    root = TokenBucket(100 * 1024)
+    torrent = TokenBucket(parent=root)
+    peer = TokenBucket(20 * 1024, parent=torrent)
+    other = TokenBucket(parent=torrent)
+    now = peer._last
+
+    # the peer limit is hit first
+    assert peer.consume(20 * 1024, now) == 0
+    assert peer.consume(10 * 1024, now) == pytest.approx(0.5)
+    # the peer's traffic also counts against the global limit
+    assert other.consume(70 * 1024, now) == 0
+    assert other.consume(10 * 1024, now) == pytest.approx(0.1)
+    assert other.consume(0, now + 0.1) == pytest.approx(0, abs=1e-9)
+
+    # limits change at runtime, removing one does not touch its parents
+    peer.set_rate(None)
+    assert peer.limited
+    assert peer.consume(1024, now + 0.1) == pytest.approx(0.01)
+
+
+def test_session_limits_update_live_peers():
+    limits = SessionLimits("torrent", download=TokenBucket())
+    download, upload = limits.peer_buckets()
+
+    assert not download.limited and not upload.limited
+    limits.set_rates(download=10 ** 6, peer_upload=1000)
+    assert download.limited and download.rate is None
+    assert upload.rate == 1000
+
+
+def test_reading_paused_while_over_limit(transport):
+    async def _run():
+        protocol = PeerProtocol(TokenBucket(TokenBucket.MIN_BURST * 10))
+        protocol.connection_made(transport)
+
+        feed(protocol, bytes(TokenBucket.MIN_BURST * 10), 4096)
+        assert not transport.paused
+        feed(protocol, bytes(4096), 4096)
+        assert transport.paused
+
+        await asyncio.sleep(0.05)
+        assert not transport.paused
+
+    asyncio.run(_run())
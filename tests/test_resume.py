@@ -0,0 +1,58 @@
+import hashlib
+
+from pytorrent.piece_manager import Bitfield, PieceManager
+from pytorrent.resume import ResumeData, ResumeSnapshot, recheck
+from pytorrent.storage import Storage
+
+
+def make_storage(tmp_path):
+    return Storage([(tmp_path / "a", 40), (tmp_path / "b", 24)], 16)
+
+
+def test_resume_roundtrip(tmp_path):
+    storage = make_storage(tmp_path)
+    manager = PieceManager(4, 16, 64, block_size=8)
+    manager.peer_have_all("peer")
+    manager.mark_have(0)
+
+    (index, begin, length), = manager.next_requests("peer", 1)
+    manager.block_received("peer", index, begin, b"x" * length)
+
+    path = ResumeData.path_for(tmp_path / "resume", b"\x01" * 20)
+    ResumeSnapshot(b"\x01" * 20, manager.have, manager).save(path, storage)
+
+    resume = ResumeData.load(path)
+    assert resume.matches(b"\x01" * 20, storage)
+    assert list(Bitfield(4, resume.pieces)) == [0]
+    assert list(Bitfield(2, resume.partial[index])) == [0]
+    assert storage.read_blocking(index, 0, 8) == b"x" * 8
+
+    restored = PieceManager(4, 16, 64, block_size=8)
+    restored.peer_have_all("peer")
+    data = storage.read_blocking(index)
+    assert not restored.restore_partial(index, Bitfield(2, resume.partial[index]), data)
+    assert restored.next_requests("peer", 1) == [(index, 8, 8)]
+
+    (tmp_path / "b").write_bytes(b"changed")
+    assert not resume.matches(b"\x01" * 20, storage)
+    storage.close()
+
+
+def test_resume_ignores_invalid_file(tmp_path):
+    path = tmp_path / "broken.resume"
+    path.write_bytes(b"d7:versioni1e")
+
+    assert ResumeData.load(path) is None
+    assert ResumeData.load(tmp_path / "missing.resume") is None
+
+
+def test_recheck(tmp_path):
+    data = bytes(range(64))
+    (tmp_path / "a").write_bytes(data[:40])
+    (tmp_path / "b").write_bytes(data[40:56] + b"\xff" * 8)
+
+    hashes = [hashlib.sha1(data[i : i + 16]).digest() for i in range(0, 64, 16)]
+    storage = make_storage(tmp_path)
+
+    assert list(recheck(storage, hashes, workers=2)) == [0, 1, 2]
+    storage.close()
@@ -0,0 +1,71 @@
+import asyncio
+
+from benchmarks.swarm import Swarm, SwarmConfig
+from main import ShardedManager
+from pytorrent.peer_connection import Handshake
+from pytorrent.torrent import Torrent
+
+
+def test_torrents_run_in_worker_processes(tmp_path):
+    async def _run():
+        swarms = [
+            Swarm(SwarmConfig(size=512 * 1024, piece_length=64 * 1024, leechers=0, seed=seed))
+            for seed in range(2)
+        ]
+        torrents = [Torrent(await swarm.start()) for swarm in swarms]
+
+        manager = ShardedManager(2, str(tmp_path), listen_port=0, event_loop="asyncio")
+        try:
+            await manager.run()
+            assert [await manager.add_torrent(torrent) for torrent in torrents] == [0, 1]
+
+            for _ in range(300):
+                stats = await manager.stats()
+                progress = [
+                    stats["torrents"].get(torrent.info_hash.hex(), {}).get("left")
+                    for torrent in torrents
+                ]
+                if progress == [0, 0]:
+                    break
+                await asyncio.sleep(0.05)
+            assert progress == [0, 0]
+            assert len({worker["pid"] for worker in stats["workers"]}) == 2
+
+            # incoming connections reach the worker that runs the torrent
+            reader, writer = await asyncio.open_connection("127.0.0.1", manager.port)
+            writer.write(Handshake(torrents[1].info_hash, b"-XX0000-000000000000").encode())
+            response = Handshake.decode(await reader.readexactly(Handshake.length))
+            assert response.info_hash == torrents[1].info_hash
+            writer.close()
+
+            metrics = await manager.prometheus()
+            assert 'worker="0"' in metrics and 'worker="1"' in metrics
+        finally:
+            await manager.stop()
+            for swarm in swarms:
+                await swarm.stop()
+
+        assert not manager.processes
+
+    asyncio.run(_run())
+
+
+def test_worker_keeps_the_info_hash_of_non_canonical_torrents(tmp_path):
+    # keys out of order, encoding the info dict again would change its hash
+    info = b"d4:name3:foo6:lengthi1e12:piece lengthi16384e6:pieces20:" + bytes(20) + b"e"
+    torrent = Torrent(b"d8:announce27:http://127.0.0.1:9/announce4:info" + info + b"e")
+
+    async def _run():
+        manager = ShardedManager(1, str(tmp_path), listen_port=0, event_loop="asyncio")
+        try:
+            await manager.run()
+            await manager.add_torrent(torrent)
+            stats = await manager.stats()
+            assert list(stats["torrents"]) == [torrent.info_hash.hex()]
+
+            await manager.remove_torrent(torrent.info_hash)
+            assert not (await manager.stats())["torrents"]
+        finally:
+            await manager.stop()
+
+    asyncio.run(_run())
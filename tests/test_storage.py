@@ -0,0 +1,120 @@
+import asyncio
+import os
+import threading
+import time
+
+import pytest
+
+from pytorrent.storage import Storage
+
+
+@pytest.fixture
+def storage(tmp_path):
+    # three files of 10, 0 and 25 bytes in 8 byte pieces
+    files = [(tmp_path / "a", 10), (tmp_path / "sub" / "empty", 0), (tmp_path / "sub" / "b", 25)]
+    storage = Storage(files, 8, max_open_files=1)
+    yield storage
+    storage.close()
+
+
+def test_piece_segments(storage):
+    assert storage.piece_segments(0) == [(0, 0, 8)]
+    assert storage.piece_segments(1) == [(0, 8, 2), (2, 0, 6)]
+    assert storage.piece_segments(1, 4, 4) == [(2, 2, 4)]
+    assert storage.piece_segments(4) == [(2, 22, 3)]
+
+    with pytest.raises(ValueError):
+        storage.piece_segments(4, 0, 4)
+
+
+def test_write_and_read(storage, tmp_path):
+    data = bytes(range(35))
+
+    async def _run():
+        await storage.run(storage.allocate)
+        # blocks written out of order in the same loop iteration are coalesced
+        await asyncio.gather(
+            *[storage.write(i // 8, i % 8, data[i : i + 4]) for i in reversed(range(0, 35, 4))]
+        )
+        return await storage.read(1, 0, 8), await storage.read(4, 1, 2)
+
+    first, last = asyncio.run(_run())
+
+    assert first == data[8:16]
+    assert last == data[33:35]
+    assert (tmp_path / "a").read_bytes() == data[:10]
+    assert (tmp_path / "sub" / "b").read_bytes() == data[10:]
+    assert os.path.getsize(tmp_path / "sub" / "empty") == 0
+    assert len(storage._fds) == 1
+
+
+def test_write_coalescing(storage, monkeypatch):
+    calls = []
+    original = Storage._pwritev_fd
+
+    def _pwritev_fd(fd, offset, buffers):
+        calls.append((offset, len(buffers)))
+        original(fd, offset, buffers)
+
+    monkeypatch.setattr(Storage, "_pwritev_fd", staticmethod(_pwritev_fd))
+
+    async def _run():
+        await asyncio.gather(*[storage.write(2 + i // 8, i % 8, b"x" * 2) for i in range(0, 16, 2)])
+
+    asyncio.run(_run())
+
+    assert calls == [(6, 8)]
+
+
+def test_flush_blocking_waits_for_writes_under_way(storage, tmp_path, monkeypatch):
+    original = Storage._write_coalesced
+
+    def _write_coalesced(self, writes):
+        time.sleep(0.1)
+        original(self, writes)
+
+    monkeypatch.setattr(Storage, "_write_coalesced", _write_coalesced)
+
+    async def _run():
+        storage.write_nowait(0, 0, b"a" * 8)
+        await asyncio.sleep(0)
+        # handed to the executor, then the loop stops
+        assert storage._writing
+        storage.write_nowait(1, 0, b"b" * 8)
+
+    asyncio.run(_run())
+    storage.flush_blocking()
+
+    assert (tmp_path / "a").read_bytes() == b"a" * 8 + b"bb"
+
+
+def test_preallocation_does_not_block_other_files(tmp_path, monkeypatch):
+    storage = Storage([(tmp_path / "a", 10), (tmp_path / "b", 10)], 8, preallocate=True)
+    allocating = threading.Event()
+    release = threading.Event()
+
+    def _posix_fallocate(fd, offset, length):
+        if os.fstat(fd).st_ino == os.stat(tmp_path / "a").st_ino:
+            allocating.set()
+            release.wait(5)
+        os.ftruncate(fd, length)
+
+    monkeypatch.setattr(os, "posix_fallocate", _posix_fallocate, raising=False)
+
+    def _open(file_index):
+        with storage.open_file(file_index):
+            pass
+
+    slow = threading.Thread(target=_open, args=(0,))
+    slow.start()
+    assert allocating.wait(5)
+    other = threading.Thread(target=_open, args=(1,))
+    other.start()
+    other.join(1)
+    opened = not other.is_alive()
+
+    release.set()
+    slow.join()
+    other.join()
+    storage.close()
+    assert opened
@@ -0,0 +1,37 @@
+from benchmarks.swarm import SwarmConfig, simulate
+
+
+def test_download_from_loopback_swarm():
+    config = SwarmConfig(
+        size=3 * 1024 * 1024 + 1000,
+        piece_length=64 * 1024,
+        seeders=2,
+        leechers=2,
+        latency=0.002,
+        bandwidth=8 * 1024 * 1024,
+        loss=0.01,
+    )
+    report = simulate(config, in_process=True, timeout=30)
+
+    assert report["bytes"] == config.size
+    assert report["mb_per_sec"] > 0
+    assert 0 < report["time_to_first_piece"] <= report["seconds"]
+    assert report["cpu_per_mb"] > 0
+    # the simulated leechers fetched what they were missing from the client
+    assert report["uploaded"] > 0 and report["swarm"]["downloaded"] > 0
+    assert report["swarm"]["announces"] >= 1
+    events = report["swarm"]["events"]
+    assert events[0] == "started" and events[-1] == "stopped"
+    assert "completed" in events
+    assert report["swarm"]["reported_uploaded"] >= report["uploaded"]
+
+    metrics = report["metrics"]
+    messages = {
+        (series["labels"]["direction"], series["labels"]["type"])
+        for series in metrics["pytorrent_messages_total"]
+    }
+    assert {("in", "Piece"), ("out", "Request"), ("out", "Piece")} <= messages
+    assert metrics["pytorrent_request_latency_seconds"][0]["value"]["count"] > 0
+    assert metrics["pytorrent_disk_write_latency_seconds"][0]["value"]["count"] > 0
+    outcomes = metrics["pytorrent_connect_attempts_total"]
+    assert {series["labels"]["outcome"] for series in outcomes} == {"connected"}
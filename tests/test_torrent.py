@@ -0,0 +1,56 @@
+import hashlib
+
+import pytest
+
+from pytorrent.bcode import bencode
+from pytorrent.torrent import Torrent, TorrentInfo
+
+PIECES = b"".join(hashlib.sha1(bytes([i])).digest() for i in range(3))
+
+INFO = (
+    b"d5:filesld6:lengthi10e4:pathl1:a5:b.txteed6:lengthi32e4:pathl5:c.bineee"
+    b"4:name3:foo12:piece lengthi16e6:pieces60:" + PIECES + b"e"
+)
+
+TORRENT = b"d8:announce19:http://tracker/test4:info" + INFO + b"e"
+
+
+@pytest.fixture(params=[False, True], ids=["eager", "lazy"])
+def torrent(request, tmp_path):
+    path = tmp_path / "foo.torrent"
+    path.write_bytes(TORRENT)
+    return Torrent(path, lazy=request.param)
+
+
+def test_info_hash_uses_original_bytes(torrent):
+    assert torrent.info_hash == hashlib.sha1(INFO).digest()
+
+
+def test_info_hash_of_non_canonical_info():
+    info = b"d4:name3:foo6:lengthi1e12:piece lengthi16e6:pieces0:e"
+    torrent = Torrent(b"d8:announce3:url4:info" + info + b"e")
+
+    assert bencode(torrent.info._raw_data) != info
+    assert torrent.info_hash == hashlib.sha1(info).digest()
+
+
+def test_pieces(torrent):
+    pieces = torrent.info.pieces
+
+    assert len(pieces) == 3
+    assert pieces[1] == hashlib.sha1(b"\x01").digest()
+    assert pieces[-1] == hashlib.sha1(b"\x02").digest()
+    assert list(pieces) == [PIECES[i : i + 20] for i in range(0, 60, 20)]
+
+    with pytest.raises(IndexError):
+        pieces[3]
+
+
+def test_files(torrent):
+    assert torrent.info.mode == TorrentInfo.MULTI_FILE_MODE
+    assert torrent.info.name == b"foo"
+    assert torrent.total_size == 42
+    assert len(torrent.info.files) == 2
+    assert torrent.info.files[0].path == [b"a", b"b.txt"]
+    assert torrent.info.files[-1].length == 32
+    assert torrent.info.files[1] is torrent.info.files[1]
@@ -0,0 +1,140 @@
+import asyncio
+import struct
+
+import pytest
+
+from pytorrent.bcode import bencode
+from pytorrent.torrent import Torrent, Tracker
+from pytorrent.udp_tracker import UDPTracker
+
+PEERS = bytes([10, 0, 0, 1, 0x1A, 0xE1, 10, 0, 0, 2, 0x1A, 0xE2])
+
+
+class TrackerStandIn(asyncio.DatagramProtocol):
+    """
+    Minimal BEP 15 tracker, optionally ignoring the first datagrams or refusing announces
+    """
+
+    def __init__(self, drop: int = 0, refuse: bool = False, silent: bool = False):
+        self.drop = drop
+        self.refuse = refuse
+        self.silent = silent
+        self.connects = 0
+        self.announces = []
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if self.silent:
+            return
+        if self.drop:
+            self.drop -= 1
+            return
+
+        connection_id, action, transaction_id = struct.unpack_from(">QII", data)
+        if action == UDPTracker.CONNECT:
+            assert connection_id == UDPTracker.PROTOCOL_ID
+            self.connects += 1
+            self.transport.sendto(struct.pack(">IIQ", 0, transaction_id, 1234), addr)
+        elif self.refuse:
+            self.transport.sendto(struct.pack(">II", 3, transaction_id) + b"go away", addr)
+        else:
+            assert connection_id == 1234
+            self.announces.append(struct.unpack_from(">20s20sQQQIIIiH", data, 16))
+            self.transport.sendto(struct.pack(">IIIII", 1, transaction_id, 900, 3, 7) + PEERS, addr)
+
+
+async def start_tracker(**kwargs):
+    loop = asyncio.get_running_loop()
+    transport, protocol = await loop.create_datagram_endpoint(
+        lambda: TrackerStandIn(**kwargs), local_addr=("127.0.0.1", 0)
+    )
+    return f"udp://127.0.0.1:{transport.get_extra_info('sockname')[1]}/announce", protocol
+
+
+def make_torrent(tiers) -> Torrent:
+    info = {"name": "foo", "length": 1, "piece length": 16, "pieces": b"\x00" * 20}
+    return Torrent(bencode({"announce": tiers[0][0], "announce-list": tiers, "info": info}))
+
+
+@pytest.fixture(autouse=True)
+def fast_retransmit(monkeypatch):
+    monkeypatch.setattr(UDPTracker, "BASE_TIMEOUT", 0.05)
+    monkeypatch.setattr(UDPTracker, "MAX_RETRIES", 2)
+
+
+def test_announce_tiers():
+    torrent = make_torrent([["a"], ["b", "c"]])
+
+    assert torrent.announce_tiers[0] == ["a"]
+    assert sorted(torrent.announce_tiers[1]) == ["b", "c"]
+    assert sorted(torrent.announce_list) == ["a", "b", "c"]
+
+
+def test_udp_announce_caches_connection_id():
+    async def _run():
+        url, stand_in = await start_tracker()
+        tracker = Tracker(make_torrent([[url]]), client=object())
+
+        response = await tracker.announce(left=1, event="started")
+        assert response.peers == [("10.0.0.1", 6881), ("10.0.0.2", 6882)]
+        assert response.interval == 900
+
+        await tracker.announce(left=0)
+        assert stand_in.connects == 1
+
+        info_hash, peer_id, _, left, _, event, *_ = stand_in.announces[0]
+        assert info_hash == tracker.torrent.info_hash
+        assert peer_id == tracker.peer_id.encode()
+        assert (left, event) == (1, UDPTracker.EVENTS["started"])
+        assert stand_in.announces[1][3] == 0
+
+    asyncio.run(_run())
+
+
+def test_udp_retransmits():
+    async def _run():
+        url, stand_in = await start_tracker(drop=2)
+        response = await Tracker(make_torrent([[url]]), client=object()).announce()
+
+        assert len(response.peers) == 2
+        assert stand_in.connects == 1
+
+    asyncio.run(_run())
+
+
+def test_first_answer_in_tier_wins():
+    async def _run():
+        silent, _ = await start_tracker(silent=True)
+        live, stand_in = await start_tracker()
+        tracker = Tracker(make_torrent([[silent, live]]), client=object())
+        tracker.tiers = [[silent, live]]
+
+        response = await tracker.announce()
+        assert len(response.peers) == 2
+        assert tracker.tiers == [[live, silent]]
+
+    asyncio.run(_run())
+
+
+def test_next_tier_after_refusal():
+    async def _run():
+        refusing, _ = await start_tracker(refuse=True)
+        silent, _ = await start_tracker(silent=True)
+        live, stand_in = await start_tracker()
+        tracker = Tracker(make_torrent([[refusing], [silent], [live]]), client=object())
+
+        response = await tracker.announce()
+        assert not response.failure_reason
+        assert len(stand_in.announces) == 1
+
+        tracker.tiers = [[refusing]]
+        assert (await tracker.announce()).failure_reason == "go away"
+
+        tracker.tiers = [[silent]]
+        with pytest.raises(ConnectionError):
+            await tracker.announce()
+
+    asyncio.run(_run())
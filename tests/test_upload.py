@@ -0,0 +1,123 @@
+import asyncio
+import struct
+import threading
+
+import pytest
+
+from pytorrent.peer_connection import BitField, PeerProtocol, Piece
+from pytorrent.piece_manager import Bitfield, PieceManager
+from pytorrent.storage import Storage
+from pytorrent.upload import BlockCache, Uploader
+
+PIECE_LENGTH = 32 * 1024
+DATA = bytes(range(256)) * (3 * PIECE_LENGTH // 256 - 8)
+REQUESTS = [(0, 0, 16384), (0, 16384, 16384), (1, 0, 16384), (1, 16384, 16384)]
+
+
+@pytest.fixture
+def storage(tmp_path):
+    # two files, piece 1 spans both
+    files = [(tmp_path / "a", 40 * 1024), (tmp_path / "b", len(DATA) - 40 * 1024)]
+    storage = Storage(files, PIECE_LENGTH)
+    for index in range(3):
+        storage.write_blocking(index, 0, DATA[index * PIECE_LENGTH : (index + 1) * PIECE_LENGTH])
+    yield storage
+    storage.close()
+
+
+def make_uploader(storage, **kwargs):
+    piece_manager = PieceManager(3, PIECE_LENGTH, len(DATA), block_size=16 * 1024)
+    have = Bitfield(3)
+    have.add(0)
+    have.add(1)
+    return Uploader(storage, have, piece_manager, **kwargs)
+
+
+def test_message_encoding():
+    frame = Piece(3, 16, b"abc").encode()
+    assert frame == struct.pack(">IBII", 12, 7, 3, 16) + b"abc"
+    assert bytes(Piece.decode(frame).data) == b"abc"
+    assert BitField(b"\xa0").encode() == b"\x00\x00\x00\x02\x05\xa0"
+
+
+def test_validate(storage):
+    uploader = make_uploader(storage)
+
+    assert uploader.validate(0, 0, 16 * 1024)
+    assert uploader.validate(1, 16 * 1024, 16 * 1024)
+    assert not uploader.validate(2, 0, 16 * 1024)
+    assert not uploader.validate(3, 0, 16 * 1024)
+    assert not uploader.validate(0, 24 * 1024, 16 * 1024)
+    assert not uploader.validate(0, 0, 0)
+    assert not uploader.validate(0, -1, 1)
+
+
+def test_block_cache(storage):
+    async def _run():
+        cache = BlockCache(storage, max_bytes=2 * PIECE_LENGTH)
+
+        # concurrent misses on one piece share a read
+        first, second = await asyncio.gather(cache.read(0, 0, 4), cache.read(0, 4, 4))
+        assert bytes(first) + bytes(second) == DATA[:8]
+        assert cache.misses == 2 and 0 in cache
+
+        await cache.read(1, 0, 1)
+        assert bytes(await cache.read(0, 100, 2)) == DATA[100:102]
+        assert cache.hits == 1
+
+        await cache.read(2, 0, 1)
+        assert 1 not in cache and 0 in cache
+        assert cache.size == PIECE_LENGTH + len(DATA) - 2 * PIECE_LENGTH
+
+    asyncio.run(_run())
+
+
+@pytest.mark.parametrize("sendfile", [True, False], ids=["sendfile", "cache"])
+def test_send_blocks(storage, sendfile, monkeypatch):
+    borrowed_on = []
+    borrow_file = Storage.borrow_file
+
+    def _borrow_file(self, file_index):
+        borrowed_on.append(threading.current_thread())
+        return borrow_file(self, file_index)
+
+    monkeypatch.setattr(Storage, "borrow_file", _borrow_file)
+
+    async def _run():
+        received = bytearray()
+        done = asyncio.Event()
+
+        async def _receive(reader, writer):
+            while data := await reader.read(65536):
+                received.extend(data)
+            done.set()
+
+        server = await asyncio.start_server(_receive, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        transport, protocol = await asyncio.get_running_loop().create_connection(
+            PeerProtocol, "127.0.0.1", port
+        )
+
+        uploader = make_uploader(storage, sendfile=sendfile)
+        for index, begin, length in REQUESTS:
+            await uploader.send(protocol, index, begin, length)
+        await protocol.drain()
+
+        transport.close()
+        await done.wait()
+        server.close()
+        return uploader, received
+
+    uploader, received = asyncio.run(_run())
+
+    expected = b"".join(
+        Piece(index, begin, DATA[index * PIECE_LENGTH + begin :][:length]).encode()
+        for index, begin, length in REQUESTS
+    )
+    assert received == expected
+    assert uploader.uploaded == 4 * 16384
+    # piece 1 spans both files, it always goes through the cache
+    assert uploader.cache.misses == (1 if sendfile else 2)
+    # descriptors are opened off the event loop and given back
+    assert threading.main_thread() not in borrowed_on
+    assert all(users == 0 for _, users in storage._fds.values())
@@ -0,0 +1,89 @@
+import asyncio
+import hashlib
+import os
+
+from pytorrent.storage import Storage
+from pytorrent.verify import PieceVerifier, hash_storage
+
+
+def test_verify_pieces():
+    pieces = [bytes([i]) * (i + 1) * 1000 for i in range(8)]
+    hashes = [hashlib.sha1(piece).digest() for piece in pieces]
+    pieces[3] = b"corrupted"
+
+    async def _verify():
+        results = {}
+        verifier = PieceVerifier(hashes, results.__setitem__)
+        for index, piece in enumerate(pieces):
+            await verifier.submit(index, piece)
+        await verifier.join()
+        verifier.close()
+        return results
+
+    results = asyncio.run(_verify())
+
+    assert results == {i: i != 3 for i in range(8)}
+
+
+def test_verify_backpressure():
+    pieces = [bytes([i]) * 4096 for i in range(32)]
+    hashes = [hashlib.sha1(piece).digest() for piece in pieces]
+
+    async def _verify():
+        peak = 0
+        verifier = PieceVerifier(hashes, lambda index, valid: None, max_pending_bytes=3 * 4096)
+        for index, piece in enumerate(pieces):
+            await verifier.submit(index, piece)
+            peak = max(peak, verifier.pending_bytes)
+        await verifier.join()
+        verifier.close()
+        return peak, verifier.pending_bytes
+
+    peak, pending = asyncio.run(_verify())
+
+    assert peak <= 3 * 4096
+    assert pending == 0
+
+
+def test_verify_waits_for_saving():
+    pieces = [bytes([i]) * 4096 for i in range(4)]
+    hashes = [hashlib.sha1(piece).digest() for piece in pieces]
+
+    async def _verify():
+        saving = {}
+
+        def _on_result(index, valid):
+            saving[index] = asyncio.get_running_loop().create_future()
+            return saving[index]
+
+        verifier = PieceVerifier(hashes, _on_result, max_pending_bytes=2 * 4096)
+        await verifier.submit(0, pieces[0])
+        await verifier.submit(1, pieces[1])
+        await verifier.join()
+
+        # hashed but not saved yet, the next piece has to wait
+        assert verifier.pending_bytes == 2 * 4096
+        submit = asyncio.ensure_future(verifier.submit(2, pieces[2]))
+        await asyncio.sleep(0.01)
+        assert not submit.done()
+
+        saving[0].set_result(None)
+        await asyncio.wait_for(submit, 1)
+        verifier.close()
+
+    asyncio.run(_verify())
+
+
+def test_hash_storage(tmp_path):
+    data = os.urandom(100)
+    (tmp_path / "a").write_bytes(data[:30])
+    storage = Storage([(tmp_path / "a", 30), (tmp_path / "missing", 70)], 16, readonly=True)
+
+    progress = []
+    digests = hash_storage(storage, workers=2, progress=lambda *args: progress.append(args))
+    storage.close()
+
+    # the piece spanning both files and those after it cannot be read
+    assert digests[0] == hashlib.sha1(data[:16]).digest()
+    assert digests[1:] == [None] * 6
+    assert progress[-1] == (7, 7)